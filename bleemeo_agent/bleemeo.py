@@ -37,6 +37,8 @@ import bleemeo_agent.util
 
 
 MQTT_QUEUE_MAX_SIZE = 2000
+# With delta encoding of top_info, a full top_info is sent at this interval
+TOP_INFO_KEYFRAME_INTERVAL = 60
 
 
 class ApiError(Exception):
@@ -136,6 +138,11 @@ class BleemeoConnector(threading.Thread):
         self._last_discovery_sent = None
         self._last_update = None
         self.last_containers_removed = bleemeo_agent.util.get_clock()
+        # Processes of the last top_info sent, used by delta encoding.
+        # None means next top_info must be a full keyframe.
+        self._top_info_processes = None
+        self._top_info_keyframe_at = None
+        self._top_info_sequence = 0
         self.mqtt_client = mqtt.Client()
 
         # Lock held when modifying self.metrics_uuid or self.services_uuid and
@@ -158,6 +165,7 @@ class BleemeoConnector(threading.Thread):
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0 and not self.core.is_terminating.is_set():
             self.connected = True
+            self._top_info_processes = None
             msg = {
                 'public_ip': self.core.last_facts.get('public_ip'),
             }
@@ -193,6 +201,12 @@ class BleemeoConnector(threading.Thread):
             if body['message_type'] == 'threshold-update':
                 logging.debug('Got "threshold-update" message from Bleemeo')
                 self._last_update = 0  # trigger a sync with Bleemeo
+            if body['message_type'] == 'top-info-fast':
+                logging.debug('Got "top-info-fast" message from Bleemeo')
+                duration = body.get('duration')
+                if not isinstance(duration, (int, float)):
+                    duration = None
+                self.core.request_fast_top_info(duration)
 
     def on_publish(self, client, userdata, mid):
         self._mqtt_queue_size -= 1
@@ -220,6 +234,7 @@ class BleemeoConnector(threading.Thread):
         self.core.add_scheduled_job(
             self._bleemeo_health_check,
             seconds=60,
+            spread=True,
         )
 
         if self.core.sentry_client and self.agent_uuid:
@@ -454,26 +469,73 @@ class BleemeoConnector(threading.Thread):
             )
 
     def publish_top_info(self, top_info):
+        """ Send top_info, which must be already stripped
+
+            See Core.get_top_info(stripped=True).
+        """
         if self.agent_uuid is None:
             return
 
         if not self.connected:
             return
 
-        self.publish(
+        if self.core.config.get('bleemeo.top_info.delta', False):
+            top_info = self._top_info_delta(top_info)
+
+        queued = self.publish(
             'v1/agent/%s/top_info' % self.agent_uuid,
             bytearray(zlib.compress(json.dumps(top_info).encode('utf8')))
         )
+        if not queued:
+            # Next delta would be based on a message never sent
+            self._top_info_processes = None
+
+    def _top_info_delta(self, top_info):
+        """ Return the message to send for top_info with delta encoding
+
+            Message is either a keyframe (the full top_info with
+            "keyframe" set to True) or the delta from the previous message
+            (see bleemeo_agent.util.diff_top_info). Each message has a
+            "sequence" number which allow to detect a missing message.
+        """
+        processes = {
+            bleemeo_agent.util.get_process_key(process): process
+            for process in top_info['processes']
+        }
+        clock_now = bleemeo_agent.util.get_clock()
+        keyframe_interval = self.core.config.get(
+            'bleemeo.top_info.keyframe_interval', TOP_INFO_KEYFRAME_INTERVAL,
+        )
+
+        if (self._top_info_processes is None
+                or clock_now - self._top_info_keyframe_at
+                >= keyframe_interval):
+            message = top_info.copy()
+            message['keyframe'] = True
+            self._top_info_keyframe_at = clock_now
+        else:
+            message = bleemeo_agent.util.diff_top_info(
+                self._top_info_processes, processes, top_info,
+            )
+            message['keyframe'] = False
+
+        self._top_info_sequence += 1
+        message['sequence'] = self._top_info_sequence
+        self._top_info_processes = processes
+        return message
 
     def publish(self, topic, message, force=False):
+        """ Queue message for publication. Return False if it was dropped
+        """
         if self._mqtt_queue_size > MQTT_QUEUE_MAX_SIZE and not force:
-            return
+            return False
 
         self._mqtt_queue_size += 1
         self.mqtt_client.publish(
             topic,
             message,
             1)
+        return True
 
     def register(self):
         """ Register the agent to Bleemeo SaaS service
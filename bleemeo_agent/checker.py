@@ -16,14 +16,23 @@
 #   limitations under the License.
 #
 
+import asyncio
+import collections
+import collections.abc
+import concurrent.futures
+import functools
 import imaplib
 import logging
-import select
+import os
+import selectors
 import shlex
 import smtplib
 import socket
+import ssl
 import struct
+import threading
 import time
+import types
 
 import requests
 from six.moves.urllib import parse as urllib_parse
@@ -31,6 +40,79 @@ from six.moves.urllib import parse as urllib_parse
 import bleemeo_agent.util
 
 
+# The agent still support Python 3.4, which doesn't have async/await syntax.
+# Coroutines are generators using "yield from", decorated with coroutine.
+#
+# asyncio.coroutine is deprecated in Python 3.8 and removed in Python 3.11,
+# and recent asyncio only accept real coroutine objects. On Python 3.5+ the
+# generator is wrapped in an object implementing collections.abc.Coroutine.
+if hasattr(collections.abc, 'Coroutine'):
+    class _GeneratorCoroutine(collections.abc.Coroutine):
+        def __init__(self, generator):
+            self._generator = generator
+
+        def send(self, value):
+            return self._generator.send(value)
+
+        def throw(self, *args):
+            return self._generator.throw(*args)
+
+        def close(self):
+            return self._generator.close()
+
+        def __await__(self):
+            return self._generator
+
+        # Used by "yield from" in other coroutines
+        __iter__ = __await__
+
+    def coroutine(func):
+        """ Decorator for generator-based coroutines
+        """
+        # types.coroutine allows "yield from" on native coroutines
+        func = types.coroutine(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return _GeneratorCoroutine(func(*args, **kwargs))
+
+        return wrapper
+else:
+    coroutine = asyncio.coroutine
+
+# asyncio.async was renamed ensure_future in Python 3.4.4
+ensure_future = getattr(asyncio, 'ensure_future', None)
+if ensure_future is None:
+    ensure_future = getattr(asyncio, 'async')
+
+
+def run_coroutine_threadsafe(coro, loop):
+    """ Submit a coroutine to loop from another thread
+
+        Same as asyncio.run_coroutine_threadsafe, which is only available
+        since Python 3.4.4. Return a concurrent.futures.Future.
+    """
+    if hasattr(asyncio, 'run_coroutine_threadsafe'):
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
+    future = concurrent.futures.Future()
+
+    def copy_result(task):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start():
+        if future.set_running_or_notify_cancel():
+            ensure_future(coro, loop=loop).add_done_callback(copy_result)
+
+    loop.call_soon_threadsafe(start)
+    return future
+
+
 # Must match nagios return code
 STATUS_OK = 0
 STATUS_WARNING = 1
@@ -50,7 +132,7 @@ STATUS_NAME = {
 
 CHECKS_INFO = {
     'mysql': {
-        'check_type': 'tcp',
+        'check_type': 'mysql',
     },
     'apache': {
         'check_type': 'http',
@@ -75,7 +157,7 @@ CHECKS_INFO = {
         'check_type': 'tcp',
     },
     'postgresql': {
-        'check_type': 'tcp',
+        'check_type': 'postgresql',
     },
     'rabbitmq': {
         'check_type': 'tcp',
@@ -93,7 +175,7 @@ CHECKS_INFO = {
         'check_tcp_expect': 'VERSION',
     },
     'mongodb': {
-        'check_type': 'tcp',
+        'check_type': 'mongodb',
     },
     'nginx': {
         'check_type': 'http',
@@ -123,9 +205,544 @@ CHECKS_INFO = {
 }
 
 
+# PostgreSQL SSLRequest message: length (8) and the SSLRequest code
+POSTGRESQL_SSL_REQUEST = struct.pack('!II', 8, 80877103)
+
+# MongoDB OP_QUERY (opcode 2004) message running {isMaster: 1} on admin
+# database. isMaster is still accepted with OP_QUERY by recent versions
+# for connection handshake.
+MONGODB_OP_REPLY = 1
+MONGODB_OP_QUERY = 2004
+
+
+def _mongodb_is_master_request():
+    document = b'\x10isMaster\x00' + struct.pack('<i', 1) + b'\x00'
+    document = struct.pack('<i', len(document) + 4) + document
+    body = (
+        struct.pack('<i', 0)  # flags
+        + b'admin.$cmd\x00'
+        + struct.pack('<ii', 0, -1)  # numberToSkip, numberToReturn
+        + document
+    )
+    header = struct.pack('<iiii', 16 + len(body), 1, 0, MONGODB_OP_QUERY)
+    return header + body
+
+
+MONGODB_IS_MASTER = _mongodb_is_master_request()
+
+# Size of fixed-length BSON values, by type
+BSON_FIXED_SIZE = {
+    0x01: 8,  # double
+    0x07: 12,  # ObjectId
+    0x08: 1,  # boolean
+    0x09: 8,  # UTC datetime
+    0x0A: 0,  # null
+    0x10: 4,  # int32
+    0x11: 8,  # timestamp
+    0x12: 8,  # int64
+    0x13: 16,  # decimal128
+}
+
+
+def parse_bson_fields(data):
+    """ Return top-level numeric and boolean fields of a BSON document
+
+        Other fields are skipped. Parsing stop at the first unsupported type.
+    """
+    fields = {}
+    offset = 4
+    while offset < len(data) and data[offset] != 0:
+        field_type = data[offset]
+        name_end = data.index(b'\x00', offset + 1)
+        name = data[offset + 1:name_end].decode('utf-8', 'ignore')
+        offset = name_end + 1
+
+        if field_type == 0x01:
+            fields[name] = struct.unpack_from('<d', data, offset)[0]
+        elif field_type == 0x08:
+            fields[name] = data[offset] != 0
+        elif field_type == 0x10:
+            fields[name] = struct.unpack_from('<i', data, offset)[0]
+        elif field_type == 0x12:
+            fields[name] = struct.unpack_from('<q', data, offset)[0]
+
+        if field_type in BSON_FIXED_SIZE:
+            offset += BSON_FIXED_SIZE[field_type]
+        elif field_type in (0x02, 0x0D, 0x0E):
+            # string, JavaScript code and symbol: int32 length + bytes
+            offset += 4 + struct.unpack_from('<i', data, offset)[0]
+        elif field_type in (0x03, 0x04):
+            # embedded document and array: their length include itself
+            offset += struct.unpack_from('<i', data, offset)[0]
+        elif field_type == 0x05:
+            # binary: int32 length + subtype + bytes
+            offset += 5 + struct.unpack_from('<i', data, offset)[0]
+        else:
+            break
+    return fields
+
+
+@coroutine
+def read_mysql_greeting(reader):
+    """ Read the initial handshake packet sent by a MySQL server
+
+        Return (return_code, output), output is None on success.
+    """
+    header = yield from reader.readexactly(4)
+    length = struct.unpack('<I', header[:3] + b'\x00')[0]
+    payload = yield from reader.readexactly(length)
+
+    if payload[0] == 0xff:
+        # Error packet, e.g. "Too many connections" or host blocked
+        (error_code,) = struct.unpack_from('<H', payload, 1)
+        message = payload[3:]
+        if message.startswith(b'#'):
+            # skip SQL state marker and SQL state
+            message = message[6:]
+        return (
+            STATUS_CRITICAL,
+            'MySQL error %d: %s' % (
+                error_code, message.decode('utf-8', 'ignore'),
+            )
+        )
+    if payload[0] != 10:
+        return (
+            STATUS_CRITICAL,
+            'Unexpected MySQL protocol version %d' % payload[0],
+        )
+    return (STATUS_OK, None)
+
+
+@coroutine
+def read_mongodb_is_master(reader):
+    """ Read the response of a MongoDB server to isMaster
+    """
+    header = yield from reader.readexactly(16)
+    (length, _, _, opcode) = struct.unpack('<iiii', header)
+    body = yield from reader.readexactly(length - 16)
+    if opcode != MONGODB_OP_REPLY or len(body) < 20:
+        return (STATUS_CRITICAL, 'Unexpected MongoDB response')
+
+    # body is responseFlags, cursorID, startingFrom, numberReturned and
+    # documents
+    (number_returned,) = struct.unpack_from('<i', body, 16)
+    if number_returned < 1:
+        return (STATUS_CRITICAL, 'Unexpected MongoDB response')
+    fields = parse_bson_fields(body[20:])
+    if fields.get('ok') != 1:
+        return (STATUS_CRITICAL, 'MongoDB isMaster command failed')
+    return (STATUS_OK, None)
+
+
+# Native protocol probes: check_type => (protocol name, request to send,
+# coroutine reading the response)
+PROTOCOL_PROBES = {
+    'mysql': ('MySQL', None, read_mysql_greeting),
+    'mongodb': ('MongoDB', MONGODB_IS_MASTER, read_mongodb_is_master),
+}
+
+
+# Interval (in seconds) between two runs of a check
+CHECK_INTERVAL = 60
+
+# With adaptive interval (check.adaptive_interval), failing or flapping
+# checks run every CHECK_MIN_INTERVAL seconds. The interval of stable checks
+# doubles after each run up to CHECK_MAX_INTERVAL seconds, which is also
+# used for services in stopped containers.
+CHECK_MIN_INTERVAL = 15
+CHECK_MAX_INTERVAL = 300
+
+# A check is flapping if its status changed during the last
+# CHECK_FLAPPING_RUNS runs.
+CHECK_FLAPPING_RUNS = 5
+
+# A check that didn't complete within CHECK_DEADLINE seconds is stopped and
+# considered as critical.
+CHECK_DEADLINE = 30
+
+# Extra ports of a service are probed concurrently. All probes share this
+# deadline (in seconds), a port not answered in time is critical.
+EXTRA_PORTS_DEADLINE = 10
+
+# Number of check runs kept to compute response time percentiles. With the
+# default interval, the window is one hour.
+RESPONSE_TIME_WINDOW = 60
+
+# Checks that use blocking libraries (HTTP, IMAP, SMTP, Nagios) run in a
+# thread pool of CHECK_EXECUTOR_WORKERS threads.
+CHECK_EXECUTOR_WORKERS = 10
+
 # global variable with all checks created
 CHECKS = {}
 
+# Protect creation of core.check_runner and core.socket_supervisor
+_CORE_HELPERS_LOCK = threading.Lock()
+
+
+def get_check_interval(
+        interval, return_codes, stopped, min_interval, max_interval):
+    """ Return the next interval of a check with adaptive interval
+
+        return_codes are the last return codes of the check, most recent
+        last. stopped is True if the service is in a stopped container.
+    """
+    if stopped:
+        return max_interval
+    if return_codes[-1] != STATUS_OK or len(set(return_codes)) > 1:
+        return min_interval
+    return max(min_interval, min(max_interval, interval * 2))
+
+
+def get_runner(core):
+    """ Return the CheckRunner of core, starting it if needed
+    """
+    with _CORE_HELPERS_LOCK:
+        if core.check_runner is None:
+            core.check_runner = CheckRunner(core)
+        return core.check_runner
+
+
+class CheckRunner:
+    """ Run all service checks concurrently on one asyncio event loop
+
+        The event loop runs in a dedicated thread. Scheduled jobs only
+        submit checks to the runner, so a slow or dead service never
+        blocks a scheduler thread.
+
+        TCP and NTP checks are native coroutines. Other checks use blocking
+        libraries and run in a bounded thread pool. Nagios commands have
+        their own thread pool, so slow commands don't delay other checks.
+    """
+
+    def __init__(self, core):
+        self.core = core
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=CHECK_EXECUTOR_WORKERS,
+        )
+        command_concurrency = core.config.get(
+            'check.command_concurrency',
+            bleemeo_agent.util.COMMAND_POOL_SIZE,
+        )
+        # One thread per command slot, so commands never wait for a slot
+        # while holding a thread.
+        self.command_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=command_concurrency,
+        )
+        self.command_pool = bleemeo_agent.util.CommandPool(
+            max_running=command_concurrency,
+            on_finish=self._record_command,
+        )
+        # Checks currently running. Only accessed from the event loop
+        self._running = set()
+        # Address family => Task creating the SharedUDPEndpoint
+        self._udp_endpoints = {}
+
+        thread = threading.Thread(target=self._run_loop)
+        thread.daemon = True
+        thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _record_command(self, name, duration):
+        self.core.record_job_run(name, CHECK_INTERVAL, duration)
+
+    def submit(self, check):
+        """ Run check on the event loop. Could be called from any thread
+
+            Return a concurrent.futures.Future.
+        """
+        return run_coroutine_threadsafe(
+            self._run_check(check), self.loop,
+        )
+
+    def run_in_executor(self, func, *args):
+        """ Run a blocking function in the thread pool
+        """
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def run_command(self, command, name=None):
+        """ Run a command with the command pool, in its own thread pool
+        """
+        return self.loop.run_in_executor(
+            self.command_executor,
+            functools.partial(self.command_pool.run, command, name=name),
+        )
+
+    @coroutine
+    def udp_request(
+            self, data, address, port, key, response_key, timeout):
+        """ Send data on the shared UDP socket and wait for its response
+
+            key must be unique for the request, the response is the first
+            datagram for which response_key(datagram) == key.
+
+            Raise asyncio.TimeoutError if no response is received in time.
+        """
+        addresses = yield from self.loop.getaddrinfo(
+            address, port, type=socket.SOCK_DGRAM,
+        )
+        (family, _, _, _, sockaddr) = addresses[0]
+
+        task = self._udp_endpoints.get(family)
+        if task is None or (
+                task.done() and not task.cancelled() and task.exception()):
+            self._udp_endpoints[family] = ensure_future(
+                self.loop.create_datagram_endpoint(
+                    SharedUDPEndpoint, family=family,
+                ),
+            )
+        (_, endpoint) = yield from self._udp_endpoints[family]
+
+        response = yield from asyncio.wait_for(
+            endpoint.request(data, sockaddr, key, response_key),
+            timeout=timeout,
+        )
+        return response
+
+    @coroutine
+    def _run_check(self, check):
+        if check in self._running:
+            # Previous run is still in progress
+            self.core.record_job_skip(check.job_name, check.interval)
+            return
+
+        self._running.add(check)
+        start = bleemeo_agent.util.get_clock()
+        try:
+            yield from asyncio.wait_for(
+                check.run_check_async(), timeout=CHECK_DEADLINE,
+            )
+        except asyncio.TimeoutError:
+            check.process_result(
+                time.time(),
+                STATUS_CRITICAL,
+                'Check timed out after %d seconds' % CHECK_DEADLINE,
+            )
+        except Exception:
+            logging.debug(
+                'check %s (on %s) failed', check.service, check.instance,
+                exc_info=True,
+            )
+        finally:
+            self._running.discard(check)
+            self.core.record_job_run(
+                check.job_name,
+                check.interval,
+                bleemeo_agent.util.get_clock() - start,
+            )
+
+
+def get_supervisor(core):
+    """ Return the SocketSupervisor of core, starting it if needed
+    """
+    with _CORE_HELPERS_LOCK:
+        if core.socket_supervisor is None:
+            core.socket_supervisor = SocketSupervisor()
+        return core.socket_supervisor
+
+
+class SocketSupervisor:
+    """ Watch persistent check sockets and react to their closure
+
+        All sockets are registered once in a selector watched by a single
+        thread. When a peer close a socket, the owning check is notified
+        immediately.
+
+        The selector is only used from the supervisor thread, other threads
+        queue their requests and wake it up.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending = []
+        (self._wakeup_read, self._wakeup_write) = socket.socketpair()
+        self._wakeup_read.setblocking(False)
+        self._wakeup_write.setblocking(False)
+        self.selector.register(self._wakeup_read, selectors.EVENT_READ)
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def register(self, sock, check, key):
+        """ Watch sock, check.socket_closed(sock, key) is called on closure
+        """
+        self._queue(self._register, sock, (check, key))
+
+    def close(self, sock):
+        """ Stop watching sock and close it
+
+            The socket is closed by the supervisor thread, after it is
+            removed from the selector.
+        """
+        self._queue(self._close, sock)
+
+    def _queue(self, func, *args):
+        with self._lock:
+            self._pending.append((func, args))
+        try:
+            self._wakeup_write.send(b'\0')
+        except socket.error:
+            # buffer full, the supervisor will be woken up anyway
+            pass
+
+    def _register(self, sock, data):
+        self.selector.register(sock, selectors.EVENT_READ, data)
+
+    def _close(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+
+    def _process_pending(self):
+        try:
+            while self._wakeup_read.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+
+        for (func, args) in pending:
+            try:
+                func(*args)
+            except Exception:
+                logging.debug(
+                    'Socket supervisor failed to process request',
+                    exc_info=True,
+                )
+
+    def _run(self):
+        while True:
+            for (selector_key, _) in self.selector.select():
+                if selector_key.fileobj is self._wakeup_read:
+                    self._process_pending()
+                    continue
+
+                sock = selector_key.fileobj
+                try:
+                    buffer = sock.recv(65536)
+                except socket.error:
+                    buffer = b''
+
+                if buffer != b'':
+                    # Data sent by the server are ignored
+                    continue
+
+                self._close(sock)
+                (check, key) = selector_key.data
+                try:
+                    check.socket_closed(sock, key)
+                except Exception:
+                    logging.debug(
+                        'Failed to process closure of socket', exc_info=True,
+                    )
+
+
+class SharedUDPEndpoint(asyncio.DatagramProtocol):
+    """ UDP socket shared by all UDP checks
+
+        Requests are multiplexed by a key: request() register the key
+        expected in the response and response_key(data) extract that key
+        from received datagrams.
+    """
+
+    def __init__(self):
+        self.transport = None
+        # key => Future of the response
+        self._pending = {}
+        self._response_key_functions = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    @coroutine
+    def request(self, data, address, key, response_key):
+        """ Send data to address and return the response matching key
+        """
+        future = asyncio.Future()
+        self._pending[key] = future
+        self._response_key_functions.add(response_key)
+        try:
+            self.transport.sendto(data, address)
+            response = yield from future
+            return response
+        finally:
+            self._pending.pop(key, None)
+
+    def datagram_received(self, data, addr):
+        for response_key in self._response_key_functions:
+            try:
+                key = response_key(data)
+            except Exception:
+                continue
+            future = self._pending.get(key)
+            if future is not None and not future.done():
+                future.set_result(data)
+                return
+
+    def error_received(self, exc):
+        # The socket isn't connected, the error can't be associated with
+        # a request. It will time out.
+        logging.debug('Error on shared UDP socket: %s', exc)
+
+
+def ntp_response_key(data):
+    """ Return the key of an NTP response
+
+        The server copy the transmit timestamp of the request in the
+        originate timestamp of the response.
+    """
+    return data[24:32]
+
+
+# Fields of the service information used by checks. Other fields (e.g. stack
+# or container_id) don't require to recreate the check when they change.
+PROBE_FIELDS = (
+    'address',
+    'port',
+    'protocol',
+    'check_type',
+    'check_command',
+    'check_tcp_send',
+    'check_tcp_expect',
+    'http_path',
+    'http_status_code',
+    'disable_persistent_socket',
+)
+
+
+def get_check_info(service_name, service_info):
+    """ Return the service information used by the check of a service
+
+        It's service_info with defaults from CHECKS_INFO.
+    """
+    check_info = dict(CHECKS_INFO.get(service_name, {}))
+
+    if (service_info.get('port') is not None
+            and service_info.get('protocol') == socket.IPPROTO_TCP):
+        check_info.setdefault('check_type', 'tcp')
+
+    check_info.update(service_info)
+    return check_info
+
+
+def get_probe_fingerprint(check_info):
+    """ Return a value which change only if what the check probes change
+    """
+    return (
+        tuple(check_info.get(field) for field in PROBE_FIELDS)
+        + (tuple(sorted(check_info.get('extra_ports', {}).items())),)
+    )
+
 
 def update_checks(core):
     global CHECKS
@@ -134,16 +751,23 @@ def update_checks(core):
     for key, service_info in core.services.items():
         (service_name, instance) = key
         checks_seen.add(key)
-        if key in CHECKS and CHECKS[key].service_info == service_info:
-            # check unchanged
-            continue
-        elif key in CHECKS:
-            CHECKS[key].stop()
-            del CHECKS[key]
 
         if not service_info.get('active', True):
             # If the service is inactive, no check should be performed
+            if key in CHECKS:
+                CHECKS[key].stop()
+                del CHECKS[key]
+            continue
+
+        check_info = get_check_info(service_name, service_info)
+        fingerprint = get_probe_fingerprint(check_info)
+        if key in CHECKS and CHECKS[key].fingerprint == fingerprint:
+            # check unchanged, only update service metadata
+            CHECKS[key].service_info = check_info
             continue
+        elif key in CHECKS:
+            CHECKS[key].stop()
+            del CHECKS[key]
 
         try:
             new_check = Check(
@@ -170,39 +794,25 @@ def update_checks(core):
         del CHECKS[key]
 
 
-def periodic_check():
-    """ Run few periodic check:
-
-        * that all TCP socket are still openned
-    """
-    for check in CHECKS.values():
-        check.check_sockets()
-
-
 class Check:
     def __init__(self, core, service_name, instance, service_info):
         self.address = service_info.get('address')
         self.port = service_info.get('port')
         self.protocol = service_info.get('protocol')
 
-        self.service_info = CHECKS_INFO.get(service_name, {})
-
-        if self.port is not None and self.protocol == socket.IPPROTO_TCP:
-            self.service_info.setdefault('check_type', 'tcp')
-
-        self.service_info.update(service_info)
-
-        if (service_info.get('password') is None
-                and service_name in ('mysql', 'postgresql')):
-            # For those check, if password is not set the dedicated check
-            # will fail.
-            self.service_info['check_type'] = 'tcp'
+        self.service_info = get_check_info(service_name, service_info)
+        self.fingerprint = get_probe_fingerprint(self.service_info)
 
         self.service = service_name
         self.instance = instance
         self.core = core
 
         self.extra_ports = self.service_info.get('extra_ports', {})
+        self.response_times = collections.deque(
+            maxlen=self.core.config.get(
+                'check.response_time_window', RESPONSE_TIME_WINDOW,
+            ),
+        )
 
         if not self.service_info.get('check_type') and not self.extra_ports:
             raise NotImplementedError("No check for this service")
@@ -214,14 +824,35 @@ class Check:
         )
 
         self.tcp_sockets = self._initialize_tcp_sockets()
-
+        self.interval = CHECK_INTERVAL
+        self.return_codes = collections.deque(maxlen=CHECK_FLAPPING_RUNS)
+        self.runner = get_runner(core)
+        self.supervisor = get_supervisor(core)
+
+        # current_job is replaced from the check runner, the socket
+        # supervisor and the scheduler threads. With APScheduler 2.x each
+        # trigger or reschedule creates a new job, so read-modify-write of
+        # current_job and open_sockets_job are done under this lock.
+        self._job_lock = threading.Lock()
+        self._stopped = False
         self.current_job = self.core.add_scheduled_job(
             self.run_check,
-            seconds=60,
+            seconds=CHECK_INTERVAL,
             next_run_in=0,
+            name=self.job_name,
+            spread=True,
+            record_stats=False,
         )
         self.open_sockets_job = None
 
+    @property
+    def job_name(self):
+        """ Name of the scheduled job running this check
+        """
+        if self.instance is None:
+            return 'check_%s' % self.service
+        return 'check_%s:%s' % (self.service, self.instance)
+
     def _initialize_tcp_sockets(self):
         tcp_sockets = {}
 
@@ -258,6 +889,7 @@ class Check:
             try:
                 tcp_socket.connect((address, port))
                 self.tcp_sockets[(address, port)] = tcp_socket
+                self.supervisor.register(tcp_socket, self, (address, port))
             except socket.error:
                 tcp_socket.close()
                 logging.debug(
@@ -269,42 +901,42 @@ class Check:
         if run_check:
             # open_socket failed, run check now
             # reschedule job to be run immediately
-            self.current_job = self.core.trigger_job(self.current_job)
+            self._trigger_job()
 
-    def check_sockets(self):
-        """ Check if some socket are closed
+    def socket_closed(self, sock, key):
+        """ Called by the SocketSupervisor when a persistent socket is closed
+
+            The socket is already closed. Run the check now.
         """
-        try_reopen = False
+        if self.tcp_sockets.get(key) is not sock:
+            # socket was already replaced or the check stopped
+            return
 
-        sockets = {}
-        for key, sock in self.tcp_sockets.items():
-            if sock is not None:
-                sockets[sock] = key
+        (address, port) = key
+        logging.debug(
+            'check %s (on %s): connection to %s:%s closed',
+            self.service, self.instance, address, port
+        )
+        self.tcp_sockets[key] = None
+        self._trigger_job()
 
-        if len(sockets) > 0:
-            (rlist, _, _) = select.select(sockets.keys(), [], [], 0)
-        else:
-            rlist = []
-        for s in rlist:
-            try:
-                buffer = s.recv(65536)
-            except socket.error:
-                buffer = b''
+    def _trigger_job(self):
+        """ Run the check as soon as possible
+        """
+        with self._job_lock:
+            if not self._stopped:
+                self.current_job = self.core.trigger_job(self.current_job)
 
-            if buffer == b'':
-                (address, port) = sockets[s]
-                logging.debug(
-                    'check %s (on %s): connection to %s:%s closed',
-                    self.service, self.instance, address, port
-                )
-                s.close()
-                self.tcp_sockets[(address, port)] = None
-                try_reopen = True
+    def run_check(self):
+        """ Submit the check to the check runner
 
-        if try_reopen:
-            self.open_sockets()
+            This is the scheduled job, the check itself runs on the runner
+            event loop.
+        """
+        self.runner.submit(self)
 
-    def run_check(self):
+    @coroutine
+    def run_check_async(self):
         now = time.time()
 
         key = (self.service, self.instance)
@@ -312,38 +944,59 @@ class Check:
                 or not self.core.services[key].get('active', True)):
             return
 
+        check_type = self.service_info.get('check_type')
         if self.address is None and self.instance is not None:
             # Address is None if this check is associated with a stopped
             # container. In such case none of our test could pass
-            (return_code, output) = (
+            result = (
                 STATUS_CRITICAL, 'Container stopped: connection refused'
             )
-        elif self.service_info.get('check_type') == 'nagios':
-            (return_code, output) = self.check_nagios()
-        elif self.service_info.get('check_type') == 'tcp':
-            (return_code, output) = self.check_tcp()
-        elif self.service_info.get('check_type') == 'http':
-            (return_code, output) = self.check_http()
-        elif self.service_info.get('check_type') == 'https':
-            (return_code, output) = self.check_http(tls=True)
-        elif self.service_info.get('check_type') == 'imap':
-            (return_code, output) = self.check_imap()
-        elif self.service_info.get('check_type') == 'smtp':
-            (return_code, output) = self.check_smtp()
-        elif self.service_info.get('check_type') == 'ntp':
-            (return_code, output) = self.check_ntp()
+        elif check_type == 'nagios':
+            result = yield from self.check_nagios()
+        elif check_type == 'tcp':
+            result = yield from self.check_tcp()
+        elif check_type == 'http':
+            result = yield from self.runner.run_in_executor(
+                self.check_http,
+            )
+        elif check_type == 'https':
+            result = yield from self.runner.run_in_executor(
+                functools.partial(self.check_http, tls=True),
+            )
+        elif check_type == 'imap':
+            result = yield from self.runner.run_in_executor(
+                self.check_imap,
+            )
+        elif check_type == 'smtp':
+            result = yield from self.runner.run_in_executor(
+                self.check_smtp,
+            )
+        elif check_type == 'ntp':
+            result = yield from self.check_ntp()
+        elif check_type == 'postgresql':
+            result = yield from self.runner.run_in_executor(
+                self.check_postgresql,
+            )
+        elif check_type in PROTOCOL_PROBES:
+            result = yield from self.check_protocol(
+                *PROTOCOL_PROBES[check_type]
+            )
+        else:
+            result = (STATUS_CHECK_NOT_RUN, '')
+
+        # Probes return (return_code, output), and also the response time
+        # of the service when the probe succeeded.
+        (return_code, output) = result[:2]
+        if len(result) > 2:
+            response_time = result[2]
         else:
-            (return_code, output) = (STATUS_CHECK_NOT_RUN, '')
+            response_time = None
 
         if (return_code != STATUS_CRITICAL
                 and return_code != STATUS_UNKNOWN
                 and self.extra_ports):
-            for (address, port) in self.tcp_sockets:
-                if port == self.port:
-                    # self.port is already checked with above check
-                    continue
-                (extra_port_rc, extra_port_output) = self.check_tcp(
-                    address, port)
+            extra_results = yield from self.check_extra_ports()
+            for (extra_port_rc, extra_port_output) in extra_results:
                 if extra_port_rc == STATUS_CRITICAL:
                     (return_code, output) = (extra_port_rc, extra_port_output)
                     break
@@ -351,6 +1004,60 @@ class Check:
                     return_code = extra_port_rc
                     output = extra_port_output
 
+        self.process_result(now, return_code, output, response_time)
+
+    @coroutine
+    def check_extra_ports(self):
+        """ Probe all extra TCP ports concurrently
+
+            Return the list of (return_code, output), in the order of
+            self.tcp_sockets. Ports that didn't answer before
+            EXTRA_PORTS_DEADLINE are critical.
+        """
+        addresses = [
+            (address, port)
+            for (address, port) in self.tcp_sockets
+            # self.port is already checked by the main check
+            if port != self.port
+        ]
+        if not addresses:
+            return []
+
+        tasks = [
+            ensure_future(self.check_tcp(address, port))
+            for (address, port) in addresses
+        ]
+        (_, pending) = yield from asyncio.wait(
+            tasks, timeout=EXTRA_PORTS_DEADLINE,
+        )
+        for task in pending:
+            task.cancel()
+
+        results = []
+        for ((address, port), task) in zip(addresses, tasks):
+            if task in pending:
+                results.append((
+                    STATUS_CRITICAL,
+                    'TCP port %d, connection timed out after %s seconds'
+                    % (port, EXTRA_PORTS_DEADLINE)
+                ))
+            elif task.exception() is not None:
+                results.append((
+                    STATUS_CRITICAL,
+                    'TCP port %d, %s' % (port, task.exception()),
+                ))
+            else:
+                results.append(task.result()[:2])
+        return results
+
+    def process_result(self, now, return_code, output, response_time=None):
+        """ Emit the status metric for a check result
+
+            If response_time is given, also emit the response time metric
+            of the main check and, if configured, its percentiles. It's only
+            given when the main probe succeeded: a refused connection or a
+            timeout has no meaningful response time.
+        """
         if return_code == STATUS_CHECK_NOT_RUN:
             logging.debug(
                 'check %s (on %s): no check available. Not metric sent',
@@ -376,34 +1083,99 @@ class Check:
             metric['instance'] = self.instance
         self.core.emit_metric(metric)
 
+        if response_time is not None:
+            self._emit_response_time(now, response_time)
+
         if return_code != STATUS_OK:
             # close all TCP sockets
             for key, sock in self.tcp_sockets.items():
                 if sock is not None:
-                    sock.close()
                     self.tcp_sockets[key] = None
+                    self.supervisor.close(sock)
 
         if return_code == STATUS_OK and self.tcp_sockets:
             # Make sure all socket are openned
-            self.open_sockets_job = self.core.add_scheduled_job(
-                self.open_sockets,
-                seconds=0,
-                next_run_in=5,
-            )
+            with self._job_lock:
+                if not self._stopped:
+                    self.open_sockets_job = self.core.add_scheduled_job(
+                        self.open_sockets,
+                        seconds=0,
+                        next_run_in=5,
+                    )
+
+        self.return_codes.append(return_code)
+        if self.core.config.get('check.adaptive_interval', False):
+            self._update_interval()
+
+    def _update_interval(self):
+        interval = get_check_interval(
+            self.interval,
+            self.return_codes,
+            self.address is None and self.instance is not None,
+            self.core.config.get('check.min_interval', CHECK_MIN_INTERVAL),
+            self.core.config.get('check.max_interval', CHECK_MAX_INTERVAL),
+        )
+        if interval == self.interval:
+            return
+
+        logging.debug(
+            'check %s (on %s): interval changed from %s to %s seconds',
+            self.service, self.instance, self.interval, interval,
+        )
+        self.interval = interval
+        with self._job_lock:
+            if not self._stopped:
+                self.current_job = self.core.reschedule_job(
+                    self.current_job, interval,
+                )
+
+    def _emit_response_time(self, now, response_time):
+        self.response_times.append(response_time)
+
+        values = [('%s_response_time' % self.service, response_time)]
+        percentiles = self.core.config.get(
+            'check.response_time_percentiles', [],
+        )
+        if percentiles:
+            window = sorted(self.response_times)
+            for percent in percentiles:
+                index = int(round((len(window) - 1) * percent / 100.0))
+                values.append((
+                    '%s_response_time_p%s' % (self.service, percent),
+                    window[index],
+                ))
+
+        for (name, value) in values:
+            metric = {
+                'measurement': name,
+                'service': self.service,
+                'time': now,
+                'value': value,
+            }
+            if self.instance is not None:
+                metric['item'] = self.instance
+                metric['instance'] = self.instance
+            self.core.emit_metric(metric)
 
     def stop(self):
         """ Unschedule this check
         """
         logging.debug('Stoping check %s (on %s)', self.service, self.instance)
-        self.core.unschedule_job(self.open_sockets_job)
-        self.core.unschedule_job(self.current_job)
-        for tcp_socket in self.tcp_sockets.values():
+        with self._job_lock:
+            self._stopped = True
+            self.core.unschedule_job(self.open_sockets_job)
+            self.core.unschedule_job(self.current_job)
+        self.core.discard_job_stats('command_%s' % self.job_name)
+        for key, tcp_socket in self.tcp_sockets.items():
             if tcp_socket is not None:
-                tcp_socket.close()
+                self.tcp_sockets[key] = None
+                self.supervisor.close(tcp_socket)
 
+    @coroutine
     def check_nagios(self):
-        (return_code, output) = bleemeo_agent.util.run_command_timeout(
+        (return_code, output) = yield from self.runner.run_command(
             shlex.split(self.service_info['check_command']),
+            name='command_%s' % self.job_name,
         )
 
         output = output.decode('utf-8', 'ignore').strip()
@@ -412,12 +1184,15 @@ class Check:
 
         return (return_code, output)
 
-    def check_tcp_recv(self, sock, start):
+    @coroutine
+    def check_tcp_recv(self, reader, start):
         received = ''
         while not self.service_info['check_tcp_expect'] in received:
             try:
-                tmp = sock.recv(4096)
-            except socket.timeout:
+                tmp = yield from asyncio.wait_for(
+                    reader.read(4096), timeout=10,
+                )
+            except asyncio.TimeoutError:
                 return (
                     STATUS_CRITICAL,
                     'Connection timed out after 10 seconds'
@@ -440,10 +1215,14 @@ class Check:
                     'Unexpected response: %s' % received
                 )
 
-        sock.close()
         end = bleemeo_agent.util.get_clock()
-        return (STATUS_OK, 'TCP OK - %.3f second response time' % (end-start))
+        return (
+            STATUS_OK,
+            'TCP OK - %.3f second response time' % (end-start),
+            end - start,
+        )
 
+    @coroutine
     def check_tcp(self, address=None, port=None):
         if address is not None or port is not None:
             use_default = False
@@ -456,11 +1235,11 @@ class Check:
             return (STATUS_CHECK_NOT_RUN, '')
 
         start = bleemeo_agent.util.get_clock()
-        sock = socket.socket()
-        sock.settimeout(10)
         try:
-            sock.connect((address, port))
-        except socket.timeout:
+            (reader, writer) = yield from asyncio.wait_for(
+                asyncio.open_connection(address, port), timeout=10,
+            )
+        except asyncio.TimeoutError:
             return (
                 STATUS_CRITICAL,
                 'TCP port %d, connection timed out after 10 seconds' % port
@@ -468,28 +1247,86 @@ class Check:
         except socket.error:
             return (STATUS_CRITICAL, 'TCP port %d, Connection refused' % port)
 
-        if (self.service_info.get('check_tcp_send')
-                and use_default):
-            try:
-                sock.send(self.service_info['check_tcp_send'].encode('utf8'))
-            except socket.timeout:
-                return (
-                    STATUS_CRITICAL,
-                    'TCP port %d, connection timed out after 10 seconds' % port
-                )
-            except socket.error:
-                return (
-                    STATUS_CRITICAL,
-                    'TCP port %d, connection closed too early' % port
-                )
-
-        if (self.service_info.get('check_tcp_expect')
-                and use_default):
-            return self.check_tcp_recv(sock, start)
+        try:
+            if (self.service_info.get('check_tcp_send')
+                    and use_default):
+                try:
+                    writer.write(
+                        self.service_info['check_tcp_send'].encode('utf8')
+                    )
+                    yield from asyncio.wait_for(writer.drain(), timeout=10)
+                except asyncio.TimeoutError:
+                    return (
+                        STATUS_CRITICAL,
+                        'TCP port %d, connection timed out after 10 seconds'
+                        % port
+                    )
+                except socket.error:
+                    return (
+                        STATUS_CRITICAL,
+                        'TCP port %d, connection closed too early' % port
+                    )
+
+            if (self.service_info.get('check_tcp_expect')
+                    and use_default):
+                result = yield from self.check_tcp_recv(reader, start)
+                return result
+        finally:
+            writer.close()
 
-        sock.close()
         end = bleemeo_agent.util.get_clock()
-        return (STATUS_OK, 'TCP OK - %.3f second response time' % (end-start))
+        return (
+            STATUS_OK,
+            'TCP OK - %.3f second response time' % (end-start),
+            end - start,
+        )
+
+    @coroutine
+    def check_protocol(self, name, request, read_response):
+        """ Check a service with a protocol handshake
+
+            request (if not None) is sent after connection, then
+            read_response(reader) is called to validate the response.
+        """
+        if self.port is None or self.address is None:
+            return (STATUS_CHECK_NOT_RUN, '')
+
+        start = bleemeo_agent.util.get_clock()
+        try:
+            (reader, writer) = yield from asyncio.wait_for(
+                asyncio.open_connection(self.address, self.port), timeout=10,
+            )
+        except asyncio.TimeoutError:
+            return (
+                STATUS_CRITICAL,
+                'TCP port %d, connection timed out after 10 seconds'
+                % self.port
+            )
+        except socket.error:
+            return (
+                STATUS_CRITICAL, 'TCP port %d, Connection refused' % self.port
+            )
+
+        try:
+            if request is not None:
+                writer.write(request)
+            (return_code, output) = yield from asyncio.wait_for(
+                read_response(reader), timeout=10,
+            )
+        except asyncio.TimeoutError:
+            return (STATUS_CRITICAL, 'Connection timed out after 10 seconds')
+        except (asyncio.IncompleteReadError, socket.error):
+            return (STATUS_CRITICAL, 'Connection closed')
+        except (ValueError, IndexError, struct.error):
+            return (STATUS_CRITICAL, 'Unexpected %s response' % name)
+        finally:
+            writer.close()
+
+        if output is None:
+            end = bleemeo_agent.util.get_clock()
+            output = '%s OK - %.3f second response time' % (name, end - start)
+            return (return_code, output, end - start)
+        return (return_code, output)
 
     def check_http(self, tls=False):
         if self.port is None or self.address is None:
@@ -504,7 +1341,7 @@ class Check:
             self.service_info.get('http_path', '/')
         )
         try:
-            response = requests.get(
+            response = bleemeo_agent.util.get_http_session(url).get(
                 url,
                 timeout=10,
                 allow_redirects=False,
@@ -542,7 +1379,9 @@ class Check:
                 STATUS_OK,
                 'HTTP OK - status_code=%s' % (
                     response.status_code,
-                )
+                ),
+                # time between sending the request and receiving headers
+                response.elapsed.total_seconds(),
             )
 
     def check_imap(self):
@@ -567,7 +1406,81 @@ class Check:
             )
 
         end = bleemeo_agent.util.get_clock()
-        return (STATUS_OK, 'IMAP OK - %.3f second response time' % (end-start))
+        return (
+            STATUS_OK,
+            'IMAP OK - %.3f second response time' % (end-start),
+            end - start,
+        )
+
+    def check_postgresql(self):
+        """ Check PostgreSQL with a SSLRequest
+
+            When the server accepts SSL ("S"), it logs "could not accept
+            SSL connection" if the connection is closed during the TLS
+            handshake, so the handshake is completed. Like a bare TCP
+            connection, closing before the startup packet isn't logged.
+        """
+        if self.port is None or self.address is None:
+            return (STATUS_CHECK_NOT_RUN, '')
+
+        start = bleemeo_agent.util.get_clock()
+
+        try:
+            sock = socket.create_connection(
+                (self.address, self.port), timeout=10,
+            )
+        except socket.timeout:
+            return (
+                STATUS_CRITICAL,
+                'TCP port %d, connection timed out after 10 seconds'
+                % self.port
+            )
+        except socket.error:
+            return (
+                STATUS_CRITICAL, 'TCP port %d, Connection refused' % self.port
+            )
+
+        try:
+            sock.sendall(POSTGRESQL_SSL_REQUEST)
+            response = sock.recv(1)
+            if response == b'S':
+                # Only the handshake matters, the certificate isn't verified
+                context = ssl.SSLContext(
+                    getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23)
+                )
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                sock = context.wrap_socket(sock)
+                # close_notify makes the server see a clean EOF, which it
+                # doesn't log. The handshake already succeeded, so errors
+                # after that are ignored.
+                try:
+                    sock.unwrap()
+                except (ssl.SSLError, socket.error):
+                    pass
+            elif response == b'':
+                return (STATUS_CRITICAL, 'Connection closed')
+            elif response != b'N':
+                return (
+                    STATUS_CRITICAL,
+                    'Unexpected response: %s'
+                    % response.decode('utf-8', 'ignore'),
+                )
+        except socket.timeout:
+            return (STATUS_CRITICAL, 'Connection timed out after 10 seconds')
+        except ssl.SSLError as exc:
+            return (STATUS_CRITICAL, 'TLS handshake failed: %s' % exc)
+        except socket.error:
+            return (STATUS_CRITICAL, 'Connection closed')
+        finally:
+            sock.close()
+
+        end = bleemeo_agent.util.get_clock()
+        return (
+            STATUS_OK,
+            'PostgreSQL OK - %.3f second response time' % (end-start),
+            end - start,
+        )
 
     def check_smtp(self):
         if self.port is None or self.address is None:
@@ -591,8 +1504,13 @@ class Check:
             )
 
         end = bleemeo_agent.util.get_clock()
-        return (STATUS_OK, 'SMTP OK - %.3f second response time' % (end-start))
+        return (
+            STATUS_OK,
+            'SMTP OK - %.3f second response time' % (end-start),
+            end - start,
+        )
 
+    @coroutine
     def check_ntp(self):
         if self.port is None or self.address is None:
             return (STATUS_CHECK_NOT_RUN, '')
@@ -603,17 +1521,23 @@ class Check:
 
         start = bleemeo_agent.util.get_clock()
 
-        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        client.settimeout(10)
-
-        msg = b'\x1b' + 47 * b'\0'
+        # A random transmit timestamp is used to match the response
+        nonce = os.urandom(8)
+        msg = b'\x1b' + 39 * b'\0' + nonce
         try:
-            client.sendto(msg, (self.address, self.port))
-            msg, address = client.recvfrom(1024)
-        except socket.timeout:
+            msg = yield from self.runner.udp_request(
+                msg, self.address, self.port, nonce, ntp_response_key,
+                timeout=10,
+            )
+        except asyncio.TimeoutError:
             return (STATUS_CRITICAL, 'Connection timed out after 10 seconds')
+        except socket.error:
+            return (STATUS_CRITICAL, 'Connection refused')
 
-        unpacked = struct.unpack("!BBBB11I", msg)
+        if len(msg) < 48:
+            return (STATUS_CRITICAL, 'Unexpected NTP response')
+
+        unpacked = struct.unpack("!BBBB11I", msg[:48])
         stratum = unpacked[1]
         server_time = unpacked[11] - NTP_DELTA
 
@@ -625,7 +1549,9 @@ class Check:
             return (STATUS_CRITICAL, 'Local time and NTP time does not match')
         else:
             return (
-                STATUS_OK, 'NTP OK - %.3f second response time' % (end-start)
+                STATUS_OK,
+                'NTP OK - %.3f second response time' % (end-start),
+                end - start,
             )
 
 
@@ -17,8 +17,12 @@
 #
 
 import argparse
+import bisect
+import concurrent.futures
 import copy
 import datetime
+import errno
+import functools
 import io
 import itertools
 import json
@@ -26,13 +30,13 @@ import logging
 import logging.config
 import os
 import re
-import shlex
 import signal
 import socket
 import subprocess
 import sys
 import threading
 import time
+import zlib
 
 try:
     import apscheduler.scheduler
@@ -42,9 +46,11 @@ except ImportError:
     from apscheduler.jobstores.base import JobLookupError
     APSCHEDULE_IS_3X = True
 
+import apscheduler.events
 import psutil
 import six
 from six.moves import configparser
+from six.moves import queue
 import yaml
 
 import bleemeo_agent
@@ -54,6 +60,9 @@ import bleemeo_agent.facts
 import bleemeo_agent.graphite
 import bleemeo_agent.util
 
+if sys.platform.startswith('linux'):
+    import bleemeo_agent.procfs
+
 
 # Optional dependencies
 try:
@@ -267,8 +276,77 @@ KNOWN_PROCESS = {
     }
 }
 
+# Index of KNOWN_PROCESS by executable name (for non-interpreted process)
+KNOWN_PROCESS_BY_NAME = {
+    key: service_info
+    for (key, service_info) in KNOWN_PROCESS.items()
+    if 'interpreter' not in service_info
+}
+
+# For interpreted process (java, python, erlang...), the service is found
+# by searching the command line for one of the keys.
+KNOWN_PROCESS_INTERPRETED = {
+    key: service_info
+    for (key, service_info) in KNOWN_PROCESS.items()
+    if 'interpreter' in service_info
+}
+KNOWN_PROCESS_INTERPRETED_RE = re.compile(
+    '|'.join(
+        re.escape(key)
+        for key in sorted(KNOWN_PROCESS_INTERPRETED, key=len, reverse=True)
+    )
+)
+
 DOCKER_API_VERSION = '1.21'
 
+# Docker API calls done during discovery (inspect, top) run in parallel
+# with at most DOCKER_API_CONCURRENCY calls at once. A call which didn't
+# complete in DOCKER_API_TIMEOUT seconds is considered as failed.
+DOCKER_API_CONCURRENCY = 8
+DOCKER_API_TIMEOUT = 10
+
+# Docker events are queued (at most DOCKER_EVENTS_QUEUE_SIZE) and processed
+# by batch of all events received within DOCKER_EVENTS_COALESCE_DELAY
+# seconds.
+DOCKER_EVENTS_QUEUE_SIZE = 1000
+DOCKER_EVENTS_COALESCE_DELAY = 1
+
+# Maximum age (in seconds) of the process snapshot reused by send_top_info
+# and by discovery. See Core.get_top_info.
+TOP_INFO_MAX_AGE = 5
+DISCOVERY_TOP_INFO_MAX_AGE = 1
+
+# With adaptive top info (agent.top_info.adaptive), top info is sent every
+# TOP_INFO_SLOW_INTERVAL seconds, unless someone is looking at it. In that
+# case it's sent every 10 seconds for TOP_INFO_FAST_DURATION seconds.
+TOP_INFO_SLOW_INTERVAL = 60
+TOP_INFO_FAST_DURATION = 300
+
+# Even with incremental discovery enabled, do a full discovery at least
+# every FULL_DISCOVERY_INTERVAL seconds.
+FULL_DISCOVERY_INTERVAL = 60 * 60
+
+# When a trigger is received, wait TRIGGER_DEBOUNCE_DELAY seconds without
+# new trigger before running the triggered jobs. Wait at most
+# TRIGGER_DEBOUNCE_MAX seconds since the first trigger.
+TRIGGER_DEBOUNCE_DELAY = 1
+TRIGGER_DEBOUNCE_MAX = 5
+
+# Map a trigger name to the attribute of Core containing the triggered job
+TRIGGER_JOBS = {
+    'discovery': '_discovery_job',
+    'facts': '_update_facts_job',
+    'updates_count': '_gather_update_metrics_job',
+    'top_info': '_send_top_info_job',
+}
+
+# Upper bound (in seconds) of each bucket of the job duration histogram.
+# A last bucket is implicitly added for durations above the last value.
+JOB_DURATION_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+# Percentiles of job duration sent as agent_job_duration_pNN metrics
+JOB_DURATION_PERCENTILES = (50, 90, 99)
+
 LOGGER_CONFIG = """
 version: 1
 disable_existing_loggers: false
@@ -342,8 +420,20 @@ def main():
 
 def get_service_info(cmdline):
     """ Return service_info from KNOWN_PROCESS matching this command line
+
+        cmdline is either the list of process arguments (as returned
+        by psutil) or a string (as returned by docker top). A string is
+        split on whitespace.
     """
-    name = os.path.basename(shlex.split(cmdline)[0])
+    if isinstance(cmdline, six.string_types):
+        argv = cmdline.split()
+    else:
+        argv = cmdline
+
+    if not argv or not argv[0]:
+        return None
+
+    name = os.path.basename(argv[0])
 
     if os.name == 'nt':
         name = name.lower()
@@ -364,14 +454,17 @@ def get_service_info(cmdline):
 
     if name in ('java', 'python', 'erl') or name.startswith('beam'):
         # For them, we search in the command line
-        for (key, service_info) in KNOWN_PROCESS.items():
-            # FIXME: we should check that intepreter match the one used.
-            if 'interpreter' not in service_info:
-                continue
-            if key in cmdline:
-                return service_info
+        if isinstance(cmdline, six.string_types):
+            joined_cmdline = cmdline
+        else:
+            joined_cmdline = ' '.join(argv)
+        # FIXME: we should check that intepreter match the one used.
+        match = KNOWN_PROCESS_INTERPRETED_RE.search(joined_cmdline)
+        if match is not None:
+            return KNOWN_PROCESS_INTERPRETED[match.group(0)]
+        return None
     else:
-        return KNOWN_PROCESS.get(name)
+        return KNOWN_PROCESS_BY_NAME.get(name)
 
 
 def apply_service_override(services, override_config):
@@ -488,6 +581,27 @@ def disable_https_warning():
     urllib3.disable_warnings(klass)
 
 
+def decode_docker_event(event):
+    """ Return (event_type, action, actor_id) of a docker event
+    """
+    if 'Action' in event:
+        action = event['Action']
+    else:
+        # status is depractated. Action was introduced with
+        # Docker 1.10
+        action = event.get('status')
+    event_type = event.get('Type', 'container')
+
+    if 'Actor' in event:
+        actor_id = event['Actor'].get('ID')
+    else:
+        # id is deprecated. Actor was introduced with
+        # Docker 1.10
+        actor_id = event.get('id')
+
+    return (event_type, action or '', actor_id)
+
+
 def decode_docker_top(docker_top):
     """ Return a list of (pid, cmdline) from result for docker_client.top()
 
@@ -521,6 +635,29 @@ def decode_docker_top(docker_top):
     return result
 
 
+def get_job_offset(name, interval):
+    """ Return a deterministic offset (in seconds) for the job name
+
+        The offset is in [0, interval) and is stable across restart. Jobs
+        with the same interval but different names are spread over the
+        interval.
+    """
+    interval_ms = int(interval * 1000)
+    if interval_ms <= 0:
+        return 0.0
+    checksum = zlib.crc32(name.encode('utf-8')) & 0xffffffff
+    return (checksum % interval_ms) / 1000.0
+
+
+def get_aligned_delay(now, interval, offset):
+    """ Return the delay until next time aligned on interval shifted by offset
+
+        The returned delay is in [0, interval) and now + delay is a time t
+        such as (t - offset) is a multiple of interval.
+    """
+    return (offset - now) % interval
+
+
 class State:
     """ Persistant store for state of the agent.
 
@@ -597,40 +734,257 @@ class State:
         return value
 
 
+def get_buckets_percentile(buckets, count, percent, overflow):
+    """ Return the upper bound of the bucket containing the percentile
+
+        buckets are the counts of a JOB_DURATION_BUCKETS histogram which
+        contains count values. overflow is returned if the percentile is
+        above the last bucket.
+    """
+    wanted = count * percent / 100.0
+    seen = 0
+    for (index, bucket_count) in enumerate(buckets):
+        seen += bucket_count
+        if seen >= wanted and bucket_count:
+            if index < len(JOB_DURATION_BUCKETS):
+                return JOB_DURATION_BUCKETS[index]
+            return overflow
+    return overflow
+
+
+class JobStatistics:
+    """ Execution statistics for one scheduled job.
+
+        It keep an histogram of run durations (see JOB_DURATION_BUCKETS),
+        the number of runs that took longer than the job interval (overrun)
+        and the number of runs skipped by the scheduler (missed run or
+        previous run still in progress).
+    """
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+        self.run_count = 0
+        self.overrun_count = 0
+        self.skipped_count = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.last_duration = None
+        self.buckets = [0] * (len(JOB_DURATION_BUCKETS) + 1)
+        self._lock = threading.Lock()
+
+        # Values since last call to pop_period
+        self._period_count = 0
+        self._period_duration = 0.0
+        self._period_max = 0.0
+        self._period_buckets = [0] * len(self.buckets)
+        self._period_overrun = 0
+        self._period_skipped = 0
+
+    def record_run(self, duration):
+        """ Record a run of the job which took duration seconds
+
+            Return True if the run overran the job interval.
+        """
+        bucket = bisect.bisect_left(JOB_DURATION_BUCKETS, duration)
+
+        with self._lock:
+            overrun = bool(self.interval) and duration > self.interval
+            self.run_count += 1
+            self.total_duration += duration
+            self.max_duration = max(self.max_duration, duration)
+            self.last_duration = duration
+            self.buckets[bucket] += 1
+            self._period_count += 1
+            self._period_duration += duration
+            self._period_max = max(self._period_max, duration)
+            self._period_buckets[bucket] += 1
+            if overrun:
+                self.overrun_count += 1
+                self._period_overrun += 1
+
+        return overrun
+
+    def set_interval(self, interval):
+        with self._lock:
+            self.interval = interval
+
+    def record_skip(self):
+        with self._lock:
+            self.skipped_count += 1
+            self._period_skipped += 1
+
+    @property
+    def mean_duration(self):
+        if self.run_count == 0:
+            return None
+        return self.total_duration / self.run_count
+
+    def percentile(self, percent):
+        """ Return an upper bound for the given percentile of durations
+
+            The result is the upper limit of the histogram bucket containing
+            the percentile. It's None if the job never ran and float('inf')
+            if the percentile is above the last bucket.
+        """
+        with self._lock:
+            if self.run_count == 0:
+                return None
+            return get_buckets_percentile(
+                self.buckets, self.run_count, percent, float('inf'),
+            )
+
+    def snapshot(self, percentiles=()):
+        """ Return a consistent copy of the statistics as a dict
+
+            It contains the name, interval, counters and durations
+            attributes, mean_duration and "percentiles", a mapping percent
+            => percentile (see percentile method).
+        """
+        with self._lock:
+            if self.run_count:
+                mean_duration = self.total_duration / self.run_count
+            else:
+                mean_duration = None
+            result = {
+                'name': self.name,
+                'interval': self.interval,
+                'run_count': self.run_count,
+                'overrun_count': self.overrun_count,
+                'skipped_count': self.skipped_count,
+                'last_duration': self.last_duration,
+                'mean_duration': mean_duration,
+                'max_duration': self.max_duration,
+                'percentiles': {},
+            }
+            for percent in percentiles:
+                if self.run_count:
+                    value = get_buckets_percentile(
+                        self.buckets, self.run_count, percent, float('inf'),
+                    )
+                else:
+                    value = None
+                result['percentiles'][percent] = value
+        return result
+
+    def pop_period(self, percentiles=()):
+        """ Return (run_count, mean_duration, overrun, skipped, durations)
+            since last call
+
+            mean_duration is None if no run happened during the period.
+            durations is a mapping percent => upper bound of the duration
+            percentile during the period, for each percent of percentiles.
+            It's empty if no run happened. Above the last bucket, the
+            maximum duration of the period is used.
+        """
+        with self._lock:
+            durations = {}
+            if self._period_count:
+                mean = self._period_duration / self._period_count
+                for percent in percentiles:
+                    durations[percent] = get_buckets_percentile(
+                        self._period_buckets,
+                        self._period_count,
+                        percent,
+                        self._period_max,
+                    )
+            else:
+                mean = None
+            result = (
+                self._period_count,
+                mean,
+                self._period_overrun,
+                self._period_skipped,
+                durations,
+            )
+            self._period_count = 0
+            self._period_duration = 0.0
+            self._period_max = 0.0
+            self._period_buckets = [0] * len(self.buckets)
+            self._period_overrun = 0
+            self._period_skipped = 0
+        return result
+
+
 class Core:
     def __init__(self, run_as_windows_service=False):
         self.run_as_windows_service = run_as_windows_service
 
         self.sentry_client = None
+        self.started_at = bleemeo_agent.util.get_clock()
         self.last_facts = {}
         self.last_facts_update = bleemeo_agent.util.get_clock()
         self.last_discovery_update = bleemeo_agent.util.get_clock()
         self.last_services_autoremove = bleemeo_agent.util.get_clock()
         self.top_info = None
+        # self.top_info without fields only used by the agent, built once per
+        # snapshot when first needed. See get_top_info.
+        self._top_info_stripped = None
+        self._top_info_clock = None
+        self._top_info_lock = threading.Lock()
+        self.process_reader = None
+        self._listen_socket_reader = None
+        self._send_top_info_job = None  # scheduled in schedule_tasks
+        self._top_info_sent_at = None
+        self._top_info_fast_until = None
 
         self.is_terminating = threading.Event()
+        # Created by bleemeo_agent.checker with the first check
+        self.check_runner = None
+        self.socket_supervisor = None
         self.bleemeo_connector = None
         self.influx_connector = None
         self.graphite_server = None
         self.docker_client = None
+        self._docker_events_client = None
         self.docker_containers = {}
         self.docker_networks = {}
+        # Result of docker inspect by container ID. Entries are removed by
+        # _process_docker_events when the container changes.
+        self._docker_inspect_cache = {}
+        # Incremented each time the cache is invalidated. A docker inspect
+        # started before an invalidation may be stale and isn't cached.
+        self._docker_inspect_generation = 0
+        self._docker_inspect_lock = threading.Lock()
+        self._docker_executor = None  # created on first use
+        self._docker_events = queue.Queue(DOCKER_EVENTS_QUEUE_SIZE)
+        self._docker_events_overflow = False
         if APSCHEDULE_IS_3X:
             self._scheduler = (
                 apscheduler.schedulers.background.BackgroundScheduler()
             )
         else:
             self._scheduler = apscheduler.scheduler.Scheduler()
+        # APScheduler 2.x has no way to modify a job, trigger_job and
+        # reschedule_job remove it and add a new one. They are called from
+        # multiple threads (scheduler, check runner, docker events...).
+        self._scheduler_lock = threading.RLock()
+        self.jobs_stats = {}
+        self._jobs_stats_lock = threading.Lock()
+        self._scheduler.add_listener(
+            self._job_skipped_listener,
+            apscheduler.events.EVENT_JOB_MISSED
+            | getattr(apscheduler.events, 'EVENT_JOB_MAX_INSTANCES', 0),
+        )
         self.last_metrics = {}
         self.last_report = None
 
         self._discovery_job = None  # scheduled in schedule_tasks
+        self._discovery_lock = threading.Lock()
         self.discovered_services = {}
+        # Processes and containers seen during previous discovery. Used by
+        # incremental discovery.
+        self._discovery_processes = {}
+        self._discovery_containers = {}
+        self._last_full_discovery = None
         self._soft_status_since = {}
-        self._trigger_discovery = False
-        self._trigger_facts = False
-        self._trigger_updates_count = False
-        self._netstat_output_mtime = 0
+        self._update_facts_job = None  # scheduled in schedule_tasks
+        self._gather_update_metrics_job = None  # scheduled in schedule_tasks
+        self._pending_triggers = set()
+        # Triggers whose job isn't scheduled yet. They are retried later.
+        self._deferred_triggers = set()
+        self._triggers_received = 0
+        self._sighup_received = False
+        self._triggers_condition = threading.Condition(threading.RLock())
 
         # This is needed on Windows to compute mem_*_perc and mem_total
         self.total_memory_size = psutil.virtual_memory().total
@@ -638,6 +992,7 @@ class Core:
         self.total_swap_size = psutil.swap_memory().total
 
         self.http_user_agent = None
+        self._first_metric_emitted = False
 
     def _init(self):
         self.started_at = bleemeo_agent.util.get_clock()
@@ -683,19 +1038,25 @@ class Core:
 
         self._apply_upgrade()
 
+        if sys.platform.startswith('linux'):
+            self._listen_socket_reader = (
+                bleemeo_agent.procfs.ListenSocketReader()
+            )
+
+        process_reader = self.config.get('agent.process_reader', 'psutil')
+        if process_reader == 'proc' and sys.platform.startswith('linux'):
+            self.process_reader = bleemeo_agent.procfs.ProcessReader()
+        elif process_reader not in ('psutil', 'proc'):
+            logging.warning(
+                'Unknown process reader "%s", using psutil', process_reader,
+            )
+
         # Agent does HTTPS requests with verify=False (only for checks, not
         # for communication with Bleemeo Cloud platform).
         # By default requests will emit one warning for EACH request which is
         # too noisy.
         disable_https_warning()
 
-        netstat_file = self.config.get('agent.netstat_file', 'netstat.out')
-        try:
-            mtime = os.stat(netstat_file).st_mtime
-        except OSError:
-            mtime = 0
-        self._netstat_output_mtime = mtime
-
         self.http_user_agent = (
             'Bleemeo Agent %s' % bleemeo_agent.facts.get_agent_version(self)
         )
@@ -766,7 +1127,9 @@ class Core:
             # https://github.com/getsentry/raven-python/pull/723
             install_thread_hook(self.sentry_client)
 
-    def add_scheduled_job(self, func, seconds, args=None, next_run_in=None):
+    def add_scheduled_job(
+            self, func, seconds, args=None, next_run_in=None, name=None,
+            spread=False, record_stats=True):
         """ Schedule a recuring job using APScheduler
 
             It's a wrapper to add_job/add_interval_job+add_date_job depending
@@ -782,10 +1145,41 @@ class Core:
             With APScheduler 3.x it means that next run is scheduled for now.
             With APScheduler 2.x, it means that next run is scheduled for
             now + 1 seconds.
+
+            name is used to aggregate execution statistics of the job (see
+            self.jobs_stats). It default to the function name.
+
+            If spread is True and next_run_in is None or 0, the first run is
+            delayed so runs are aligned on the interval with a deterministic
+            offset computed from the job name. This avoid that all jobs with
+            the same interval run at the same instant. The first run date is
+            computed when the job is added, which may be long before the
+            scheduler starts (e.g. during the first discovery). The misfire
+            grace time of such jobs is their interval, so a late run still
+            happens instead of being skipped.
+
+            If record_stats is False, execution time isn't recorded. This is
+            useful when func only submit the actual work elsewhere, which
+            record its execution with record_job_run.
         """
-        options = {}
+        if name is None:
+            name = func.__name__
+
+        if spread and seconds and not next_run_in:
+            next_run_in = get_aligned_delay(
+                time.time(), seconds, get_job_offset(name, seconds),
+            )
+
+        options = {
+            'name': name,
+        }
         if args is not None:
             options['args'] = args
+        if spread and seconds:
+            options['misfire_grace_time'] = max(1, int(seconds))
+
+        if record_stats:
+            func = self._wrap_job(func, name, seconds)
 
         if APSCHEDULE_IS_3X:
             if seconds is None or seconds == 0:
@@ -858,34 +1252,200 @@ class Core:
 
             >>> self.the_job = self.trigger_job(self.the_job)
         """
-        if APSCHEDULE_IS_3X:
-            job.modify(next_run_time=datetime.datetime.now())
-        else:
-            self._scheduler.unschedule_job(job)
-            job = self._scheduler.add_interval_job(
-                job.func,
-                args=job.args,
-                seconds=job.trigger.interval.total_seconds(),
-                start_date=(
-                    datetime.datetime.now() + datetime.timedelta(seconds=1)
+        with self._scheduler_lock:
+            if APSCHEDULE_IS_3X:
+                job.modify(next_run_time=datetime.datetime.now())
+            else:
+                self._scheduler.unschedule_job(job)
+                job = self._scheduler.add_interval_job(
+                    job.func,
+                    args=job.args,
+                    name=job.name,
+                    misfire_grace_time=job.misfire_grace_time,
+                    seconds=job.trigger.interval.total_seconds(),
+                    start_date=(
+                        datetime.datetime.now()
+                        + datetime.timedelta(seconds=1)
+                    )
                 )
-            )
         return job
 
+    def reschedule_job(self, job, seconds):
+        """ Change the interval of a recurring job
+
+            Next run is scheduled in seconds. Like trigger_job, caller must
+            use the returned job e.g.::
+
+            >>> self.the_job = self.reschedule_job(self.the_job, 30)
+
+            The interval of the job statistics is updated, so overruns are
+            computed against the new interval.
+        """
+        with self._scheduler_lock:
+            if APSCHEDULE_IS_3X:
+                job.reschedule(trigger='interval', seconds=seconds)
+            else:
+                self._scheduler.unschedule_job(job)
+                job = self._scheduler.add_interval_job(
+                    job.func,
+                    args=job.args,
+                    name=job.name,
+                    misfire_grace_time=job.misfire_grace_time,
+                    seconds=seconds,
+                    start_date=(
+                        datetime.datetime.now()
+                        + datetime.timedelta(seconds=seconds)
+                    )
+                )
+
+        with self._jobs_stats_lock:
+            stats = self.jobs_stats.get(job.name)
+        if stats is not None:
+            stats.set_interval(seconds)
+        return job
+
+    def _get_job_stats(self, name, interval):
+        """ Return the JobStatistics for job name, creating it if needed
+        """
+        with self._jobs_stats_lock:
+            stats = self.jobs_stats.get(name)
+            if stats is None:
+                stats = JobStatistics(name, interval)
+                self.jobs_stats[name] = stats
+        return stats
+
+    def get_jobs_stats(self):
+        """ Return the list of JobStatistics of all jobs
+        """
+        with self._jobs_stats_lock:
+            return list(self.jobs_stats.values())
+
+    def discard_job_stats(self, name):
+        """ Forget execution statistics of job name
+        """
+        with self._jobs_stats_lock:
+            self.jobs_stats.pop(name, None)
+
+    def record_job_run(self, name, interval, duration):
+        """ Record the execution time of one run of job name
+
+            Jobs scheduled with add_scheduled_job are recorded
+            automatically. This is for jobs that run outside the scheduler
+            (e.g. service checks run by the check runner).
+        """
+        stats = self._get_job_stats(name, interval)
+        if stats.record_run(duration):
+            logging.debug(
+                'Job %s took %.3f seconds, longer than its interval'
+                ' of %s seconds',
+                name,
+                duration,
+                stats.interval,
+            )
+
+    def record_job_skip(self, name, interval):
+        """ Record that a run of job name was skipped
+        """
+        self._get_job_stats(name, interval).record_skip()
+
+    def _wrap_job(self, func, name, interval):
+        """ Return a function which call func and record its execution time
+        """
+        self._get_job_stats(name, interval)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = bleemeo_agent.util.get_clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = bleemeo_agent.util.get_clock() - start
+                self.record_job_run(name, interval, duration)
+
+        return wrapper
+
+    def _job_skipped_listener(self, event):
+        """ APScheduler listener called when a job run is skipped
+        """
+        job = getattr(event, 'job', None)
+        if job is None:
+            # APScheduler 3.x only give the job ID
+            job = self._scheduler.get_job(event.job_id)
+        if job is None:
+            return
+
+        with self._jobs_stats_lock:
+            stats = self.jobs_stats.get(job.name)
+        if stats is not None:
+            stats.record_skip()
+
+    def _emit_jobs_stats(self):
+        """ Send metrics about scheduled jobs executions
+        """
+        now = time.time()
+        percentiles = self.config.get(
+            'agent.job_duration_percentiles', JOB_DURATION_PERCENTILES,
+        )
+
+        for stats in self.get_jobs_stats():
+            (run_count, mean_duration, overrun, skipped, durations) = (
+                stats.pop_period(percentiles)
+            )
+            if run_count == 0 and skipped == 0:
+                continue
+            if mean_duration is not None:
+                self.emit_metric({
+                    'measurement': 'agent_job_duration',
+                    'item': stats.name,
+                    'time': now,
+                    'value': mean_duration,
+                })
+            for (percent, duration) in sorted(durations.items()):
+                self.emit_metric({
+                    'measurement': 'agent_job_duration_p%s' % percent,
+                    'item': stats.name,
+                    'time': now,
+                    'value': float(duration),
+                })
+            self.emit_metric({
+                'measurement': 'agent_job_overrun',
+                'item': stats.name,
+                'time': now,
+                'value': float(overrun),
+            })
+            self.emit_metric({
+                'measurement': 'agent_job_skipped',
+                'item': stats.name,
+                'time': now,
+                'value': float(skipped),
+            })
+
     def unschedule_job(self, job):
         """ Unschedule and remove a job
+
+            Execution statistics of the job are removed unless another job
+            with the same name is still scheduled.
         """
-        if APSCHEDULE_IS_3X:
-            if job:
+        if not job:
+            return
+
+        with self._scheduler_lock:
+            if APSCHEDULE_IS_3X:
                 try:
                     job.remove()
                 except JobLookupError:
                     pass
-        else:
-            try:
-                self._scheduler.unschedule_job(job)
-            except KeyError:
-                pass
+            else:
+                try:
+                    self._scheduler.unschedule_job(job)
+                except KeyError:
+                    pass
+            still_scheduled = any(
+                other.name == job.name for other in self._scheduler.get_jobs()
+            )
+
+        if not still_scheduled:
+            self.discard_job_stats(job.name)
 
     def update_thresholds(self, state_threshold):
         """ Update threshold definition
@@ -915,7 +1475,7 @@ class Core:
                             'system_pending_security_updates'):
             if (self.get_threshold(update_name, thresholds=old_thresholds) !=
                     self.get_threshold(update_name)):
-                self._trigger_updates_count = True
+                self.trigger('updates_count')
 
         return self.thresholds
 
@@ -928,6 +1488,8 @@ class Core:
                 bleemeo_agent.util.pull_raw_metric,
                 args=(self, name),
                 seconds=interval,
+                name='pull_%s' % name,
+                spread=True,
             )
 
     def run(self):
@@ -952,14 +1514,20 @@ class Core:
             self.schedule_tasks()
             try:
                 self._scheduler.start()
+                self._start_triggers_threads()
                 # This loop is break by KeyboardInterrupt (ctrl+c or SIGTERM).
                 # It wait with a timeout because under Windows the wait() is
                 # uninterruptible. Using a 500ms wait allow to process
                 # signal every 500ms.
                 while not self.is_terminating.is_set():
                     self.is_terminating.wait(0.5)
+                    if self._sighup_received:
+                        self._sighup_received = False
+                        self.trigger('discovery', 'updates_count', 'facts')
             finally:
                 self._scheduler.shutdown()
+                if self._docker_executor is not None:
+                    self._docker_executor.shutdown(wait=False)
         except KeyboardInterrupt:
             pass
         finally:
@@ -979,9 +1547,8 @@ class Core:
             self.is_terminating.set()
 
         def handler_hup(signum, frame):
-            self._trigger_discovery = True
-            self._trigger_updates_count = True
-            self._trigger_facts = True
+            # trigger() takes a lock, it's called by the main loop in run()
+            self._sighup_received = True
 
         if not self.run_as_windows_service:
             # Windows service don't use signal to shutdown
@@ -998,14 +1565,143 @@ class Core:
             )
             return
 
+        # Timeout is given to the client, so a hung call doesn't hold a
+        # thread of _docker_api_map forever.
         self.docker_client = docker.Client(
             version=DOCKER_API_VERSION,
+            timeout=self.config.get('docker.api_timeout', DOCKER_API_TIMEOUT),
+        )
+        # Events are a long-running stream which must not time out
+        self._docker_events_client = docker.Client(
+            version=DOCKER_API_VERSION,
+            timeout=None,
         )
         try:
             self.docker_client.ping()
         except:
             logging.debug('Docker ping failed. Assume Docker is not used')
             self.docker_client = None
+            self._docker_events_client = None
+
+    def get_docker_inspect(self, container_id, state=None):
+        """ Return the result of docker inspect for container_id
+
+            The result is cached until an event on the container is
+            received. state is the container state (e.g. "running") from
+            the containers listing, it's used to detect a missed event.
+
+            The returned dict is shared and must not be modified.
+        """
+        inspect = self._get_cached_docker_inspect(container_id, state)
+        if inspect is None:
+            generation = self._docker_inspect_generation
+            inspect = self.docker_client.inspect_container(container_id)
+            self._cache_docker_inspects({inspect['Id']: inspect}, generation)
+        return inspect
+
+    def _cache_docker_inspects(self, inspects, generation):
+        """ Store docker inspect results, unless they may be stale
+
+            generation is the value of _docker_inspect_generation before the
+            inspects were started.
+        """
+        with self._docker_inspect_lock:
+            if generation == self._docker_inspect_generation:
+                self._docker_inspect_cache.update(inspects)
+
+    def _invalidate_docker_inspect(self, container_id=None):
+        """ Forget docker inspect of container_id, or of all containers
+        """
+        with self._docker_inspect_lock:
+            self._docker_inspect_generation += 1
+            if container_id is None:
+                self._docker_inspect_cache.clear()
+            else:
+                self._docker_inspect_cache.pop(container_id, None)
+
+    def _get_cached_docker_inspect(self, container_id, state=None):
+        """ Return docker inspect for container_id if cached and valid
+        """
+        with self._docker_inspect_lock:
+            inspect = self._docker_inspect_cache.get(container_id)
+
+        if (inspect is not None and state is not None
+                and inspect['State'].get('Status', state) != state):
+            return None
+        return inspect
+
+    def _docker_api_map(self, func, args):
+        """ Call func(arg) for each arg using a bounded thread pool
+
+            Return a dict mapping arg to the result of func(arg). Calls which
+            raised an exception or didn't finish within docker.api_timeout
+            seconds are absent from the result. Concurrency is bounded by
+            docker.api_concurrency.
+        """
+        args = list(args)
+        if not args:
+            return {}
+
+        concurrency = self.config.get(
+            'docker.api_concurrency', DOCKER_API_CONCURRENCY,
+        )
+        timeout = self.config.get('docker.api_timeout', DOCKER_API_TIMEOUT)
+        if self._docker_executor is None:
+            self._docker_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=concurrency,
+            )
+
+        started_at = {}
+
+        def call(arg):
+            started_at[arg] = bleemeo_agent.util.get_clock()
+            return func(arg)
+
+        futures = {
+            self._docker_executor.submit(call, arg): arg for arg in args
+        }
+        # Calls are queued, so the whole batch may take more than timeout
+        deadline = (
+            bleemeo_agent.util.get_clock()
+            + timeout * (len(args) // concurrency + 1)
+        )
+        results = {}
+        pending = set(futures)
+        while pending:
+            (done, pending) = concurrent.futures.wait(
+                pending,
+                timeout=min(timeout, 1),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                arg = futures[future]
+                try:
+                    results[arg] = future.result()
+                except Exception as exc:
+                    # Most probably container was removed or is restarting
+                    logging.debug('Docker API call on %s failed: %s', arg, exc)
+
+            clock_now = bleemeo_agent.util.get_clock()
+            for future in list(pending):
+                arg = futures[future]
+                if (clock_now >= deadline
+                        or clock_now - started_at.get(arg, clock_now)
+                        > timeout):
+                    logging.debug('Docker API call on %s timed out', arg)
+                    # This only cancel queued calls. A running call will
+                    # end with the docker client timeout.
+                    future.cancel()
+                    pending.discard(future)
+
+        return results
+
+    def _get_docker_inspect_by_name(self, container_name):
+        """ Return docker inspect for a container found by discovery
+        """
+        inspect = self.docker_containers.get(container_name)
+        if inspect is None:
+            inspect = self.docker_client.inspect_container(container_name)
+        return inspect
 
     def _update_docker_info(self):
         self.docker_containers = {}
@@ -1015,8 +1711,33 @@ class Core:
         if self.docker_client is None:
             return
 
-        for container in self.docker_client.containers(all=True):
-            inspect = self.docker_client.inspect_container(container['Id'])
+        containers = self.docker_client.containers(all=True)
+        with self._docker_inspect_lock:
+            # Forget containers which no longer exist
+            containers_id = set(container['Id'] for container in containers)
+            for container_id in list(self._docker_inspect_cache):
+                if container_id not in containers_id:
+                    del self._docker_inspect_cache[container_id]
+
+        generation = self._docker_inspect_generation
+        missing = [
+            container['Id']
+            for container in containers
+            if self._get_cached_docker_inspect(
+                container['Id'], container.get('State'),
+            ) is None
+        ]
+        inspects = self._docker_api_map(
+            self.docker_client.inspect_container, missing,
+        )
+        self._cache_docker_inspects(inspects, generation)
+
+        for container in containers:
+            inspect = inspects.get(container['Id'])
+            if inspect is None:
+                inspect = self._get_cached_docker_inspect(container['Id'])
+            if inspect is None:
+                continue  # inspect failed
             labels = inspect.get('Config', {}).get('Labels', {})
             if labels is None:
                 labels = {}
@@ -1047,10 +1768,6 @@ class Core:
             self.docker_networks[name] = network
 
     def schedule_tasks(self):
-        self.add_scheduled_job(
-            func=bleemeo_agent.checker.periodic_check,
-            seconds=3,
-        )
         self.add_scheduled_job(
             self.purge_metrics,
             seconds=5 * 60,
@@ -1066,29 +1783,55 @@ class Core:
         self.add_scheduled_job(
             self._gather_metrics,
             seconds=10,
+            spread=True,
         )
         self.add_scheduled_job(
             self._gather_metrics_minute,
             seconds=60,
+            spread=True,
         )
         self._gather_update_metrics_job = self.add_scheduled_job(
             self._gather_update_metrics,
             seconds=3600,
             next_run_in=15,
         )
-        self.add_scheduled_job(
+        self._send_top_info_job = self.add_scheduled_job(
             self.send_top_info,
             seconds=10,
-        )
-        self.add_scheduled_job(
-            self._check_triggers,
-            seconds=10,
+            spread=True,
         )
         self._schedule_metric_pull()
 
-        # Call jobs we want to run immediatly
+        cached_facts = self.state.get('facts')
+        if (self.config.get('agent.fast_start', False)
+                and cached_facts
+                and self.state.get('discovered_services') is not None):
+            # Start with facts and services from previous run, so metrics
+            # gathering and checks don't wait for facts and discovery.
+            logging.debug('Fast start using facts and services from state')
+            self.last_facts = cached_facts
+            # Like the first discovery, but on cached services. It must run
+            # before the scheduler starts Bleemeo._bleemeo_synchronize.
+            self._search_old_service(dict(self.discovered_services))
+            self._update_services()
+            self.add_scheduled_job(
+                self._fast_start_refresh,
+                seconds=None,
+                next_run_in=0,
+            )
+        else:
+            # Call jobs we want to run immediatly
+            self.update_facts()
+            self.update_discovery(first_run=True)
+
+    def _fast_start_refresh(self):
+        """ Update facts and discovery after a fast start
+
+            Old services were already renamed by schedule_tasks, this runs
+            while Bleemeo._bleemeo_synchronize could run.
+        """
         self.update_facts()
-        self.update_discovery(first_run=True)
+        self.update_discovery()
 
     def start_threads(self):
 
@@ -1135,6 +1878,10 @@ class Core:
         thread.daemon = True
         thread.start()
 
+        thread = threading.Thread(target=self._process_docker_events_loop)
+        thread.daemon = True
+        thread.start()
+
     def _gather_metrics(self):
         """ Gather and send some metric missing from other sources
         """
@@ -1176,13 +1923,15 @@ class Core:
     def _gather_metrics_minute(self):
         """ Gather and send every minute some metric missing from other sources
         """
+        self._emit_jobs_stats()
+
         for key in list(self.docker_containers.keys()):
             result = self.docker_containers.get(key)
             if (result is not None
                     and 'Health' in result['State']
                     and self.docker_client is not None):
 
-                self._docker_health_status(result['Id'])
+                self._docker_health_status(result['Id'], refresh=False)
 
     def _gather_update_metrics(self):
         """ Gather and send metrics from system updates
@@ -1210,11 +1959,15 @@ class Core:
                 soft_status=False,
             )
 
-    def _docker_health_status(self, container_id):
+    def _docker_health_status(self, container_id, refresh=True):
         """ Send metric for docker container health status
+
+            With refresh=False, the cached docker inspect could be used.
         """
+        if refresh:
+            self._invalidate_docker_inspect(container_id)
         try:
-            result = self.docker_client.inspect_container(container_id)
+            result = self.get_docker_inspect(container_id)
         except:
             return  # most probably container was removed
 
@@ -1270,33 +2023,114 @@ class Core:
             if metric['time'] >= cutoff and key not in deleted_metrics
         }
 
-    def _check_triggers(self):
-        if self._trigger_discovery:
-            self._discovery_job = self.trigger_job(self._discovery_job)
-            self._trigger_discovery = False
-        if self._trigger_updates_count:
-            self._gather_update_metrics_job = self.trigger_job(
-                self._gather_update_metrics_job
-            )
-            self._trigger_updates_count = False
-        if self._trigger_facts:
-            self._update_facts_job = self.trigger_job(self._update_facts_job)
-            self._trigger_facts = False
+    def trigger(self, *names):
+        """ Request the jobs identified by names to run as soon as possible
+
+            Valid names are the keys of TRIGGER_JOBS. Triggers are debounced,
+            multiple triggers received in a short time run the job once.
+            If the job isn't scheduled yet, the trigger is kept until it is.
+
+            This method takes a lock and must not be called from a signal
+            handler.
+        """
+        with self._triggers_condition:
+            self._pending_triggers.update(names)
+            self._triggers_received += 1
+            self._triggers_condition.notify()
 
+    def _start_triggers_threads(self):
+        thread = threading.Thread(target=self._process_triggers)
+        thread.daemon = True
+        thread.start()
+
+        thread = threading.Thread(target=self._watch_netstat)
+        thread.daemon = True
+        thread.start()
+
+    def _process_triggers(self):
+        """ Wait for triggers and run the corresponding jobs
+        """
+        while not self.is_terminating.is_set():
+            with self._triggers_condition:
+                if not self._pending_triggers:
+                    self._triggers_condition.wait(60)
+                    if (not self._pending_triggers
+                            and not self._deferred_triggers):
+                        continue
+
+                # Debounce: wait for a quiet period of
+                # TRIGGER_DEBOUNCE_DELAY seconds, at most TRIGGER_DEBOUNCE_MAX
+                deadline = (
+                    bleemeo_agent.util.get_clock() + TRIGGER_DEBOUNCE_MAX
+                )
+                while not self.is_terminating.is_set():
+                    count = self._triggers_received
+                    timeout = min(
+                        TRIGGER_DEBOUNCE_DELAY,
+                        deadline - bleemeo_agent.util.get_clock(),
+                    )
+                    if timeout <= 0:
+                        break
+                    self._triggers_condition.wait(timeout)
+                    if self._triggers_received == count:
+                        break
+
+                names = self._pending_triggers | self._deferred_triggers
+                previously_deferred = self._deferred_triggers
+                self._pending_triggers = set()
+                self._deferred_triggers = set()
+
+            deferred = set()
+            for name in names:
+                attribute = TRIGGER_JOBS[name]
+                job = getattr(self, attribute)
+                if job is None:
+                    if name not in previously_deferred:
+                        logging.debug(
+                            'Job %s is not yet scheduled, trigger is delayed',
+                            name,
+                        )
+                    deferred.add(name)
+                    continue
+                logging.debug('Running job %s due to trigger', name)
+                setattr(self, attribute, self.trigger_job(job))
+
+            if deferred:
+                with self._triggers_condition:
+                    self._deferred_triggers.update(deferred)
+
+    def _watch_netstat(self):
+        """ Trigger a discovery when netstat.out is updated
+        """
         netstat_file = self.config.get('agent.netstat_file', 'netstat.out')
+        watcher = bleemeo_agent.util.FileWatcher(netstat_file)
         try:
-            mtime = os.stat(netstat_file).st_mtime
-        except OSError:
-            mtime = 0
-
-        if mtime != self._netstat_output_mtime:
-            # Trigger discovery if netstat.out changed
-            self._trigger_discovery = True
-            self._netstat_output_mtime = mtime
+            while not self.is_terminating.is_set():
+                if watcher.wait(60):
+                    logging.debug('%s changed', netstat_file)
+                    self.trigger('discovery')
+        finally:
+            watcher.close()
 
     def update_discovery(self, first_run=False, deleted_services=None):
+        # Discovery could run from multiple jobs (e.g. after a fast start)
+        with self._discovery_lock:
+            self._update_discovery(first_run, deleted_services)
+
+    def _update_discovery(self, first_run, deleted_services):
+        clock_now = bleemeo_agent.util.get_clock()
         self._update_docker_info()
-        discovered_running_services = self._run_discovery()
+
+        incremental = (
+            not first_run
+            and self.config.get('discovery.incremental', True)
+            and self._last_full_discovery is not None
+            and clock_now - self._last_full_discovery
+            < FULL_DISCOVERY_INTERVAL
+        )
+        if not incremental:
+            self._last_full_discovery = clock_now
+        discovered_running_services = self._run_discovery(incremental)
         if first_run:
             # Should only be needed on first run. In addition to avoid
             # possible race-condition, do not run this while
@@ -1332,6 +2166,30 @@ class Core:
             self.state.set_complex_dict(
                 'discovered_services', self.discovered_services)
 
+        self._update_services()
+
+        self.last_discovery_update = bleemeo_agent.util.get_clock()
+        if had_autoremove:
+            self.last_services_autoremove = bleemeo_agent.util.get_clock()
+
+        duration = self.last_discovery_update - clock_now
+        logging.debug(
+            '%s discovery took %.3f seconds',
+            'Incremental' if incremental else 'Full',
+            duration,
+        )
+        self.emit_metric({
+            'measurement': 'agent_discovery_duration',
+            'time': time.time(),
+            'value': duration,
+        })
+
+    def _update_services(self):
+        """ Build services from discovered services and apply them
+
+            Metrics collector configuration and checks are only updated
+            for services that changed.
+        """
         self.services = copy.deepcopy(self.discovered_services)
         apply_service_override(
             self.services,
@@ -1342,10 +2200,6 @@ class Core:
         self.graphite_server.update_discovery()
         bleemeo_agent.checker.update_checks(self)
 
-        self.last_discovery_update = bleemeo_agent.util.get_clock()
-        if had_autoremove:
-            self.last_services_autoremove = bleemeo_agent.util.get_clock()
-
     def apply_service_defaults(self):
         """ Apply defaults to services.
 
@@ -1436,60 +2290,261 @@ class Core:
                 if port_protocol.endswith('/udp6'):
                     del extra_ports[port_protocol]
 
-    def _get_processes_map(self):
+    def _get_processes_map(self, incremental=False):
         """ Return a mapping from PID to name and container in which
             process is running.
 
             When running in host / root pid namespace, associate None
             for the container (else it's the docker container name)
+
+            Each entry also contains the service_info from KNOWN_PROCESS
+            matching the process (or None).
+
+            When incremental is True, processes and containers seen by the
+            previous call are reused. Only new processes (new PID or same PID
+            with a different create_time) are matched against KNOWN_PROCESS
+            and only new or restarted containers are listed with "docker top".
         """
         # Contains list of all processes from root pid_namespace point-of-view
         # key is the PID, value is {'name': 'mysqld', 'instance': 'db'}
         # instance is the container name. In case of processes running
         # outside docker, it's None
         processes = {}
+        if incremental:
+            previous_processes = self._discovery_processes
+            previous_containers = self._discovery_containers
+        else:
+            previous_processes = {}
+            previous_containers = {}
+
+        # New processes which may be a service
+        unattributed_service = False
 
-        if (self.container is None
-                or self.config.get('container.pid_namespace_host')):
+        host_pid_namespace = (
+            self.container is None
+            or self.config.get('container.pid_namespace_host')
+        )
+        if host_pid_namespace:
             # The host pid namespace see ALL process.
             # They are added in instance "None" (i.e. running in the host),
             # but if they are running in a docker, they will be updated later
-            for process in bleemeo_agent.util.get_top_info(self)['processes']:
-                processes[process['pid']] = {
-                    'cmdline': process['cmdline'],
-                    'instance': None,
-                    'exe': process['exe'],
-                }
+            top_info = self.get_top_info(max_age=DISCOVERY_TOP_INFO_MAX_AGE)
+            for process in top_info['processes']:
+                pid = process['pid']
+                entry = previous_processes.get(pid)
+                # A process which exec() keeps its PID and create_time,
+                # cmdline also need to match to reuse the entry.
+                if (entry is None
+                        or entry['create_time'] != process['create_time']
+                        or entry['cmdline'] != process['cmdline']):
+                    entry = {
+                        'cmdline': process['cmdline'],
+                        'exe': process['exe'],
+                        'create_time': process['create_time'],
+                        'service_info': get_service_info(process['argv']),
+                    }
+                    if entry['service_info'] is not None:
+                        unattributed_service = True
+                entry['instance'] = None
+                processes[pid] = entry
+
+        self._discovery_processes = processes
+        self._discovery_containers = {}
 
         if self.docker_client is None:
             return processes
 
+        # Without host pid namespace, new processes in a container are only
+        # visible with docker top. A new process which is a service may also
+        # belong to any already known container. In both case, all
+        # containers need a docker top.
+        reuse_docker_top = host_pid_namespace and not unattributed_service
+
+        containers = []
+        need_top = []
         for container in self.docker_client.containers():
             # container has... nameS
             # Also name start with "/". I think it may have mulitple name
             # and/or other "/" with docker-in-docker.
             container_name = container['Names'][0].lstrip('/')
-            try:
-                docker_top = (
-                    self.docker_client.top(container_name)
-                )
-            except docker.errors.APIError:
-                # most probably container is restarting or just stopped
-                continue
+            container_id = container['Id']
+            started_at = (
+                self.docker_containers.get(container_name, {})
+                .get('State', {})
+                .get('StartedAt')
+            )
+            containers.append((container_name, container_id, started_at))
 
-            for (pid, cmdline) in decode_docker_top(docker_top):
-                processes.setdefault(pid, {'cmdline': cmdline})
-                processes[pid]['instance'] = container_name
+        if (host_pid_namespace
+                and sys.platform.startswith('linux')
+                and self.config.get('docker.pid_resolver', 'top') == 'cgroup'):
+            (resolved, unresolved) = (
+                self._get_containers_processes_cgroup(processes)
+            )
+        else:
+            (resolved, unresolved) = ({}, set())
+
+        for (container_name, container_id, started_at) in containers:
+            if container_id in resolved:
+                if unresolved:
+                    # some processes may belong to this container
+                    need_top.append(container_name)
+                continue
+            cached = previous_containers.get(container_id)
+            if (not reuse_docker_top
+                    or cached is None
+                    or cached['name'] != container_name
+                    or cached['started_at'] != started_at):
+                need_top.append(container_name)
+
+        docker_tops = self._docker_api_map(self.docker_client.top, need_top)
+
+        for (container_name, container_id, started_at) in containers:
+            if container_id in resolved:
+                container_processes = list(resolved[container_id])
+                if container_name in docker_tops:
+                    # docker top is only used for processes whose cgroup
+                    # couldn't be read
+                    container_processes.extend(
+                        (pid, cmdline)
+                        for (pid, cmdline) in decode_docker_top(
+                            docker_tops[container_name]
+                        )
+                        if pid in unresolved
+                    )
+            elif container_name in need_top:
+                if container_name not in docker_tops:
+                    # most probably container is restarting or just stopped
+                    continue
+                container_processes = decode_docker_top(
+                    docker_tops[container_name]
+                )
+            else:
+                container_processes = (
+                    previous_containers[container_id]['processes']
+                )
+                if host_pid_namespace:
+                    # A process may have exited while its container keeps
+                    # running, don't bring it back.
+                    container_processes = [
+                        (pid, cmdline)
+                        for (pid, cmdline) in container_processes
+                        if pid in processes
+                    ]
+
+            self._discovery_containers[container_id] = {
+                'name': container_name,
+                'started_at': started_at,
+                'processes': container_processes,
+            }
+
+            for (pid, cmdline) in container_processes:
+                entry = processes.get(pid)
+                if entry is None:
+                    entry = previous_processes.get(pid)
+                    if entry is None or entry['cmdline'] != cmdline:
+                        entry = {
+                            'cmdline': cmdline,
+                            'create_time': None,
+                            'service_info': get_service_info(cmdline),
+                        }
+                    processes[pid] = entry
+                entry['instance'] = container_name
 
         return processes
 
-    def get_netstat(self):
-        """ Parse netstat output and return a mapping pid => list of listening
-            port/protocol (e.g. 80/tcp, 127/udp)
+    def _get_containers_processes_cgroup(self, processes):
+        """ Return (mapping container ID => list of (pid, cmdline), unresolved)
+
+            The container of each process is found from its cgroup. This
+            only works when processes are from the host pid namespace.
+
+            unresolved is the set of PIDs whose cgroup couldn't be read.
+            Caller should fall back to "docker top" for them.
+
+            Only found container IDs are kept in the process entry. A process
+            which isn't (yet) in a container cgroup, e.g. during container
+            start-up, is read again on next call.
         """
+        result = {}
+        unresolved = set()
+        for (pid, entry) in processes.items():
+            container_id = entry.get('container_id')
+            if container_id is None:
+                try:
+                    container_id = bleemeo_agent.procfs.get_container_id(pid)
+                except (IOError, OSError) as exc:
+                    if exc.errno in (errno.ENOENT, errno.ESRCH):
+                        # process terminated
+                        continue
+                    logging.debug(
+                        'Unable to read cgroup of process %d: %s', pid, exc,
+                    )
+                    unresolved.add(pid)
+                    continue
+            if container_id is not None:
+                entry['container_id'] = container_id
+                result.setdefault(container_id, []).append(
+                    (pid, entry['cmdline'])
+                )
+        return (result, unresolved)
+
+    def get_netstat(self):
+        """ Return a mapping pid => list of listening port/protocol
+            (e.g. 80/tcp, 127/udp)
 
+            On Linux, listening sockets are read from /proc/net. The netstat
+            output (written by bleemeo-netstat) is only parsed when this
+            fails or when the owner of some sockets isn't visible to the
+            agent (e.g. agent isn't running as root).
+        """
         netstat_info = {}
+        need_netstat_file = True
+        if self._listen_socket_reader is not None:
+            try:
+                sockets = self._listen_socket_reader.get_listening_sockets()
+            except (IOError, OSError) as exc:
+                logging.debug('Unable to read listening sockets: %s', exc)
+            else:
+                need_netstat_file = any(
+                    pid is None for (pid, _, _, _) in sockets
+                )
+                for (pid, protocol, address, port) in sockets:
+                    if pid is not None:
+                        self._add_listen_port(
+                            netstat_info, pid, protocol, address, port,
+                        )
 
+        if need_netstat_file:
+            self._parse_netstat_file(netstat_info)
+
+        if self._listen_socket_reader is None:
+            self._add_psutil_connections(netstat_info)
+
+        return netstat_info
+
+    def _add_listen_port(self, netstat_info, pid, protocol, address, port):
+        """ Add one listening socket in netstat_info
+        """
+        if address == '::':
+            # "::" is all address in IPv6. Assume the socket
+            # is IPv4 & IPv6 and since agent supports only IPv4
+            # convert to all address in IPv4
+            address = '0.0.0.0'
+        if ':' in address:
+            # No support for IPv6
+            return
+
+        key = '%s/%s' % (port, protocol)
+        ports = netstat_info.setdefault(pid, {})
+
+        # If multiple address exists, prefer 127.0.0.1
+        if key not in ports or address.startswith('127.'):
+            ports[key] = address
+
+    def _parse_netstat_file(self, netstat_info):
+        """ Parse netstat output and add listening sockets to netstat_info
+        """
         netstat_file = self.config.get('agent.netstat_file', 'netstat.out')
         netstat_re = re.compile(
             r'^(?P<protocol>udp6?|tcp6?)\s+\d+\s+\d+\s+'
@@ -1515,26 +2570,17 @@ class Core:
                         # Assume this socket is IPv4 & IPv6
                         protocol = protocol[:3]
 
-                    if address == '::':
-                        # "::" is all address in IPv6. Assume the socket
-                        # is IPv4 & IPv6 and since agent supports only IPv4
-                        # convert to all address in IPv4
-                        address = '0.0.0.0'
-                    if ':' in address:
-                        # No support for IPv6
-                        continue
-
-                    key = '%s/%s' % (port, protocol)
-                    ports = netstat_info.setdefault(pid, {})
-
-                    # If multiple address exists, prefer 127.0.0.1
-                    if key not in ports or address.startswith('127.'):
-                        ports[key] = address
+                    self._add_listen_port(
+                        netstat_info, pid, protocol, address, port,
+                    )
         except IOError:
             pass
 
-        # also use psutil to fill current information, but due to privilege
-        # this may be very limited.
+    def _add_psutil_connections(self, netstat_info):
+        """ Add listening sockets from psutil to netstat_info
+
+            Due to privilege this may be very limited.
+        """
         for conn in psutil.net_connections():
             if conn.pid is None:
                 continue
@@ -1543,15 +2589,6 @@ class Core:
 
             (address, port) = conn.laddr
 
-            if address == '::':
-                # "::" is all address in IPv6. Assume the socket
-                # is IPv4 & IPv6 and since agent supports only IPv4
-                # convert to all address in IPv4
-                address = '0.0.0.0'
-            if ':' in address:
-                # No support for IPv6
-                continue
-
             if conn.type == socket.SOCK_STREAM:
                 protocol = 'tcp'
             elif conn.type == socket.SOCK_DGRAM:
@@ -1559,14 +2596,9 @@ class Core:
             else:
                 continue
 
-            key = '%s/%s' % (port, protocol)
-            ports = netstat_info.setdefault(conn.pid, {})
-
-            # If multiple address exists, prefer 127.0.0.1
-            if key not in ports or address.startswith('127.'):
-                ports[key] = address
-
-        return netstat_info
+            self._add_listen_port(
+                netstat_info, conn.pid, protocol, address, port,
+            )
 
     def _discovery_fill_address_and_ports(
             self, service_info, instance, ports):
@@ -1615,11 +2647,11 @@ class Core:
         service_info['port'] = default_port
         service_info['address'] = default_address
 
-    def _run_discovery(self):
+    def _run_discovery(self, incremental=False):
         """ Try to discover some service based on known port/process
         """
         discovered_services = {}
-        processes = self._get_processes_map()
+        processes = self._get_processes_map(incremental)
 
         netstat_info = self.get_netstat()
 
@@ -1631,7 +2663,7 @@ class Core:
             if process is None:
                 continue
 
-            service_info = get_service_info(process['cmdline'])
+            service_info = process['service_info']
             if service_info is not None:
                 service_info = service_info.copy()
                 service_info['exe_path'] = process.get('exe') or ''
@@ -1706,7 +2738,7 @@ class Core:
                 pass
         else:
             # MySQL is running inside a docker.
-            container_info = self.docker_client.inspect_container(instance)
+            container_info = self._get_docker_inspect_by_name(instance)
             for env in container_info['Config']['Env']:
                 # env has the form "VARIABLE=value"
                 if env.startswith('MYSQL_ROOT_PASSWORD='):
@@ -1724,7 +2756,7 @@ class Core:
 
         if instance is not None:
             # Only know to extract user/password from Docker container
-            container_info = self.docker_client.inspect_container(instance)
+            container_info = self._get_docker_inspect_by_name(instance)
             for env in container_info['Config']['Env']:
                 # env has the form "VARIABLE=value"
                 if env.startswith('POSTGRES_PASSWORD='):
@@ -1755,16 +2787,19 @@ class Core:
                 self.docker_client = None
                 continue
 
+            # Events may have been missed while disconnected
+            self._invalidate_docker_inspect()
+
             try:
                 try:
-                    generator = self.docker_client.events(
+                    generator = self._docker_events_client.events(
                         decode=True, since=last_event_at,
                     )
                 except TypeError:
                     # older version of docker-py does decode=True by default
                     # (and don't have this option)
                     # Also they don't have since option.
-                    generator = self.docker_client.events()
+                    generator = self._docker_events_client.events()
 
                 for event in generator:
                     # even older version of docker-py does not support decoding
@@ -1773,34 +2808,93 @@ class Core:
                         event = json.loads(event)
 
                     last_event_at = event['time']
-                    self._process_docker_event(event)
+                    self._queue_docker_event(event)
             except:
                 # When docker restart, it breaks the connection and the
                 # generator will raise an exception.
                 logging.debug('Docker event watcher error', exc_info=True)
                 pass
 
-    def _process_docker_event(self, event):
+    def _queue_docker_event(self, event):
+        """ Queue a docker event for _process_docker_events_loop
+        """
+        try:
+            self._docker_events.put_nowait(event)
+        except queue.Full:
+            # Events processing can't keep up. Events are dropped and
+            # everything will be refreshed once the queue is drained.
+            self._docker_events_overflow = True
+
+    def _process_docker_events_loop(self):
+        """ Process queued docker events by batch
+
+            Events received within DOCKER_EVENTS_COALESCE_DELAY seconds
+            after the first one are processed together. This avoid doing
+            the same work for each event of a burst (e.g. restart of a
+            compose stack).
+        """
+        while True:
+            events = [self._docker_events.get()]
+            deadline = (
+                bleemeo_agent.util.get_clock() + DOCKER_EVENTS_COALESCE_DELAY
+            )
+            while True:
+                timeout = deadline - bleemeo_agent.util.get_clock()
+                if timeout <= 0:
+                    break
+                try:
+                    events.append(self._docker_events.get(timeout=timeout))
+                except queue.Empty:
+                    break
 
-        if 'Action' in event:
-            action = event['Action']
-        else:
-            # status is depractated. Action was introduced with
-            # Docker 1.10
-            action = event.get('status')
-        event_type = event.get('Type', 'container')
+            overflow = self._docker_events_overflow
+            self._docker_events_overflow = False
+            try:
+                self._process_docker_events(events, overflow)
+            except Exception:
+                logging.debug('Docker events processing error', exc_info=True)
 
-        if 'Actor' in event:
-            actor_id = event['Actor'].get('ID')
-        else:
-            # id is deprecated. Actor was introduced with
-            # Docker 1.10
-            actor_id = event.get('id')
-
-        if (action in DOCKER_DISCOVERY_EVENTS
-                and event_type == 'container'):
-            self._trigger_discovery = True
-            if action == 'destroy':
+    def _process_docker_events(self, events, overflow=False):
+        """ Process a batch of docker events
+
+            Events are coalesced per container: the inspect cache is
+            invalidated once, one discovery is triggered and health status
+            is refreshed once per container.
+
+            overflow is True when some events were dropped. All cached
+            container information is then invalidated.
+        """
+        containers_actions = {}
+        for event in events:
+            (event_type, action, actor_id) = decode_docker_event(event)
+            if event_type != 'container' or actor_id is None:
+                continue
+            containers_actions.setdefault(actor_id, set()).add(action)
+
+        if overflow:
+            logging.debug('Docker events were dropped, refreshing everything')
+            self._invalidate_docker_inspect()
+            self._last_full_discovery = None
+            self.trigger('discovery')
+
+        need_discovery = False
+        health_changed = []
+        for (actor_id, actions) in containers_actions.items():
+            if any(
+                    not action.startswith('exec_')
+                    and not action.startswith('health_status:')
+                    for action in actions):
+                # Docker inspect of this container may have changed. exec_*
+                # events are ignored, they are sent by each health check.
+                self._invalidate_docker_inspect(actor_id)
+
+            if actions.intersection(DOCKER_DISCOVERY_EVENTS):
+                need_discovery = True
+                # Processes of this container changed, next discovery must
+                # do a docker top on it.
+                self._discovery_containers.pop(actor_id, None)
+
+            if 'destroy' in actions:
                 # Mark immediately any service from this container
                 # as inactive. It avoid that a service check detect
                 # the service as down before the discovery was run.
@@ -1808,10 +2902,18 @@ class Core:
                     if ('container_id' in service_info
                             and service_info['container_id'] == actor_id):
                         service_info['active'] = False
+            elif any(
+                    action.startswith('health_status:')
+                    for action in actions):
+                health_changed.append(actor_id)
+
+        if need_discovery:
+            self.trigger('discovery')
 
-        elif (action.startswith('health_status:')
-                and event_type == 'container'):
+        for actor_id in health_changed:
             self._docker_health_status(actor_id)
+
+        if health_changed:
             # If an health_status event occure, it means that
             # docker container inspect changed.
             # Update the discovery date, so BleemeoConnector will
@@ -1824,11 +2926,100 @@ class Core:
         """ Update facts """
         self.last_facts = bleemeo_agent.facts.get_facts(self)
         self.last_facts_update = bleemeo_agent.util.get_clock()
+        # Saved for the fast start of next run
+        self.state.set('facts', self.last_facts)
+
+    def get_top_info(self, max_age=None, stripped=False):
+        """ Return a snapshot of all processes (and system usage)
+
+            The snapshot is shared by all its users (top info, discovery,...)
+            and must not be modified. If the last snapshot is younger than
+            max_age seconds it is returned, else a new one is gathered.
+
+            If stripped is True, the snapshot without fields only used by
+            the agent is returned (see bleemeo_agent.util.strip_top_info).
+            It's built once per snapshot and shared too.
+        """
+        with self._top_info_lock:
+            clock_now = bleemeo_agent.util.get_clock()
+            if (max_age is not None
+                    and self._top_info_clock is not None
+                    and clock_now - self._top_info_clock < max_age):
+                if not stripped:
+                    return self.top_info
+                if self._top_info_stripped is None:
+                    self._top_info_stripped = (
+                        bleemeo_agent.util.strip_top_info(self.top_info)
+                    )
+                return self._top_info_stripped
+
+            top_info = bleemeo_agent.util.get_top_info(self)
+            duration = bleemeo_agent.util.get_clock() - clock_now
+            self.top_info = top_info
+            self._top_info_stripped = None
+            self._top_info_clock = clock_now
+            if stripped:
+                self._top_info_stripped = (
+                    bleemeo_agent.util.strip_top_info(top_info)
+                )
+                result = self._top_info_stripped
+            else:
+                result = top_info
+
+        logging.debug(
+            'Process snapshot of %d processes took %.3f seconds',
+            len(top_info['processes']),
+            duration,
+        )
+        self.emit_metric({
+            'measurement': 'agent_process_snapshot_duration',
+            'time': top_info['time'],
+            'value': duration,
+        })
+        return result
+
+    def request_fast_top_info(self, duration=None):
+        """ Send top info at full rate for the next duration seconds
+
+            Only useful with adaptive top info, which otherwise send it
+            every agent.top_info.slow_interval seconds.
+        """
+        if not self.config.get('agent.top_info.adaptive', False):
+            return
+
+        if duration is None:
+            duration = self.config.get(
+                'agent.top_info.fast_duration', TOP_INFO_FAST_DURATION,
+            )
+        clock_now = bleemeo_agent.util.get_clock()
+        was_fast = (
+            self._top_info_fast_until is not None
+            and clock_now < self._top_info_fast_until
+        )
+        self._top_info_fast_until = max(
+            self._top_info_fast_until or 0, clock_now + duration,
+        )
+        if not was_fast:
+            logging.debug('Sending top info at full rate')
+            self.trigger('top_info')
 
     def send_top_info(self):
-        self.top_info = bleemeo_agent.util.get_top_info(self)
+        clock_now = bleemeo_agent.util.get_clock()
+        if (self.config.get('agent.top_info.adaptive', False)
+                and self._top_info_sent_at is not None
+                and (self._top_info_fast_until is None
+                     or clock_now >= self._top_info_fast_until)):
+            slow_interval = self.config.get(
+                'agent.top_info.slow_interval', TOP_INFO_SLOW_INTERVAL,
+            )
+            # Allow 1 second of jitter on job run time
+            if clock_now - self._top_info_sent_at < slow_interval - 1:
+                return
+
+        self._top_info_sent_at = clock_now
+        top_info = self.get_top_info(max_age=TOP_INFO_MAX_AGE, stripped=True)
         if self.bleemeo_connector is not None:
-            self.bleemeo_connector.publish_top_info(self.top_info)
+            self.bleemeo_connector.publish_top_info(top_info)
 
     def reload_config(self):
         (self.config, errors) = bleemeo_agent.config.load_config()
@@ -1891,6 +3082,14 @@ class Core:
         if no_emit:
             return
 
+        if not self._first_metric_emitted:
+            self._first_metric_emitted = True
+            logging.info(
+                'First metric (%s) emitted %.2f seconds after agent start',
+                metric['measurement'],
+                bleemeo_agent.util.get_clock() - self.started_at,
+            )
+
         if self.bleemeo_connector is not None:
             self.bleemeo_connector.emit_metric(metric)
         if self.influx_connector is not None:
@@ -2191,7 +3390,7 @@ class Core:
             * the IP address of this container in the docker_gwbridge
             * the IP address from the first network
         """
-        container_info = self.docker_client.inspect_container(container_name)
+        container_info = self._get_docker_inspect_by_name(container_name)
         container_id = container_info.get('Id')
 
         if container_info['NetworkSettings']['IPAddress']:
@@ -2226,7 +3425,7 @@ class Core:
         return address_first_network
 
     def get_docker_ports(self, container_name):
-        container_info = self.docker_client.inspect_container(container_name)
+        container_info = self._get_docker_inspect_by_name(container_name)
         exposed_ports = container_info['Config'].get('ExposedPorts', {})
         listening_ports = list(exposed_ports.keys())
 
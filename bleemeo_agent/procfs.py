@@ -0,0 +1,390 @@
+#
+#  Copyright 2015-2016 Bleemeo
+#
+#  bleemeo.com an infrastructure monitoring solution in the Cloud
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+""" Direct readers for Linux /proc filesystem.
+
+    They are faster alternatives to psutil when the agent need information
+    about all processes of a busy host.
+"""
+
+import errno
+import os
+import pwd
+import re
+import shlex
+import socket
+import struct
+import time
+
+import psutil
+
+
+# Mapping from the state letter of /proc/<pid>/stat to psutil status
+PROC_STATUS = {
+    'R': psutil.STATUS_RUNNING,
+    'S': psutil.STATUS_SLEEPING,
+    'D': psutil.STATUS_DISK_SLEEP,
+    'T': psutil.STATUS_STOPPED,
+    't': psutil.STATUS_TRACING_STOP,
+    'Z': psutil.STATUS_ZOMBIE,
+    'X': psutil.STATUS_DEAD,
+    'x': psutil.STATUS_DEAD,
+    'K': getattr(psutil, 'STATUS_WAKE_KILL', 'wake-kill'),
+    'W': getattr(psutil, 'STATUS_WAKING', 'waking'),
+    'I': getattr(psutil, 'STATUS_IDLE', 'idle'),
+    'P': getattr(psutil, 'STATUS_PARKED', 'parked'),
+}
+
+# Process name in /proc/<pid>/stat is truncated to 15 characters
+PROC_NAME_MAX_LENGTH = 15
+
+# State of a listening TCP socket in /proc/net/tcp (TCP_LISTEN)
+TCP_LISTEN = '0A'
+# State of an unconnected UDP socket in /proc/net/udp (TCP_CLOSE)
+UDP_UNCONNECTED = '07'
+
+# Match the container ID at the end of a cgroup path. Depending on the cgroup
+# driver, the path ends with "/docker/<id>", "/docker-<id>.scope",
+# "/cri-containerd-<id>.scope", "/kubepods/.../<id>"...
+CGROUP_CONTAINER_ID_RE = re.compile(r'[/-]([0-9a-f]{64})(\.scope)?$')
+
+
+def get_container_id(pid, proc_path='/proc'):
+    """ Return the ID of the container running pid, using its cgroup
+
+        Return None if the process isn't in a container. Raise IOError
+        (or OSError) if the cgroup file can't be read, e.g. because the
+        process terminated.
+    """
+    path = os.path.join(proc_path, str(pid), 'cgroup')
+    with open(path, 'rb') as fd:
+        data = fd.read().decode('utf-8', 'replace')
+
+    for line in data.splitlines():
+        # Format is hierarchy-ID:controller-list:cgroup-path
+        cgroup_path = line.split(':', 2)[-1]
+        match = CGROUP_CONTAINER_ID_RE.search(cgroup_path)
+        if match is not None:
+            return match.group(1)
+    return None
+
+
+class ProcessReader:
+    """ Read information about all processes from /proc
+
+        It produces the same process entries as bleemeo_agent.util.get_top_info
+        does with psutil, but reads stat, statm, status and cmdline files
+        directly. uid to username resolution is cached and read buffers
+        are reused between processes.
+
+        The reader keeps CPU times of the previous call to compute the
+        cpu_percent of each process, so the same instance should be reused.
+    """
+
+    def __init__(self, proc_path='/proc'):
+        self.proc_path = proc_path
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self._buffer = bytearray(4096)
+        self._usernames = {}
+        # (pid, starttime) => (cpu ticks, wall clock)
+        self._previous_cpu = {}
+        self._boot_time = None
+
+    def _read(self, path):
+        """ Read the whole file using the shared buffer
+        """
+        with open(path, 'rb', buffering=0) as fd:
+            size = fd.readinto(self._buffer)
+            while size == len(self._buffer):
+                # buffer is full, file may be bigger
+                self._buffer.extend(bytearray(len(self._buffer)))
+                size += fd.readinto(memoryview(self._buffer)[size:])
+        return bytes(self._buffer[:size])
+
+    @property
+    def boot_time(self):
+        if self._boot_time is None:
+            data = self._read(os.path.join(self.proc_path, 'stat'))
+            for line in data.splitlines():
+                if line.startswith(b'btime'):
+                    self._boot_time = float(line.split()[1])
+                    break
+            else:
+                raise ValueError('btime not found in /proc/stat')
+        return self._boot_time
+
+    def get_username(self, uid):
+        """ Return username for uid, caching the result
+        """
+        username = self._usernames.get(uid)
+        if username is None:
+            try:
+                username = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                # the uid can't be resolved by the system
+                username = str(uid)
+            self._usernames[uid] = username
+        return username
+
+    def _pids(self):
+        for name in os.listdir(self.proc_path):
+            if name.isdigit():
+                yield int(name)
+
+    def get_processes(self):
+        """ Return the list of processes (same schema as get_top_info)
+        """
+        processes = []
+        previous_cpu = self._previous_cpu
+        self._previous_cpu = {}
+        clock_now = time.time()
+
+        for pid in self._pids():
+            try:
+                process_info = self._get_process(
+                    pid, previous_cpu, clock_now,
+                )
+            except (IOError, OSError) as exc:
+                # Process terminated while it was read
+                if exc.errno in (errno.ENOENT, errno.ESRCH):
+                    continue
+                raise
+            except (ValueError, IndexError):
+                # Process terminated while it was read (truncated file)
+                continue
+            processes.append(process_info)
+
+        return processes
+
+    def _get_process(self, pid, previous_cpu, clock_now):
+        pid_path = os.path.join(self.proc_path, str(pid))
+
+        stat = self._read(os.path.join(pid_path, 'stat'))
+        # Name is between parenthesis and may contains spaces or parenthesis
+        name_start = stat.index(b'(')
+        name_end = stat.rindex(b')')
+        comm = stat[name_start + 1:name_end].decode('utf-8', 'replace')
+        fields = stat[name_end + 2:].split()
+        # fields[0] is the 3rd field of stat (state), see proc(5)
+        state = fields[0].decode('ascii')
+        utime = int(fields[11])
+        stime = int(fields[12])
+        starttime = int(fields[19])
+
+        statm = self._read(os.path.join(pid_path, 'statm'))
+        rss_pages = int(statm.split()[1])
+
+        uid = None
+        status = self._read(os.path.join(pid_path, 'status'))
+        for line in status.splitlines():
+            if line.startswith(b'Uid:'):
+                uid = int(line.split()[1])
+                break
+
+        argv = self._read_cmdline(pid_path)
+
+        try:
+            exe = os.readlink(os.path.join(pid_path, 'exe'))
+        except OSError:
+            exe = ''
+
+        name = comm
+        if len(comm) >= PROC_NAME_MAX_LENGTH and argv:
+            # Same as psutil: try to recover the full name from cmdline
+            extended_name = os.path.basename(argv[0])
+            if extended_name.startswith(comm):
+                name = extended_name
+
+        if argv and argv[0]:
+            cmdline = ' '.join(shlex.quote(x) for x in argv)
+        else:
+            cmdline = name
+            argv = [name]
+
+        cpu_ticks = utime + stime
+        key = (pid, starttime)
+        self._previous_cpu[key] = (cpu_ticks, clock_now)
+        cpu_percent = 0.0
+        if key in previous_cpu:
+            (previous_ticks, previous_clock) = previous_cpu[key]
+            delta_clock = clock_now - previous_clock
+            if delta_clock > 0:
+                cpu_percent = round(
+                    (cpu_ticks - previous_ticks) / self.clock_ticks
+                    / delta_clock * 100,
+                    1,
+                )
+
+        return {
+            'pid': pid,
+            'create_time': self.boot_time + starttime / self.clock_ticks,
+            'cmdline': cmdline,
+            'argv': argv,
+            'name': name,
+            'memory_rss': rss_pages * self.page_size / 1024,
+            'cpu_percent': cpu_percent,
+            'cpu_times': cpu_ticks / self.clock_ticks,
+            'status': PROC_STATUS.get(state, state),
+            'username': self.get_username(uid) if uid is not None else '',
+            'exe': exe,
+        }
+
+    def _read_cmdline(self, pid_path):
+        """ Return process argv, splitted like psutil does
+        """
+        data = self._read(os.path.join(pid_path, 'cmdline'))
+        data = data.decode('utf-8', 'surrogateescape')
+        if not data:
+            return []
+
+        # Process which changed their title (setproctitle) may use
+        # space instead of null byte as separator.
+        if data.endswith('\0'):
+            separator = '\0'
+        else:
+            separator = ' '
+        if data.endswith(separator):
+            data = data[:-1]
+        argv = data.split(separator)
+        if separator == '\0' and len(argv) == 1 and ' ' in data:
+            argv = data.split(' ')
+        return argv
+
+
+def decode_address(hex_address):
+    """ Decode an address from /proc/net/{tcp,udp}{,6}
+
+        Address has the form "0100007F:1F90" (IP and port in hexadecimal,
+        the IP being in host byte order by 32-bits words).
+        Return (address, port).
+    """
+    (hex_ip, hex_port) = hex_address.split(':')
+    ip_bytes = bytes.fromhex(hex_ip)
+    words = struct.unpack('=%dI' % (len(ip_bytes) // 4), ip_bytes)
+    ip_bytes = struct.pack('!%dI' % len(words), *words)
+    if len(ip_bytes) == 4:
+        address = socket.inet_ntop(socket.AF_INET, ip_bytes)
+    else:
+        address = socket.inet_ntop(socket.AF_INET6, ip_bytes)
+    return (address, int(hex_port, 16))
+
+
+class ListenSocketReader:
+    """ Find listening sockets and the process owning them from /proc
+
+        Sockets are read from /proc/net/tcp, tcp6, udp and udp6. Only
+        listening TCP sockets and unconnected UDP sockets are kept, unlike
+        psutil.net_connections which decode all sockets.
+
+        The owner of a socket is found by its inode in /proc/<pid>/fd. The
+        inode to PID mapping is cached, so processes are only scanned when
+        new sockets are found.
+    """
+
+    def __init__(self, proc_path='/proc'):
+        self.proc_path = proc_path
+        self._inode_pid = {}
+
+    def _read_sockets(self, filename, protocol, listen_state):
+        """ Return a mapping inode => (protocol, address, port)
+        """
+        sockets = {}
+        path = os.path.join(self.proc_path, 'net', filename)
+        try:
+            with open(path) as fd:
+                lines = fd.readlines()
+        except (IOError, OSError) as exc:
+            if exc.errno == errno.ENOENT:
+                # e.g. IPv6 is disabled
+                return sockets
+            raise
+
+        for line in lines[1:]:
+            # sl local_address rem_address st tx_queue:rx_queue tr:tm->when
+            # retrnsmt uid timeout inode ...
+            fields = line.split()
+            if len(fields) < 10 or fields[3] != listen_state:
+                continue
+            if protocol == 'udp' and fields[2].split(':')[1] != '0000':
+                # connected UDP socket, it's a client
+                continue
+            inode = int(fields[9])
+            if inode == 0:
+                continue
+            (address, port) = decode_address(fields[1])
+            sockets[inode] = (protocol, address, port)
+        return sockets
+
+    def _find_owners(self, inodes):
+        """ Update the inode to PID cache for given inodes
+        """
+        missing = set(inodes)
+        for name in os.listdir(self.proc_path):
+            if not missing:
+                break
+            if not name.isdigit():
+                continue
+            fd_path = os.path.join(self.proc_path, name, 'fd')
+            try:
+                fds = os.listdir(fd_path)
+            except OSError:
+                # process terminated or permission denied
+                continue
+            for fd_name in fds:
+                try:
+                    target = os.readlink(os.path.join(fd_path, fd_name))
+                except OSError:
+                    continue
+                if not target.startswith('socket:['):
+                    continue
+                inode = int(target[8:-1])
+                if inode in missing:
+                    self._inode_pid[inode] = int(name)
+                    missing.discard(inode)
+
+        # Owner not visible (e.g. permission denied), don't search it again
+        for inode in missing:
+            self._inode_pid[inode] = None
+
+    def get_listening_sockets(self):
+        """ Return a list of (pid, protocol, address, port)
+
+            protocol is either "tcp" or "udp". pid is None if the owner
+            of the socket was not found (e.g. permission denied on
+            /proc/<pid>/fd).
+        """
+        sockets = {}
+        sockets.update(self._read_sockets('tcp', 'tcp', TCP_LISTEN))
+        sockets.update(self._read_sockets('tcp6', 'tcp', TCP_LISTEN))
+        sockets.update(self._read_sockets('udp', 'udp', UDP_UNCONNECTED))
+        sockets.update(self._read_sockets('udp6', 'udp', UDP_UNCONNECTED))
+
+        # Forget sockets which are closed
+        for inode in list(self._inode_pid):
+            if inode not in sockets:
+                del self._inode_pid[inode]
+
+        missing = [inode for inode in sockets if inode not in self._inode_pid]
+        if missing:
+            self._find_owners(missing)
+
+        return [
+            (self._inode_pid.get(inode), protocol, address, port)
+            for (inode, (protocol, address, port)) in sockets.items()
+        ]
@@ -0,0 +1,588 @@
+#
+#  Copyright 2015-2016 Bleemeo
+#
+#  bleemeo.com an infrastructure monitoring solution in the Cloud
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import asyncio
+import os
+import shutil
+import socket
+import ssl
+import struct
+import subprocess
+import threading
+import time
+
+import pytest
+
+import bleemeo_agent.checker
+import bleemeo_agent.config
+
+
+class FakeCore:
+    def __init__(self):
+        self.config = bleemeo_agent.config.Config()
+        self.check_runner = None
+        self.socket_supervisor = None
+        self.services = {}
+        self.metrics = []
+        self.runs = []
+        self.skips = []
+        self.triggered = threading.Event()
+        self.intervals = []
+
+    def add_scheduled_job(self, func, seconds, **kwargs):
+        return None
+
+    def unschedule_job(self, job):
+        pass
+
+    def discard_job_stats(self, name):
+        pass
+
+    def reschedule_job(self, job, seconds):
+        self.intervals.append(seconds)
+        return job
+
+    def trigger_job(self, job):
+        self.triggered.set()
+        return job
+
+    def emit_metric(self, metric):
+        self.metrics.append(metric)
+
+    def record_job_run(self, name, interval, duration):
+        self.runs.append(name)
+
+    def record_job_skip(self, name, interval):
+        self.skips.append(name)
+
+
+def _tcp_server(response=None):
+    """ Start a TCP server accepting one connection. Return its port
+    """
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def serve():
+        (conn, _) = server.accept()
+        if response is not None:
+            conn.sendall(response)
+        conn.recv(4096)
+        conn.close()
+        server.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+
+def _create_check(core, service_info):
+    core.services[('custom_test', None)] = {}
+    check = bleemeo_agent.checker.Check(
+        core, 'custom_test', None, service_info,
+    )
+    check.service_info['disable_persistent_socket'] = True
+    return check
+
+
+def test_check_tcp():
+    core = FakeCore()
+    port = _tcp_server(b'+OK ready\r\n')
+    check = _create_check(core, {
+        'address': '127.0.0.1',
+        'port': port,
+        'protocol': socket.IPPROTO_TCP,
+        'check_tcp_expect': '+OK',
+    })
+
+    check.runner.submit(check).result(timeout=10)
+    assert len(core.metrics) == 2
+    assert core.metrics[0]['measurement'] == 'custom_test_status'
+    assert core.metrics[0]['status'] == 'ok'
+    assert core.metrics[0]['check_output'].startswith('TCP OK')
+    assert core.metrics[1]['measurement'] == 'custom_test_response_time'
+    # response time is the one shown in check output
+    assert core.metrics[0]['check_output'] == (
+        'TCP OK - %.3f second response time' % core.metrics[1]['value']
+    )
+    assert core.runs == ['check_custom_test']
+
+
+def test_check_tcp_refused():
+    core = FakeCore()
+    # Bind a port without listening on it, connection will be refused
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    try:
+        check = _create_check(core, {
+            'address': '127.0.0.1',
+            'port': port,
+            'protocol': socket.IPPROTO_TCP,
+        })
+        check.runner.submit(check).result(timeout=10)
+    finally:
+        sock.close()
+
+    # No response time for failed probes
+    assert len(core.metrics) == 1
+    assert core.metrics[0]['status'] == 'critical'
+    assert core.metrics[0]['check_output'] == (
+        'TCP port %d, Connection refused' % port
+    )
+
+
+def test_check_extra_ports(monkeypatch):
+    core = FakeCore()
+    check = _create_check(core, {
+        'extra_ports': {
+            '8001/tcp': '127.0.0.1',
+            '8002/tcp': '127.0.0.1',
+            '8003/tcp': '127.0.0.1',
+        },
+    })
+    monkeypatch.setattr(bleemeo_agent.checker, 'EXTRA_PORTS_DEADLINE', 0.5)
+
+    @bleemeo_agent.checker.coroutine
+    def fake_check_tcp(address=None, port=None):
+        # Port 8002 is filtered, probe never complete
+        if port == 8002:
+            yield from asyncio.sleep(60)
+        return (bleemeo_agent.checker.STATUS_OK, 'TCP OK on %d' % port)
+
+    check.check_tcp = fake_check_tcp
+
+    start = time.time()
+    check.runner.submit(check).result(timeout=10)
+    # all probes run concurrently under one deadline
+    assert time.time() - start < 5
+
+    assert len(core.metrics) == 1
+    assert core.metrics[0]['status'] == 'critical'
+    assert core.metrics[0]['check_output'] == (
+        'TCP port 8002, connection timed out after 0.5 seconds'
+    )
+
+
+def test_socket_supervisor():
+    core = FakeCore()
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    check = _create_check(core, {
+        'address': '127.0.0.1',
+        'port': port,
+        'protocol': socket.IPPROTO_TCP,
+    })
+    check.service_info['disable_persistent_socket'] = False
+    check.open_sockets()
+    (conn, _) = server.accept()
+    assert check.tcp_sockets[('127.0.0.1', port)] is not None
+
+    # Server close the connection, the check must be run again
+    conn.close()
+    server.close()
+    assert core.triggered.wait(5)
+    assert check.tcp_sockets[('127.0.0.1', port)] is None
+
+
+def test_response_time_percentiles():
+    core = FakeCore()
+    core.config.set('check.response_time_window', 10)
+    core.config.set('check.response_time_percentiles', [50, 90])
+    check = _create_check(core, {
+        'address': '127.0.0.1',
+        'port': 1,
+        'protocol': socket.IPPROTO_TCP,
+    })
+
+    for value in range(20):
+        core.metrics = []
+        check.process_result(
+            time.time(), bleemeo_agent.checker.STATUS_OK, 'OK', value,
+        )
+
+    values = dict(
+        (metric['measurement'], metric['value'])
+        for metric in core.metrics
+    )
+    # only the last 10 runs (values 10 to 19) are in the window
+    assert values == {
+        'custom_test_status': 0.0,
+        'custom_test_response_time': 19,
+        'custom_test_response_time_p50': 14,
+        'custom_test_response_time_p90': 18,
+    }
+
+
+def test_get_check_interval():
+    ok = bleemeo_agent.checker.STATUS_OK
+    critical = bleemeo_agent.checker.STATUS_CRITICAL
+
+    def interval(current, return_codes, stopped=False):
+        return bleemeo_agent.checker.get_check_interval(
+            current, return_codes, stopped, 15, 300,
+        )
+
+    # stable checks back off
+    assert interval(60, [ok, ok, ok]) == 120
+    assert interval(240, [ok, ok, ok]) == 300
+    assert interval(15, [ok]) == 30
+    # failing and flapping checks run more often
+    assert interval(300, [ok, ok, critical]) == 15
+    assert interval(300, [ok, critical, ok]) == 15
+    # stopped containers
+    assert interval(15, [critical], stopped=True) == 300
+
+
+def test_adaptive_interval():
+    core = FakeCore()
+    core.config.set('check.adaptive_interval', True)
+    core.config.set('check.max_interval', 200)
+    check = _create_check(core, {
+        'address': '127.0.0.1',
+        'port': 1,
+        'protocol': socket.IPPROTO_TCP,
+    })
+
+    for return_code in [0, 0, 0, 2, 2, 0, 0, 0, 0, 0, 0, 0]:
+        check.process_result(time.time(), return_code, '')
+
+    # after a failure, the check is considered flapping until
+    # CHECK_FLAPPING_RUNS successful runs
+    assert core.intervals == [120, 200, 15, 30, 60, 120]
+
+
+class RecreatingJobsCore(FakeCore):
+    """ FakeCore where trigger and reschedule replace the job, like
+        APScheduler 2.x does
+    """
+    def __init__(self):
+        super(RecreatingJobsCore, self).__init__()
+        self.jobs = set()
+        self.errors = []
+
+    def add_scheduled_job(self, func, seconds, **kwargs):
+        job = object()
+        if seconds:
+            # Only track the check recurring job, not open_sockets
+            self.jobs.add(job)
+        return job
+
+    def _replace_job(self, job):
+        try:
+            self.jobs.remove(job)
+        except KeyError:
+            self.errors.append(job)
+            raise
+        # Leave time to other threads to use the removed job
+        time.sleep(0.001)
+        return self.add_scheduled_job(None, 60)
+
+    def trigger_job(self, job):
+        return self._replace_job(job)
+
+    def reschedule_job(self, job, seconds):
+        return self._replace_job(job)
+
+    def unschedule_job(self, job):
+        self.jobs.discard(job)
+
+
+def test_concurrent_job_changes():
+    core = RecreatingJobsCore()
+    core.config.set('check.adaptive_interval', True)
+    check = _create_check(core, {
+        'address': '127.0.0.1',
+        'port': 1,
+        'protocol': socket.IPPROTO_TCP,
+    })
+
+    def trigger():
+        for _ in range(20):
+            check._trigger_job()
+
+    def reschedule():
+        for return_code in [2, 0] * 10:
+            check.process_result(time.time(), return_code, '')
+
+    threads = [
+        threading.Thread(target=trigger),
+        threading.Thread(target=trigger),
+        threading.Thread(target=reschedule),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert core.errors == []
+    assert core.jobs == set([check.current_job])
+
+    check.stop()
+    check._trigger_job()
+    assert core.jobs == set()
+
+
+def test_update_checks(monkeypatch):
+    monkeypatch.setattr(bleemeo_agent.checker, 'CHECKS', {})
+    core = FakeCore()
+    core.services = {
+        ('apache', None): {
+            'address': '127.0.0.1',
+            'port': 80,
+            'protocol': socket.IPPROTO_TCP,
+            'stack': 'web',
+        },
+    }
+    bleemeo_agent.checker.update_checks(core)
+    check = bleemeo_agent.checker.CHECKS[('apache', None)]
+    assert check.service_info['check_type'] == 'http'
+    # CHECKS_INFO must not be modified by checks
+    assert bleemeo_agent.checker.CHECKS_INFO['apache'] == {
+        'check_type': 'http',
+    }
+
+    # Change unrelated to the probe reuse the check
+    core.services[('apache', None)]['stack'] = 'frontend'
+    bleemeo_agent.checker.update_checks(core)
+    assert bleemeo_agent.checker.CHECKS[('apache', None)] is check
+    assert check.service_info['stack'] == 'frontend'
+
+    core.services[('apache', None)]['port'] = 8080
+    bleemeo_agent.checker.update_checks(core)
+    assert bleemeo_agent.checker.CHECKS[('apache', None)] is not check
+
+    core.services[('apache', None)]['active'] = False
+    bleemeo_agent.checker.update_checks(core)
+    assert bleemeo_agent.checker.CHECKS == {}
+
+
+def _mysql_packet(payload):
+    return struct.pack('<I', len(payload))[:3] + b'\x00' + payload
+
+
+def _mongodb_reply(document):
+    body = struct.pack('<iqii', 0, 0, 0, 1) + document
+    return struct.pack('<iiii', 16 + len(body), 2, 1, 1) + body
+
+
+def _bson_document(elements):
+    return struct.pack('<i', len(elements) + 5) + elements + b'\x00'
+
+
+def test_parse_bson_fields():
+    document = _bson_document(
+        b'\x08ismaster\x00\x01'
+        + b'\x02msg\x00' + struct.pack('<i', 4) + b'abc\x00'
+        + b'\x03sub\x00' + _bson_document(b'\x10a\x00' + b'\x01\x00\x00\x00')
+        + b'\x10maxWireVersion\x00' + struct.pack('<i', 17)
+        + b'\x01ok\x00' + struct.pack('<d', 1.0)
+    )
+    assert bleemeo_agent.checker.parse_bson_fields(document) == {
+        'ismaster': True,
+        'maxWireVersion': 17,
+        'ok': 1.0,
+    }
+
+
+def test_check_protocol():
+    mongodb_ok = _bson_document(
+        b'\x08ismaster\x00\x01' + b'\x01ok\x00' + struct.pack('<d', 1.0)
+    )
+    mongodb_failed = _bson_document(b'\x01ok\x00' + struct.pack('<d', 0.0))
+    cases = [
+        (
+            'mysql',
+            _mysql_packet(b'\x0a8.0.32\x00' + b'\x00' * 40),
+            'ok',
+            'MySQL OK',
+        ),
+        (
+            'mysql',
+            _mysql_packet(
+                b'\xff' + struct.pack('<H', 1040) + b'Too many connections'
+            ),
+            'critical',
+            'MySQL error 1040: Too many connections',
+        ),
+        ('mongodb', _mongodb_reply(mongodb_ok), 'ok', 'MongoDB OK'),
+        (
+            'mongodb',
+            _mongodb_reply(mongodb_failed),
+            'critical',
+            'MongoDB isMaster command failed',
+        ),
+    ]
+
+    for (service, response, status, output) in cases:
+        core = FakeCore()
+        port = _tcp_server(response)
+        core.services[(service, None)] = {}
+        check = bleemeo_agent.checker.Check(core, service, None, {
+            'address': '127.0.0.1',
+            'port': port,
+            'protocol': socket.IPPROTO_TCP,
+            'disable_persistent_socket': True,
+        })
+        check.runner.submit(check).result(timeout=10)
+
+        assert core.metrics[0]['status'] == status
+        assert core.metrics[0]['check_output'].startswith(output)
+
+
+def _postgresql_server(response, certfile=None):
+    """ Start a server answering one PostgreSQL SSLRequest
+
+        Return (port, events), events is filled with what the server saw
+        after the response: "handshake" and "clean eof" or "reset".
+    """
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    events = []
+
+    def serve():
+        (conn, _) = server.accept()
+        conn.settimeout(5)
+        assert conn.recv(8) == bleemeo_agent.checker.POSTGRESQL_SSL_REQUEST
+        conn.sendall(response)
+        try:
+            if not response:
+                return
+            if certfile is not None:
+                context = ssl.SSLContext(
+                    getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23)
+                )
+                context.load_cert_chain(certfile)
+                conn = context.wrap_socket(conn, server_side=True)
+                events.append('handshake')
+            if conn.recv(4096) == b'':
+                events.append('clean eof')
+        except (ssl.SSLError, socket.error):
+            events.append('reset')
+        finally:
+            conn.close()
+            server.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return (server.getsockname()[1], events, thread)
+
+
+def test_check_postgresql(tmpdir):
+    cases = [
+        (b'N', None, 'ok', 'PostgreSQL OK'),
+        (b'', None, 'critical', 'Connection closed'),
+        (b'E', None, 'critical', 'Unexpected response: E'),
+    ]
+    if shutil.which('openssl') is not None:
+        certfile = str(tmpdir.join('server.pem'))
+        subprocess.check_call(
+            [
+                'openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                '-nodes', '-subj', '/CN=localhost', '-days', '1',
+                '-keyout', certfile, '-out', certfile,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        cases.append((b'S', certfile, 'ok', 'PostgreSQL OK'))
+
+    for (response, certfile, status, output) in cases:
+        core = FakeCore()
+        (port, events, thread) = _postgresql_server(response, certfile)
+        core.services[('postgresql', None)] = {}
+        check = bleemeo_agent.checker.Check(core, 'postgresql', None, {
+            'address': '127.0.0.1',
+            'port': port,
+            'protocol': socket.IPPROTO_TCP,
+            'disable_persistent_socket': True,
+        })
+        check.runner.submit(check).result(timeout=10)
+        thread.join(10)
+
+        assert core.metrics[0]['status'] == status
+        assert core.metrics[0]['check_output'].startswith(output)
+        if certfile is not None:
+            # The server sees a completed handshake and a clean close,
+            # PostgreSQL doesn't log such connection.
+            assert events == ['handshake', 'clean eof']
+
+    if len(cases) == 3:
+        pytest.skip('openssl is needed to test the SSL handshake')
+
+
+def _ntp_server(count):
+    """ Start an UDP server answering count NTP requests. Return its port
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+
+    def serve():
+        for _ in range(count):
+            (request, addr) = server.recvfrom(48)
+            now = int(time.time()) + 2208988800
+            response = (
+                struct.pack('!BBBB', 0x24, 2, 0, 0)
+                + b'\x00' * 20
+                + request[40:48]  # originate timestamp
+                + struct.pack('!II', now, 0)  # receive timestamp
+                + struct.pack('!II', now, 0)  # transmit timestamp
+            )
+            server.sendto(response, addr)
+        server.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+
+def test_check_ntp():
+    core = FakeCore()
+    port = _ntp_server(6)
+    checks = []
+    for index in range(3):
+        core.services[('ntp', str(index))] = {}
+        checks.append(bleemeo_agent.checker.Check(core, 'ntp', str(index), {
+            'address': '127.0.0.1',
+            'port': port,
+            'protocol': socket.IPPROTO_UDP,
+        }))
+
+    fd_count = len(os.listdir('/proc/self/fd'))
+    for _ in range(2):
+        futures = [check.runner.submit(check) for check in checks]
+        for future in futures:
+            future.result(timeout=10)
+
+    status = [
+        (metric['item'], metric['status'])
+        for metric in core.metrics
+        if metric['measurement'] == 'ntp_status'
+    ]
+    assert sorted(status) == sorted([
+        (str(index), 'ok') for index in range(3)
+    ] * 2)
+    # All requests use the shared UDP socket
+    assert len(os.listdir('/proc/self/fd')) <= fd_count + 1
@@ -16,9 +16,21 @@
 #   limitations under the License.
 #
 
+import errno
+import shlex
 import socket
+import sys
+import threading
+import time
 
+import pytest
+
+import bleemeo_agent.config
 import bleemeo_agent.core
+import bleemeo_agent.util
+
+if sys.platform.startswith('linux'):
+    import bleemeo_agent.procfs
 
 # List of process cmdline and the expected service type
 PROCESS_SERVICE = [
@@ -301,6 +313,51 @@ def test_get_service_info():
             assert result['service'] == service
 
 
+def test_get_service_info_argv():
+    for (cmdline, service) in PROCESS_SERVICE:
+        result = bleemeo_agent.core.get_service_info(shlex.split(cmdline))
+        if service is None:
+            assert result is None, 'Found a service for cmdline %s' % cmdline
+        elif result is None:
+            assert False, 'Expected service %s' % service
+        else:
+            assert result['service'] == service
+
+    # Process which rewrote its argv[0], e.g. redis
+    result = bleemeo_agent.core.get_service_info(['redis-server *:6379'])
+    assert result['service'] == 'redis'
+
+    assert bleemeo_agent.core.get_service_info([]) is None
+    assert bleemeo_agent.core.get_service_info(['']) is None
+    assert bleemeo_agent.core.get_service_info('') is None
+
+
+def test_get_service_info_many_processes(monkeypatch):
+    """ Match 5000 synthetic processes without any shlex parsing
+    """
+    def no_shlex(*args, **kwargs):
+        raise AssertionError('shlex must not be used during matching')
+
+    monkeypatch.setattr(shlex, 'split', no_shlex)
+    monkeypatch.setattr(shlex, 'quote', no_shlex)
+
+    processes = []
+    for index in range(5000):
+        (cmdline, service) = PROCESS_SERVICE[index % len(PROCESS_SERVICE)]
+        processes.append((cmdline.split(), service))
+
+    found = 0
+    for (argv, service) in processes:
+        result = bleemeo_agent.core.get_service_info(argv)
+        if service is None:
+            assert result is None
+        else:
+            assert result['service'] == service
+            found += 1
+
+    assert found > 4000
+
+
 def test_sanitize_service():
     sanitize_service = bleemeo_agent.core.sanitize_service
 
@@ -434,3 +491,734 @@ def test_decode_docker_top():
         # result[0][0] is a PID, e.g. a number
         int(result[0][0])
         assert result[0][1].startswith('python3')
+
+
+def test_job_statistics():
+    stats = bleemeo_agent.core.JobStatistics('update_discovery', 10)
+    assert stats.percentile(50) is None
+    assert stats.mean_duration is None
+
+    assert not stats.record_run(0.05)
+    assert not stats.record_run(0.2)
+    assert not stats.record_run(0.3)
+    assert stats.record_run(12)
+    stats.record_skip()
+
+    assert stats.run_count == 4
+    assert stats.overrun_count == 1
+    assert stats.skipped_count == 1
+    assert stats.max_duration == 12
+    assert stats.last_duration == 12
+    assert stats.percentile(25) == 0.1
+    assert stats.percentile(50) == 0.5
+    assert stats.percentile(100) == 30
+
+    (run_count, mean_duration, overrun, skipped, durations) = (
+        stats.pop_period((50, 99))
+    )
+    assert run_count == 4
+    assert abs(mean_duration - 12.55 / 4) < 0.0001
+    assert overrun == 1
+    assert skipped == 1
+    assert durations == {50: 0.5, 99: 30}
+
+    # pop_period reset the period but not global counter
+    assert stats.pop_period((50, 99)) == (0, None, 0, 0, {})
+    assert stats.run_count == 4
+
+    snapshot = stats.snapshot(percentiles=(95,))
+    assert snapshot['name'] == 'update_discovery'
+    assert snapshot['run_count'] == 4
+    assert snapshot['skipped_count'] == 1
+    assert abs(snapshot['mean_duration'] - 12.55 / 4) < 0.0001
+    assert snapshot['percentiles'] == {95: 30}
+    assert bleemeo_agent.core.JobStatistics('x', 10).snapshot(
+        percentiles=(95,),
+    )['percentiles'] == {95: None}
+
+    # A job without interval (one-shot job) never overrun
+    stats = bleemeo_agent.core.JobStatistics('open_sockets', 0)
+    assert not stats.record_run(3600)
+    assert stats.percentile(99) == float('inf')
+    # Above the last bucket, the period maximum is used
+    assert stats.pop_period((99,))[4] == {99: 3600}
+
+
+def test_reschedule_job_statistics():
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    job = core.add_scheduled_job(
+        lambda: None, seconds=60, name='check_apache',
+    )
+    job = core.reschedule_job(job, 10)
+
+    stats = core.jobs_stats['check_apache']
+    assert stats.interval == 10
+    assert stats.record_run(12)
+    core.unschedule_job(job)
+    assert 'check_apache' not in core.jobs_stats
+
+
+def test_emit_jobs_stats():
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    metrics = []
+    core.emit_metric = metrics.append
+
+    job1 = core.add_scheduled_job(
+        lambda: None, seconds=0, next_run_in=5, name='open_sockets',
+    )
+    job2 = core.add_scheduled_job(
+        lambda: None, seconds=0, next_run_in=5, name='open_sockets',
+    )
+    for duration in (0.05, 0.05, 0.3, 2):
+        core.record_job_run('open_sockets', 0, duration)
+
+    core._emit_jobs_stats()
+    values = dict(
+        (metric['measurement'], metric['value']) for metric in metrics
+    )
+    assert values['agent_job_duration_p50'] == 0.1
+    assert values['agent_job_duration_p90'] == 5
+    assert values['agent_job_duration_p99'] == 5
+    assert values['agent_job_overrun'] == 0
+
+    # Statistics are shared by both jobs
+    core.unschedule_job(job1)
+    assert 'open_sockets' in core.jobs_stats
+    core.unschedule_job(job2)
+    assert 'open_sockets' not in core.jobs_stats
+
+
+def test_get_job_offset():
+    get_job_offset = bleemeo_agent.core.get_job_offset
+
+    # Offset is deterministic
+    assert (
+        get_job_offset('check_apache', 60)
+        == get_job_offset('check_apache', 60)
+    )
+
+    offsets = set()
+    for index in range(50):
+        offset = get_job_offset('check_service%d' % index, 60)
+        assert 0 <= offset < 60
+        offsets.add(int(offset / 10))
+
+    # 50 checks are spread over the 6 slots of 10 seconds
+    assert len(offsets) == 6
+
+    assert get_job_offset('one-shot', 0) == 0.0
+
+
+def test_spread_job_added_before_scheduler_start(monkeypatch):
+    """ A spread job whose first run date passed before the scheduler
+        started must run, not be skipped
+    """
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    monkeypatch.setattr(
+        bleemeo_agent.core, 'get_aligned_delay', lambda *args: 0,
+    )
+    ran = threading.Event()
+    job = core.add_scheduled_job(
+        ran.set, seconds=60, name='check_apache', spread=True,
+    )
+    assert job.misfire_grace_time == 60
+
+    # e.g. the first discovery took some time
+    time.sleep(1.5)
+    core._scheduler.start()
+    try:
+        assert ran.wait(5)
+        assert core.jobs_stats['check_apache'].skipped_count == 0
+    finally:
+        core._scheduler.shutdown(wait=False)
+
+
+def test_get_aligned_delay():
+    get_aligned_delay = bleemeo_agent.core.get_aligned_delay
+
+    assert get_aligned_delay(1000, 10, 0) == 0
+    assert get_aligned_delay(1001, 10, 0) == 9
+    assert get_aligned_delay(1001, 10, 3.5) == 2.5
+    assert get_aligned_delay(1004, 10, 3.5) == 9.5
+    assert get_aligned_delay(1000, 60, 59) == 19
+
+
+class FakeDockerClient:
+    """ Minimal docker client returning fixed containers and processes
+    """
+    def __init__(self, containers):
+        # containers is a mapping name => list of (pid, cmdline)
+        self._containers = containers
+        self.states = {}
+        self.top_calls = []
+        self.inspect_calls = []
+
+    def containers(self, all=False):
+        return [
+            {
+                'Id': 'id-%s' % name,
+                'Names': ['/%s' % name],
+                'State': self.states.get(name, 'running'),
+            }
+            for name in self._containers
+        ]
+
+    def inspect_container(self, container_id):
+        name = container_id.replace('id-', '', 1)
+        self.inspect_calls.append(name)
+        return {
+            'Id': 'id-%s' % name,
+            'Name': '/%s' % name,
+            'State': {'Status': self.states.get(name, 'running')},
+            'Config': {'Labels': {}},
+        }
+
+    def top(self, container_name):
+        self.top_calls.append(container_name)
+        return {
+            'Titles': ['PID', 'CMD'],
+            'Processes': [
+                [str(pid), cmdline]
+                for (pid, cmdline) in self._containers[container_name]
+            ],
+        }
+
+
+def _fake_process(pid, cmdline, create_time=1000.0):
+    return {
+        'pid': pid,
+        'create_time': create_time,
+        'cmdline': cmdline,
+        'argv': cmdline.split(),
+        'exe': cmdline.split()[0],
+    }
+
+
+def test_incremental_processes_map(monkeypatch):
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    core.thresholds = {}
+    core.docker_client = FakeDockerClient({
+        'db': [(20, '/usr/sbin/mysqld')],
+    })
+
+    host_processes = [
+        _fake_process(1, '/sbin/init'),
+        _fake_process(10, '/usr/sbin/apache2 -k start'),
+        _fake_process(20, '/usr/sbin/mysqld'),
+    ]
+    monkeypatch.setattr(
+        bleemeo_agent.util,
+        'get_top_info',
+        lambda core: {'time': 0, 'processes': list(host_processes)},
+    )
+    # Always use a new process snapshot
+    monkeypatch.setattr(bleemeo_agent.core, 'DISCOVERY_TOP_INFO_MAX_AGE', 0)
+    matched = []
+
+    def get_service_info(cmdline):
+        matched.append(' '.join(cmdline))
+        return original_get_service_info(cmdline)
+
+    original_get_service_info = bleemeo_agent.core.get_service_info
+    monkeypatch.setattr(
+        bleemeo_agent.core, 'get_service_info', get_service_info,
+    )
+
+    full = core._get_processes_map()
+    assert full[10]['instance'] is None
+    assert full[10]['service_info']['service'] == 'apache'
+    assert full[20]['instance'] == 'db'
+    assert full[20]['service_info']['service'] == 'mysql'
+    assert core.docker_client.top_calls == ['db']
+    assert len(matched) == 3
+
+    # Nothing changed: no process matched and no docker top
+    del matched[:]
+    incremental = core._get_processes_map(incremental=True)
+    assert incremental == full
+    assert matched == []
+    assert core.docker_client.top_calls == ['db']
+
+    # A new process which isn't a service and a PID reused by a new process
+    host_processes.append(_fake_process(30, '/bin/bash'))
+    host_processes[0] = _fake_process(1, '/usr/sbin/ntpd', create_time=2000)
+    incremental = core._get_processes_map(incremental=True)
+    assert sorted(matched) == ['/bin/bash', '/usr/sbin/ntpd']
+    assert incremental[1]['service_info']['service'] == 'ntp'
+    # ntpd may run in a container, so docker top is done again
+    assert core.docker_client.top_calls == ['db', 'db']
+
+    # A process that vanished is dropped
+    del host_processes[1]
+    incremental = core._get_processes_map(incremental=True)
+    assert 10 not in incremental
+    assert incremental[20]['instance'] == 'db'
+
+    # A process which exec() keeps its PID and create_time
+    host_processes.append(_fake_process(40, '/bin/sh /docker-entrypoint.sh'))
+    incremental = core._get_processes_map(incremental=True)
+    assert incremental[40]['service_info'] is None
+    host_processes[-1] = _fake_process(40, '/usr/sbin/apache2 -k start')
+    incremental = core._get_processes_map(incremental=True)
+    assert incremental[40]['service_info']['service'] == 'apache'
+
+
+def test_incremental_processes_map_container_process_exit(monkeypatch):
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    core.thresholds = {}
+    core.docker_client = FakeDockerClient({
+        'db': [
+            (19, '/usr/bin/python /usr/bin/supervisord'),
+            (20, '/usr/sbin/mysqld'),
+        ],
+    })
+    host_processes = [
+        _fake_process(1, '/sbin/init'),
+        _fake_process(19, '/usr/bin/python /usr/bin/supervisord'),
+        _fake_process(20, '/usr/sbin/mysqld'),
+    ]
+    monkeypatch.setattr(
+        bleemeo_agent.util,
+        'get_top_info',
+        lambda core: {'time': 0, 'processes': list(host_processes)},
+    )
+    monkeypatch.setattr(bleemeo_agent.core, 'DISCOVERY_TOP_INFO_MAX_AGE', 0)
+
+    full = core._get_processes_map()
+    assert full[20]['instance'] == 'db'
+    assert full[20]['service_info']['service'] == 'mysql'
+
+    # mysqld exits but the container keeps running. docker top isn't
+    # done again and the cached container processes are reused.
+    del host_processes[2]
+    incremental = core._get_processes_map(incremental=True)
+    assert core.docker_client.top_calls == ['db']
+    assert 20 not in incremental
+    assert incremental[19]['instance'] == 'db'
+
+
+def test_get_top_info_stripped(monkeypatch):
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    core.emit_metric = lambda metric: None
+    snapshots = []
+
+    def get_top_info(core):
+        snapshots.append(None)
+        return {'time': 0, 'processes': [_fake_process(1, '/sbin/init')]}
+
+    monkeypatch.setattr(bleemeo_agent.util, 'get_top_info', get_top_info)
+
+    stripped = core.get_top_info(stripped=True)
+    assert 'argv' not in stripped['processes'][0]
+    assert 'argv' in core.top_info['processes'][0]
+
+    # The stripped view is shared while the snapshot is reused
+    assert core.get_top_info(max_age=60, stripped=True) is stripped
+    assert core.get_top_info(max_age=60) is core.top_info
+    assert len(snapshots) == 1
+
+    assert core.get_top_info(stripped=True) is not stripped
+    assert len(snapshots) == 2
+
+
+def test_adaptive_top_info(monkeypatch):
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    core.config.set('agent.top_info.adaptive', True)
+    triggers = []
+    monkeypatch.setattr(core, 'trigger', triggers.append)
+    sent = []
+    monkeypatch.setattr(
+        core,
+        'get_top_info',
+        lambda max_age, stripped: sent.append(max_age),
+    )
+    clock = [1000]
+    monkeypatch.setattr(bleemeo_agent.util, 'get_clock', lambda: clock[0])
+
+    def run_for(seconds):
+        """ Run the send_top_info job every 10 seconds for given duration
+        """
+        del sent[:]
+        for _ in range(seconds // 10):
+            core.send_top_info()
+            clock[0] += 10
+        return len(sent)
+
+    # Slow mode: first run then every 60 seconds
+    assert run_for(120) == 2
+
+    core.request_fast_top_info()
+    assert triggers == ['top_info']
+    # Already in fast mode, no new trigger
+    core.request_fast_top_info()
+    assert triggers == ['top_info']
+    assert run_for(300) == 30
+
+    # Fast mode expired
+    assert run_for(120) == 2
+
+    core.request_fast_top_info(30)
+    assert run_for(60) == 3
+
+
+def test_docker_inspect_cache():
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    core.docker_client = FakeDockerClient({
+        'db': [],
+        'web': [],
+    })
+
+    core._update_docker_info()
+    assert sorted(core.docker_client.inspect_calls) == ['db', 'web']
+    assert sorted(core.docker_containers) == ['db', 'web']
+
+    # Nothing changed, cache is used
+    core._update_docker_info()
+    assert len(core.docker_client.inspect_calls) == 2
+    assert core.get_docker_ports('web') == {}
+    assert len(core.docker_client.inspect_calls) == 2
+
+    # Exec events (sent by health checks) don't invalidate the cache
+    core._process_docker_events([{
+        'Type': 'container',
+        'Action': 'exec_start: ls',
+        'Actor': {'ID': 'id-db'},
+    }])
+    core._update_docker_info()
+    assert len(core.docker_client.inspect_calls) == 2
+
+    core._process_docker_events([{
+        'Type': 'container', 'Action': 'rename', 'Actor': {'ID': 'id-db'},
+    }])
+    core._update_docker_info()
+    assert core.docker_client.inspect_calls[2:] == ['db']
+
+    # State changed but event was missed
+    core.docker_client.states['web'] = 'exited'
+    core._update_docker_info()
+    assert core.docker_client.inspect_calls[3:] == ['web']
+    assert core.docker_containers['web']['State']['Status'] == 'exited'
+
+    # Removed container are forgotten
+    del core.docker_client._containers['web']
+    core._update_docker_info()
+    assert sorted(core.docker_containers) == ['db']
+    assert list(core._docker_inspect_cache) == ['id-db']
+
+    # An event received during docker inspect make its result stale
+    original_inspect = core.docker_client.inspect_container
+
+    def inspect_with_event(container_id):
+        result = original_inspect(container_id)
+        core._process_docker_events([{
+            'Type': 'container', 'Action': 'rename', 'Actor': {'ID': 'id-db'},
+        }])
+        return result
+
+    core.docker_client.inspect_container = inspect_with_event
+    core._process_docker_events([{
+        'Type': 'container', 'Action': 'rename', 'Actor': {'ID': 'id-db'},
+    }])
+    core._update_docker_info()
+    # Used by this discovery, but not cached
+    assert sorted(core.docker_containers) == ['db']
+    assert core._docker_inspect_cache == {}
+
+
+def test_docker_api_map():
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    core.config.set('docker.api_concurrency', 4)
+    core.config.set('docker.api_timeout', 0.5)
+    release = threading.Event()
+    running = []
+
+    def call(arg):
+        running.append(arg)
+        if arg == 'error':
+            raise ValueError('failed')
+        if arg == 'hang':
+            release.wait(5)
+        return arg * 2
+
+    args = ['a%d' % i for i in range(20)] + ['error', 'hang']
+    try:
+        start = time.time()
+        result = core._docker_api_map(call, args)
+        duration = time.time() - start
+    finally:
+        release.set()
+        core._docker_executor.shutdown()
+
+    assert result == {'a%d' % i: 'a%d' % i * 2 for i in range(20)}
+    assert sorted(running) == sorted(args)
+    assert duration < 2
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith('linux'), reason='cgroup are Linux only',
+)
+def test_processes_map_cgroup(monkeypatch):
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    core.config.set('docker.pid_resolver', 'cgroup')
+    core.thresholds = {}
+    core.docker_client = FakeDockerClient({
+        'db': [(20, '/usr/sbin/mysqld')],
+        'web': [(30, '/usr/sbin/apache2')],
+    })
+    host_processes = [
+        _fake_process(1, '/sbin/init'),
+        _fake_process(20, '/usr/sbin/mysqld'),
+        _fake_process(30, '/usr/sbin/apache2'),
+    ]
+    monkeypatch.setattr(
+        bleemeo_agent.util,
+        'get_top_info',
+        lambda core: {'time': 0, 'processes': list(host_processes)},
+    )
+    monkeypatch.setattr(bleemeo_agent.core, 'DISCOVERY_TOP_INFO_MAX_AGE', 0)
+    # apache2 just started and its cgroup isn't yet the container one
+    containers = {20: 'id-db'}
+    monkeypatch.setattr(
+        bleemeo_agent.procfs,
+        'get_container_id',
+        lambda pid: containers.get(pid),
+    )
+
+    processes = core._get_processes_map()
+    assert processes[1]['instance'] is None
+    assert processes[20]['instance'] == 'db'
+    assert processes[30]['instance'] == 'web'
+    # docker top is only used for the unresolved container
+    assert core.docker_client.top_calls == ['web']
+
+    # apache2 is now in its container cgroup, this isn't a cached negative
+    containers[30] = 'id-web'
+    del core.docker_client.top_calls[:]
+    processes = core._get_processes_map()
+    assert processes[30]['instance'] == 'web'
+    assert core.docker_client.top_calls == []
+
+    # cgroup of a process can't be read, docker top is used for it only
+    core.docker_client._containers['db'].append((21, '/usr/sbin/mysqld'))
+    host_processes.append(_fake_process(21, '/usr/sbin/mysqld'))
+
+    def get_container_id(pid):
+        if pid == 21:
+            raise IOError(errno.EACCES, 'Permission denied')
+        return containers.get(pid)
+
+    monkeypatch.setattr(
+        bleemeo_agent.procfs, 'get_container_id', get_container_id,
+    )
+    processes = core._get_processes_map()
+    assert processes[20]['instance'] == 'db'
+    assert processes[21]['instance'] == 'db'
+    assert processes[30]['instance'] == 'web'
+    assert sorted(core.docker_client.top_calls) == ['db', 'web']
+
+
+def test_trigger_before_job_scheduled(monkeypatch):
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    monkeypatch.setattr(bleemeo_agent.core, 'TRIGGER_DEBOUNCE_DELAY', 0.01)
+    monkeypatch.setattr(bleemeo_agent.core, 'TRIGGER_DEBOUNCE_MAX', 0.05)
+    triggered = []
+    done = threading.Event()
+
+    def trigger_job(job):
+        triggered.append(job)
+        if len(triggered) == 2:
+            done.set()
+        return job
+
+    monkeypatch.setattr(core, 'trigger_job', trigger_job)
+    core._update_facts_job = 'facts-job'
+
+    thread = threading.Thread(target=core._process_triggers)
+    thread.daemon = True
+    thread.start()
+    try:
+        core.trigger('discovery')
+        deadline = time.time() + 5
+        while not core._deferred_triggers and time.time() < deadline:
+            time.sleep(0.01)
+        assert core._deferred_triggers == set(['discovery'])
+        assert triggered == []
+
+        # discovery job is now scheduled, it runs with the next trigger
+        core._discovery_job = 'discovery-job'
+        core.trigger('facts')
+        assert done.wait(5)
+        assert sorted(triggered) == ['discovery-job', 'facts-job']
+    finally:
+        core.is_terminating.set()
+        core.trigger()
+
+
+def test_process_docker_events(monkeypatch):
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    core.services = {
+        ('nginx', 'web'): {'container_id': 'id-web', 'active': True},
+    }
+    triggers = []
+    monkeypatch.setattr(core, 'trigger', triggers.append)
+    health_checked = []
+    monkeypatch.setattr(
+        core,
+        '_docker_health_status',
+        lambda container_id: health_checked.append(container_id),
+    )
+
+    def event(action, container_id):
+        return {
+            'Type': 'container',
+            'Action': action,
+            'Actor': {'ID': container_id},
+        }
+
+    # A compose stack restart
+    events = []
+    for container_id in ('id-db', 'id-web', 'id-worker'):
+        events.append(event('die', container_id))
+        events.append(event('start', container_id))
+        events.append(event('health_status: starting', container_id))
+        events.append(event('health_status: healthy', container_id))
+    events.append(event('destroy', 'id-web'))
+    # Old Docker event format
+    events.append({'status': 'start', 'id': 'id-other'})
+
+    core._process_docker_events(events)
+    assert triggers == ['discovery']
+    assert sorted(health_checked) == ['id-db', 'id-worker']
+    assert not core.services[('nginx', 'web')]['active']
+
+    # Only health check exec, nothing to do
+    del triggers[:]
+    del health_checked[:]
+    core._process_docker_events([event('exec_start: curl', 'id-db')])
+    assert triggers == []
+    assert health_checked == []
+
+    # Some events were dropped
+    core._docker_inspect_cache['id-db'] = {}
+    core._process_docker_events([], overflow=True)
+    assert triggers == ['discovery']
+    assert core._docker_inspect_cache == {}
+
+
+def test_queue_docker_event():
+    core = bleemeo_agent.core.Core()
+    core._docker_events = bleemeo_agent.core.queue.Queue(2)
+
+    for _ in range(3):
+        core._queue_docker_event({'Action': 'start'})
+    assert core._docker_events.qsize() == 2
+    assert core._docker_events_overflow
+
+
+class FakeListenSocketReader:
+    def __init__(self, sockets):
+        self.sockets = sockets
+
+    def get_listening_sockets(self):
+        return self.sockets
+
+
+def test_get_netstat(tmpdir):
+    netstat_file = tmpdir.join('netstat.out')
+    netstat_file.write(
+        'tcp        0      0 0.0.0.0:22              0.0.0.0:*'
+        '               LISTEN      1234/sshd\n'
+    )
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    core.config.set('agent.netstat_file', str(netstat_file))
+
+    core._listen_socket_reader = FakeListenSocketReader([
+        (10, 'tcp', '0.0.0.0', 3306),
+        (10, 'tcp', '127.0.0.1', 3306),
+        (20, 'tcp', '::', 80),
+        (20, 'udp', '::1', 53),
+    ])
+    # All sockets have an owner, netstat.out isn't needed
+    assert core.get_netstat() == {
+        10: {'3306/tcp': '127.0.0.1'},
+        20: {'80/tcp': '0.0.0.0'},
+    }
+
+    core._listen_socket_reader.sockets.append((None, 'tcp', '0.0.0.0', 22))
+    assert core.get_netstat() == {
+        10: {'3306/tcp': '127.0.0.1'},
+        20: {'80/tcp': '0.0.0.0'},
+        1234: {'22/tcp': '0.0.0.0'},
+    }
+
+
+class FakeGraphiteServer:
+    def __init__(self):
+        self.update_discovery_calls = 0
+
+    def update_discovery(self):
+        self.update_discovery_calls += 1
+
+
+def test_fast_start(tmpdir, monkeypatch):
+    core = bleemeo_agent.core.Core()
+    core.config = bleemeo_agent.config.Config()
+    core.config.set('agent.fast_start', True)
+    core.state = bleemeo_agent.core.State(str(tmpdir.join('state.json')))
+    core.graphite_server = FakeGraphiteServer()
+    calls = []
+    monkeypatch.setattr(
+        core, 'update_facts', lambda: calls.append('facts'),
+    )
+    monkeypatch.setattr(
+        core,
+        'update_discovery',
+        lambda first_run=False: calls.append(('discovery', first_run)),
+    )
+
+    # Nothing in state, facts and discovery are done synchronously
+    core.schedule_tasks()
+    assert calls == ['facts', ('discovery', True)]
+    core._scheduler.remove_all_jobs()
+
+    del calls[:]
+    core.state.set('facts', {'fqdn': 'example.com'})
+    core.state.set_complex_dict('discovered_services', {})
+    core.schedule_tasks()
+    assert calls == []
+    assert core.last_facts == {'fqdn': 'example.com'}
+    assert core.services == {}
+    assert core.graphite_server.update_discovery_calls == 1
+    assert '_fast_start_refresh' in [
+        job.name for job in core._scheduler.get_jobs()
+    ]
+    core._scheduler.remove_all_jobs()
+
+    # Old service names are renamed before the scheduler starts, the
+    # refresh doesn't do it again
+    class FakeConnector:
+        services_uuid = {('imap', None): 'uuid-imap'}
+
+    core.bleemeo_connector = FakeConnector()
+    core.discovered_services = {('imap', None): {'active': True}}
+    core.schedule_tasks()
+    assert list(core.discovered_services) == [('dovecot', None)]
+    assert core.bleemeo_connector.services_uuid == {
+        ('dovecot', None): 'uuid-imap',
+    }
+
+    core._fast_start_refresh()
+    assert calls[-2:] == ['facts', ('discovery', False)]
@@ -0,0 +1,339 @@
+#
+#  Copyright 2015-2016 Bleemeo
+#
+#  bleemeo.com an infrastructure monitoring solution in the Cloud
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os
+import sys
+import time
+
+import psutil
+import pytest
+
+import bleemeo_agent.util
+
+if sys.platform.startswith('linux'):
+    import bleemeo_agent.procfs
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith('linux'), reason='/proc is Linux only',
+)
+
+BOOT_TIME = 1500000000
+
+# uid which is not defined in /etc/passwd
+UNKNOWN_UID = 4242421
+
+
+def _write_process(proc_path, pid, name, cmdline, state='S', uid=0):
+    pid_path = os.path.join(str(proc_path), str(pid))
+    os.mkdir(pid_path)
+    # pid (comm) state ppid pgrp session tty_nr tpgid flags minflt cminflt
+    # majflt cmajflt utime stime cutime cstime priority nice num_threads
+    # itrealvalue starttime vsize rss ...
+    stat = '%d (%s) %s 1 %d %d 0 -1 4194560 100 0 0 0 %d %d 0 0 20 0 1 0 ' \
+        '%d 10000000 %d 18446744073709551615 1 1 0 0 0 0 0 0 0 0 0 0 0 ' \
+        '0 0 0 0 0 0 0 0 0 0 0 0\n' % (
+            pid, name, state, pid, pid, pid * 3, pid, pid * 100, 20 + pid,
+        )
+    with open(os.path.join(pid_path, 'stat'), 'w') as fd:
+        fd.write(stat)
+    with open(os.path.join(pid_path, 'statm'), 'w') as fd:
+        fd.write('2441 %d 300 10 0 200 0\n' % (20 + pid))
+    with open(os.path.join(pid_path, 'status'), 'w') as fd:
+        fd.write(
+            'Name:\t%s\nState:\t%s\nPid:\t%d\nPPid:\t1\n'
+            'Uid:\t%d\t%d\t%d\t%d\nGid:\t0\t0\t0\t0\n' % (
+                name[:15], state, pid, uid, uid, uid, uid,
+            )
+        )
+    with open(os.path.join(pid_path, 'cmdline'), 'wb') as fd:
+        fd.write(cmdline)
+    os.symlink('/usr/bin/%s' % name.split()[0], os.path.join(pid_path, 'exe'))
+
+
+def _make_proc_tree(proc_path, count=0):
+    """ Create a synthetic /proc with a few special processes and count
+        generic processes
+    """
+    with open(os.path.join(str(proc_path), 'stat'), 'w') as fd:
+        fd.write(
+            'cpu  100 0 100 1000 0 0 0 0 0 0\n'
+            'cpu0 100 0 100 1000 0 0 0 0 0 0\n'
+            'btime %d\n' % BOOT_TIME
+        )
+    _write_process(
+        proc_path, 1, 'init', b'/sbin/init\0splash\0',
+    )
+    _write_process(
+        proc_path, 2, 'kthreadd', b'',
+    )
+    _write_process(
+        proc_path, 3, 'name (with) space', b'python3\0-c\0print("x y")\0',
+        state='R', uid=UNKNOWN_UID,
+    )
+    # Process that changed its title with setproctitle
+    _write_process(
+        proc_path, 4, 'postgres', b'postgres: checkpointer process   ',
+    )
+    # comm is truncated to 15 characters
+    _write_process(
+        proc_path, 5, 'very-long-proce', b'/opt/very-long-process-name\0',
+        state='Z',
+    )
+    for pid in range(10, 10 + count):
+        _write_process(
+            proc_path,
+            pid,
+            'worker',
+            b'/usr/bin/worker\0--id\0' + str(pid).encode() + b'\0',
+        )
+
+
+def _by_pid(processes):
+    return {x['pid']: x for x in processes}
+
+
+def test_process_reader(tmpdir):
+    _make_proc_tree(tmpdir)
+    reader = bleemeo_agent.procfs.ProcessReader(str(tmpdir))
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+
+    processes = _by_pid(reader.get_processes())
+    assert sorted(processes) == [1, 2, 3, 4, 5]
+
+    assert processes[1]['name'] == 'init'
+    assert processes[1]['argv'] == ['/sbin/init', 'splash']
+    assert processes[1]['cmdline'] == '/sbin/init splash'
+    assert processes[1]['username'] == 'root'
+    assert processes[1]['exe'] == '/usr/bin/init'
+    assert processes[1]['status'] == psutil.STATUS_SLEEPING
+    assert processes[1]['create_time'] == BOOT_TIME + 100 / clock_ticks
+    assert processes[1]['cpu_times'] == 4 / clock_ticks
+    assert processes[1]['memory_rss'] == 21 * page_size / 1024
+    assert processes[1]['cpu_percent'] == 0.0
+
+    # Kernel threads have no cmdline
+    assert processes[2]['argv'] == ['kthreadd']
+    assert processes[2]['cmdline'] == 'kthreadd'
+
+    assert processes[3]['name'] == 'name (with) space'
+    assert processes[3]['argv'] == ['python3', '-c', 'print("x y")']
+    assert processes[3]['cmdline'] == 'python3 -c \'print("x y")\''
+    assert processes[3]['username'] == str(UNKNOWN_UID)
+    assert processes[3]['status'] == psutil.STATUS_RUNNING
+
+    assert processes[4]['argv'] == [
+        'postgres:', 'checkpointer', 'process', '', '',
+    ]
+
+    assert processes[5]['name'] == 'very-long-process-name'
+    assert processes[5]['status'] == psutil.STATUS_ZOMBIE
+
+
+def test_process_reader_cpu_percent(tmpdir, monkeypatch):
+    _make_proc_tree(tmpdir)
+    reader = bleemeo_agent.procfs.ProcessReader(str(tmpdir))
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+
+    monkeypatch.setattr(time, 'time', lambda: 1000)
+    reader.get_processes()
+
+    # init used half a second of CPU in one second
+    with open(os.path.join(str(tmpdir), '1', 'stat')) as fd:
+        fields = fd.read().split()
+    fields[13] = str(int(fields[13]) + clock_ticks // 2)
+    with open(os.path.join(str(tmpdir), '1', 'stat'), 'w') as fd:
+        fd.write(' '.join(fields))
+
+    monkeypatch.setattr(time, 'time', lambda: 1001)
+    processes = _by_pid(reader.get_processes())
+    assert processes[1]['cpu_percent'] == 50.0
+    assert processes[2]['cpu_percent'] == 0.0
+
+
+def test_process_reader_terminated_process(tmpdir):
+    _make_proc_tree(tmpdir)
+    # Process terminated between listdir and read of its files
+    os.unlink(os.path.join(str(tmpdir), '3', 'statm'))
+    with open(os.path.join(str(tmpdir), '4', 'stat'), 'w') as fd:
+        fd.write('')
+
+    reader = bleemeo_agent.procfs.ProcessReader(str(tmpdir))
+    processes = _by_pid(reader.get_processes())
+    assert sorted(processes) == [1, 2, 5]
+
+
+def test_process_reader_same_as_psutil(tmpdir, monkeypatch):
+    """ Both readers must return the same processes on a synthetic /proc
+    """
+    if not hasattr(psutil, 'PROCFS_PATH'):
+        pytest.skip('psutil does not support PROCFS_PATH')
+
+    _make_proc_tree(tmpdir, count=50)
+    monkeypatch.setattr(psutil, 'PROCFS_PATH', str(tmpdir))
+    # psutil cache boot time
+    monkeypatch.setattr(psutil, 'boot_time', lambda: BOOT_TIME)
+    reader = bleemeo_agent.procfs.ProcessReader(str(tmpdir))
+
+    psutil_processes = _by_pid(bleemeo_agent.util._get_processes_psutil())
+    proc_processes = _by_pid(reader.get_processes())
+
+    assert sorted(proc_processes) == sorted(psutil_processes)
+    for pid, process in proc_processes.items():
+        expected = psutil_processes[pid]
+        for key in ('create_time', 'cpu_times', 'memory_rss'):
+            assert process.pop(key) == pytest.approx(expected.pop(key))
+        assert process == expected
+
+
+def test_process_reader_real_proc():
+    """ Compare with psutil on the running process
+    """
+    reader = bleemeo_agent.procfs.ProcessReader()
+    processes = _by_pid(reader.get_processes())
+    process = processes[os.getpid()]
+
+    expected = bleemeo_agent.util._get_process_info(psutil.Process())
+    assert process['argv'] == expected['argv']
+    assert process['cmdline'] == expected['cmdline']
+    assert process['name'] == expected['name']
+    assert process['username'] == expected['username']
+    assert process['exe'] == expected['exe']
+    assert process['create_time'] == pytest.approx(
+        expected['create_time'], abs=1,
+    )
+
+
+def test_get_container_id(tmpdir):
+    container_id = (
+        '6ad5b1ff1a3e4c25d6b3d2f2b2ec4b1e3fb2c1d3cf2a1e8d2c9b5b5e7a7b6c1d'
+    )
+    cgroups = {
+        # cgroup v1, cgroupfs driver
+        1: '12:pids:/docker/%s\n11:memory:/docker/%s\n' % (
+            container_id, container_id,
+        ),
+        # cgroup v2, systemd driver
+        2: '0::/system.slice/docker-%s.scope\n' % container_id,
+        # Kubernetes
+        3: '0::/kubepods/burstable/pod1234/%s\n' % container_id,
+        # Not in a container
+        4: '0::/user.slice/user-1000.slice/session-2.scope\n',
+        5: '12:pids:/\n11:memory:/user.slice\n',
+    }
+    for (pid, content) in cgroups.items():
+        os.mkdir(os.path.join(str(tmpdir), str(pid)))
+        with open(os.path.join(str(tmpdir), str(pid), 'cgroup'), 'w') as fd:
+            fd.write(content)
+
+    for pid in (1, 2, 3):
+        assert bleemeo_agent.procfs.get_container_id(
+            pid, str(tmpdir),
+        ) == container_id
+    for pid in (4, 5):
+        assert bleemeo_agent.procfs.get_container_id(
+            pid, str(tmpdir),
+        ) is None
+
+    with pytest.raises(IOError):
+        bleemeo_agent.procfs.get_container_id(6, str(tmpdir))
+
+
+def test_decode_address():
+    assert bleemeo_agent.procfs.decode_address('0100007F:1F90') == (
+        '127.0.0.1', 8080,
+    )
+    assert bleemeo_agent.procfs.decode_address('00000000:0016') == (
+        '0.0.0.0', 22,
+    )
+    assert bleemeo_agent.procfs.decode_address(
+        '00000000000000000000000000000000:0050'
+    ) == ('::', 80)
+    assert bleemeo_agent.procfs.decode_address(
+        '00000000000000000000000001000000:0050'
+    ) == ('::1', 80)
+
+
+def _write_net(proc_path, filename, sockets):
+    """ Write a /proc/net/{tcp,udp}{,6} file
+
+        sockets is a list of (local_address, remote_address, state, inode)
+    """
+    lines = [
+        '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when '
+        'retrnsmt   uid  timeout inode\n',
+    ]
+    for (index, (local, remote, state, inode)) in enumerate(sockets):
+        lines.append(
+            '%4d: %s %s %s 00000000:00000000 00:00000000 00000000     0 '
+            '       0 %d 1 0000000000000000 100 0 0 10 0\n' % (
+                index, local, remote, state, inode,
+            )
+        )
+    with open(os.path.join(str(proc_path), 'net', filename), 'w') as fd:
+        fd.write(''.join(lines))
+
+
+def test_listen_socket_reader(tmpdir):
+    os.mkdir(os.path.join(str(tmpdir), 'net'))
+    _write_net(tmpdir, 'tcp', [
+        ('0100007F:0CEA', '00000000:0000', '0A', 1001),
+        ('00000000:0050', '00000000:0000', '0A', 1002),
+        # An established connection
+        ('0100007F:0CEA', '0100007F:A2B4', '01', 1003),
+        # Owner isn't visible
+        ('00000000:0016', '00000000:0000', '0A', 1004),
+    ])
+    _write_net(tmpdir, 'tcp6', [
+        ('00000000000000000000000000000000:01BB', '00000000000000000000000000000000:0000', '0A', 1005),  # noqa
+    ])
+    _write_net(tmpdir, 'udp', [
+        ('00000000:007B', '00000000:0000', '07', 1006),
+        # A connected UDP client
+        ('0100007F:D431', '0100007F:0035', '01', 1007),
+    ])
+    # No udp6 file: IPv6 is disabled
+
+    owners = {
+        10: [1001, 1007],
+        20: [1002, 1005],
+        30: [1006],
+    }
+    for (pid, inodes) in owners.items():
+        fd_path = os.path.join(str(tmpdir), str(pid), 'fd')
+        os.makedirs(fd_path)
+        os.symlink('/dev/null', os.path.join(fd_path, '0'))
+        for (index, inode) in enumerate(inodes):
+            os.symlink(
+                'socket:[%d]' % inode, os.path.join(fd_path, str(index + 3)),
+            )
+
+    reader = bleemeo_agent.procfs.ListenSocketReader(str(tmpdir))
+    assert sorted(reader.get_listening_sockets(), key=str) == sorted([
+        (10, 'tcp', '127.0.0.1', 3306),
+        (20, 'tcp', '0.0.0.0', 80),
+        (20, 'tcp', '::', 443),
+        (30, 'udp', '0.0.0.0', 123),
+        (None, 'tcp', '0.0.0.0', 22),
+    ], key=str)
+
+    # Owners are cached, processes are not scanned again
+    os.rename(
+        os.path.join(str(tmpdir), '10'), os.path.join(str(tmpdir), '11'),
+    )
+    assert (10, 'tcp', '127.0.0.1', 3306) in reader.get_listening_sockets()
@@ -16,6 +16,11 @@
 #   limitations under the License.
 #
 
+import threading
+import time
+
+from six.moves import BaseHTTPServer as http_server
+
 import bleemeo_agent.util
 
 
@@ -37,3 +42,180 @@ def test_format_uptime():
     assert bleemeo_agent.util.format_uptime(float(2*60*60 + 5*60)) == '2 hours'
     assert bleemeo_agent.util.format_uptime(
         float(2*24*60*60 + 1*60*60 + 5)) == '2 days, 1 hour'
+
+
+def test_file_watcher(tmpdir):
+    filename = str(tmpdir.join('netstat.out'))
+    watcher = bleemeo_agent.util.FileWatcher(filename, poll_interval=0.1)
+    try:
+        assert not watcher.wait(0.1)
+
+        with open(filename, 'w') as fd:
+            fd.write('tcp 0 0 0.0.0.0:22 0.0.0.0:* LISTEN 42/sshd\n')
+
+        assert watcher.wait(1)
+
+        # Other files in the same directory are ignored
+        with open(str(tmpdir.join('other-file')), 'w') as fd:
+            fd.write('content')
+        assert not watcher.wait(0.1)
+    finally:
+        watcher.close()
+
+
+def test_diff_top_info():
+    def process(pid, create_time, cpu_percent=0.0, status='sleeping'):
+        return {
+            'pid': pid,
+            'create_time': create_time,
+            'cmdline': 'cmd%d' % pid,
+            'cpu_percent': cpu_percent,
+            'status': status,
+        }
+
+    previous = {
+        (1, 100): process(1, 100),
+        (2, 100): process(2, 100),
+        (3, 100): process(3, 100),
+    }
+    top_info = {
+        'time': 42,
+        'loads': [0.1, 0.2, 0.3],
+        'processes': [
+            process(1, 100),
+            process(2, 100, cpu_percent=12.5, status='running'),
+            # pid 3 was reused by a new process
+            process(3, 200),
+            process(4, 200),
+        ],
+    }
+    processes = {
+        bleemeo_agent.util.get_process_key(x): x
+        for x in top_info['processes']
+    }
+
+    delta = bleemeo_agent.util.diff_top_info(previous, processes, top_info)
+    assert 'processes' not in delta
+    assert delta['time'] == 42
+    assert delta['loads'] == [0.1, 0.2, 0.3]
+    assert sorted(delta['processes_added'], key=lambda x: x['pid']) == [
+        process(3, 200), process(4, 200),
+    ]
+    assert delta['processes_changed'] == [{
+        'pid': 2,
+        'create_time': 100,
+        'cpu_percent': 12.5,
+        'status': 'running',
+    }]
+    assert delta['processes_removed'] == [[3, 100]]
+
+
+def test_get_http_session(monkeypatch):
+    monkeypatch.setattr(bleemeo_agent.util, 'HTTP_SESSIONS_MAX', 2)
+    monkeypatch.setattr(bleemeo_agent.util, '_http_local', threading.local())
+
+    session1 = bleemeo_agent.util.get_http_session('http://host1/a')
+    assert bleemeo_agent.util.get_http_session('http://host1/b') is session1
+    closed = []
+    session1.close = lambda: closed.append(session1)
+    # different scheme or port means different session
+    session2 = bleemeo_agent.util.get_http_session('https://host1/a')
+    assert session2 is not session1
+    assert (
+        bleemeo_agent.util.get_http_session('http://host1:8080/')
+        is not session1
+    )
+
+    # host1 over http was the least recently used, it's dropped and closed
+    assert closed == [session1]
+    assert bleemeo_agent.util.get_http_session('https://host1/') is session2
+    assert bleemeo_agent.util.get_http_session('http://host1/') is not session1
+
+    # Each thread has its own sessions
+    other_thread = []
+    thread = threading.Thread(
+        target=lambda: other_thread.append(
+            bleemeo_agent.util.get_http_session('https://host1/'),
+        ),
+    )
+    thread.start()
+    thread.join()
+    assert other_thread[0] is not session2
+
+
+class CookieHandler(http_server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'session=secret; Path=/')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_http_session_cookies(monkeypatch):
+    monkeypatch.setattr(bleemeo_agent.util, '_http_local', threading.local())
+    server = http_server.HTTPServer(('127.0.0.1', 0), CookieHandler)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+
+    url = 'http://127.0.0.1:%d/' % server.server_port
+    session = bleemeo_agent.util.get_http_session(url)
+    response = session.get(url, timeout=5)
+    thread.join()
+    server.server_close()
+
+    assert response.status_code == 200
+    # Cookies aren't kept between requests
+    assert len(session.cookies) == 0
+
+
+def test_command_pool():
+    durations = []
+    pool = bleemeo_agent.util.CommandPool(
+        max_running=2,
+        max_output=10,
+        on_finish=lambda name, duration: durations.append(name),
+    )
+
+    (return_code, output) = pool.run(['echo', 'hello'], name='echo')
+    assert (return_code, output) == (0, b'hello\n')
+
+    (return_code, output) = pool.run(['seq', '1000'])
+    assert return_code == 0
+    assert output == b'1\n2\n3\n4\n5\n\n(output truncated)'
+
+    (return_code, output) = pool.run(['sleep', '10'], timeout=0.2)
+    assert return_code == 2
+
+    (return_code, output) = pool.run(['/does/not/exist'])
+    assert return_code == 127
+
+    assert durations == ['echo', 'seq', 'sleep']
+
+
+def test_command_pool_truncate_on_read_boundary():
+    # The limit is a multiple of the read size
+    pool = bleemeo_agent.util.CommandPool(max_output=4096)
+
+    (return_code, output) = pool.run(['sh', '-c', 'head -c 5000 /dev/zero'])
+    assert return_code == 0
+    assert output == b'\0' * 4096 + b'\n(output truncated)'
+
+    (return_code, output) = pool.run(['sh', '-c', 'head -c 4096 /dev/zero'])
+    assert output == b'\0' * 4096
+
+
+def test_command_pool_kill(monkeypatch):
+    monkeypatch.setattr(bleemeo_agent.util, 'COMMAND_KILL_DELAY', 0.2)
+    pool = bleemeo_agent.util.CommandPool()
+
+    # This command ignores SIGTERM
+    start = time.time()
+    (return_code, _) = pool.run(
+        ['sh', '-c', 'trap "" TERM; while true; do sleep 0.1; done'],
+        timeout=0.2,
+    )
+    assert return_code == 2
+    assert time.time() - start < 5
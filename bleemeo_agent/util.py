@@ -16,12 +16,18 @@
 #   limitations under the License.
 #
 
+import collections
+import ctypes
+import ctypes.util
 import datetime
+import errno
 import logging
 import os
 import random
 import re
+import select
 import shlex
+import struct
 import subprocess
 import sys
 import threading
@@ -30,6 +36,7 @@ import time
 import jinja2
 import psutil
 import requests
+from six.moves import http_cookiejar
 from six.moves import urllib_parse
 
 import bleemeo_agent
@@ -139,6 +146,133 @@ def format_cpu_time(cpu_time):
         return '%s:%.2f' % (minutes, cpu_time % 60)
 
 
+# inotify constants, from linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _get_mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return 0
+
+
+class FileWatcher:
+    """ Wait for modification of one file.
+
+        It uses inotify when available (Linux). The directory containing the
+        file is watched, so file replaced by a rename are also seen.
+        On other system or if inotify fails, it fallback to polling the
+        mtime of the file every poll_interval seconds.
+    """
+
+    def __init__(self, filename, poll_interval=10):
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self._mtime = _get_mtime(filename)
+        self._inotify_fd = None
+
+        try:
+            self._inotify_fd = self._inotify_setup()
+        except (OSError, AttributeError) as exc:
+            logging.debug(
+                'inotify unavailable for %s, using polling: %s',
+                filename,
+                exc,
+            )
+
+    def _inotify_setup(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is Linux only')
+
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOENT, 'libc not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        watch_descriptor = libc.inotify_add_watch(
+            fd,
+            directory.encode('utf-8'),
+            IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE,
+        )
+        if watch_descriptor < 0:
+            error = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(error, os.strerror(error))
+
+        return fd
+
+    @property
+    def use_inotify(self):
+        return self._inotify_fd is not None
+
+    def _read_inotify_events(self):
+        """ Read pending inotify events. Return True if one is about our file
+        """
+        basename = os.path.basename(self.filename).encode('utf-8')
+        matched = False
+        while True:
+            try:
+                data = os.read(self._inotify_fd, 4096)
+            except OSError as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return matched
+                raise
+
+            offset = 0
+            while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+                (_, _, _, name_len) = INOTIFY_EVENT_HEADER.unpack_from(
+                    data, offset,
+                )
+                offset += INOTIFY_EVENT_HEADER.size
+                name = data[offset:offset + name_len].rstrip(b'\0')
+                offset += name_len
+                if name == basename:
+                    matched = True
+
+    def wait(self, timeout=None):
+        """ Wait at most timeout seconds for a modification of the file
+
+            Return True if the file changed (its mtime changed).
+        """
+        if self.use_inotify:
+            if timeout is None:
+                (rlist, _, _) = select.select([self._inotify_fd], [], [])
+            else:
+                (rlist, _, _) = select.select(
+                    [self._inotify_fd], [], [], timeout,
+                )
+            if not rlist or not self._read_inotify_events():
+                return False
+        else:
+            if timeout is None:
+                timeout = self.poll_interval
+            time.sleep(min(timeout, self.poll_interval))
+
+        mtime = _get_mtime(self.filename)
+        if mtime != self._mtime:
+            self._mtime = mtime
+            return True
+        return False
+
+    def close(self):
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+
 def run_command_timeout(command, timeout=10):
     """ Run a command and wait at most timeout seconds
 
@@ -180,6 +314,140 @@ def run_command_timeout(command, timeout=10):
     return (returncode, output)
 
 
+# Default number of commands a CommandPool run at the same time
+COMMAND_POOL_SIZE = 4
+
+# Output of commands run by a CommandPool is truncated after this many bytes
+COMMAND_OUTPUT_MAX = 64 * 1024
+
+# A command still running COMMAND_KILL_DELAY seconds after it was terminated
+# on timeout is killed.
+COMMAND_KILL_DELAY = 5
+
+
+class CommandPool:
+    """ Run commands with a limit on concurrency and output size
+
+        At most max_running commands run at the same time, other callers
+        wait their turn. A single reaper thread terminate commands which
+        exceed their timeout, and kill them if they are still running
+        COMMAND_KILL_DELAY seconds later. Output above max_output bytes is
+        discarded.
+
+        If on_finish is given, it's called with (name, duration) after each
+        command, duration being the execution time of the command.
+    """
+
+    def __init__(
+            self, max_running=COMMAND_POOL_SIZE, max_output=COMMAND_OUTPUT_MAX,
+            on_finish=None):
+        self.max_output = max_output
+        self.on_finish = on_finish
+        self._semaphore = threading.BoundedSemaphore(max_running)
+        self._condition = threading.Condition()
+        # Running process => deadline
+        self._deadlines = {}
+        # Processes terminated by the reaper
+        self._terminated = set()
+        self._reaper = None
+
+    def run(self, command, timeout=10, name=None):
+        """ Run a command and wait at most timeout seconds
+
+            Same as run_command_timeout. Returns (return_code, output)
+        """
+        with self._semaphore:
+            start = get_clock()
+            try:
+                proc = subprocess.Popen(
+                    command,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                )
+            except OSError:
+                # Most probably: command not found
+                return (127, b"Unable to run command")
+
+            with self._condition:
+                self._deadlines[proc] = start + timeout
+                if self._reaper is None:
+                    self._reaper = threading.Thread(target=self._reap_loop)
+                    self._reaper.daemon = True
+                    self._reaper.start()
+                self._condition.notify()
+
+            try:
+                output = self._read_output(proc)
+                proc.wait()
+            finally:
+                with self._condition:
+                    self._deadlines.pop(proc, None)
+                    self._terminated.discard(proc)
+
+            duration = get_clock() - start
+
+        if self.on_finish is not None:
+            self.on_finish(name or command[0], duration)
+
+        returncode = proc.returncode
+        if returncode in (-15, -9):
+            # code -15 means SIGTERM and -9 SIGKILL, which are used by the
+            # reaper thread to implement timeout.
+            # Change returncode from timeout to a critical status
+            returncode = 2
+
+        return (returncode, output)
+
+    def _read_output(self, proc):
+        """ Read output of proc up to self.max_output bytes
+
+            Output after the limit is read and discarded, so the process
+            isn't blocked on a full pipe.
+        """
+        chunks = []
+        size = 0
+        truncated = False
+        with proc.stdout:
+            while True:
+                data = proc.stdout.read(4096)
+                if not data:
+                    break
+                kept = data[:self.max_output - size]
+                if kept:
+                    chunks.append(kept)
+                    size += len(kept)
+                if len(kept) < len(data):
+                    truncated = True
+
+        output = b''.join(chunks)
+        if truncated:
+            output += b'\n(output truncated)'
+        return output
+
+    def _reap_loop(self):
+        while True:
+            with self._condition:
+                now = get_clock()
+                for (proc, deadline) in list(self._deadlines.items()):
+                    if deadline > now:
+                        continue
+                    if proc.poll() is not None:
+                        del self._deadlines[proc]
+                    elif proc in self._terminated:
+                        del self._deadlines[proc]
+                        proc.kill()
+                    else:
+                        self._terminated.add(proc)
+                        self._deadlines[proc] = now + COMMAND_KILL_DELAY
+                        proc.terminate()
+
+                if self._deadlines:
+                    wait = min(self._deadlines.values()) - now
+                else:
+                    wait = None
+                self._condition.wait(wait)
+
+
 def clean_cmdline(cmdline):
     """ Remove character that may cause trouble.
 
@@ -370,63 +638,100 @@ def get_pending_update(core):
     return (None, None)
 
 
-def get_top_info(core):
-    """ Return informations needed to build a "top" view.
+def _get_process_info(process):
+    """ Return information about one process for get_top_info
+    """
+    try:
+        username = process.username()
+    except (KeyError, psutil.AccessDenied):
+        # the uid can't be resolved by the system
+        if os.name == 'nt':
+            username = ''
+        else:
+            username = str(process.uids().real)
+
+    # Cmdline may be unavailable (permission issue ?)
+    # When unavailable, depending on psutil version, it returns
+    # either [] or ['']
+    try:
+        argv = process.cmdline()
+        if argv and argv[0]:
+            cmdline = ' '.join(shlex.quote(x) for x in argv)
+            name = process.name()
+        else:
+            cmdline = process.name()
+            name = cmdline
+            argv = [cmdline]
+    except psutil.AccessDenied:
+        cmdline = process.name()
+        name = cmdline
+        argv = [cmdline]
+
+    cpu_times = process.cpu_times()
+    process_info = {
+        'pid': process.pid,
+        'create_time': process.create_time(),
+        'cmdline': cmdline,
+        'argv': argv,
+        'name': name,
+        'memory_rss': process.memory_info().rss / 1024,
+        'cpu_percent': process.cpu_percent(),
+        'cpu_times':
+            cpu_times.user + cpu_times.system,
+        'status': process.status(),
+        'username': username,
+    }
+    try:
+        process_info['exe'] = process.exe()
+    except psutil.AccessDenied:
+        process_info['exe'] = ''
+
+    return process_info
+
+
+def _get_processes_psutil():
+    """ Return the list of processes for get_top_info using psutil
     """
     processes = []
     for process in psutil.process_iter():
+        if process.pid == 0:
+            # PID 0 on Windows use it for "System Idle Process".
+            # PID 0 is not used Linux don't use it.
+            # Other system are currently not supported.
+            continue
         try:
-            if process.pid == 0:
-                # PID 0 on Windows use it for "System Idle Process".
-                # PID 0 is not used Linux don't use it.
-                # Other system are currently not supported.
-                continue
-            try:
-                username = process.username()
-            except (KeyError, psutil.AccessDenied):
-                # the uid can't be resolved by the system
-                if os.name == 'nt':
-                    username = ''
-                else:
-                    username = str(process.uids().real)
-
-            # Cmdline may be unavailable (permission issue ?)
-            # When unavailable, depending on psutil version, it returns
-            # either [] or ['']
-            try:
-                cmdline = process.cmdline()
-                if cmdline and cmdline[0]:
-                    cmdline = ' '.join(shlex.quote(x) for x in cmdline)
-                    name = process.name()
-                else:
-                    cmdline = process.name()
-                    name = cmdline
-            except psutil.AccessDenied:
-                cmdline = process.name()
-                name = cmdline
-
-            cpu_times = process.cpu_times()
-            process_info = {
-                'pid': process.pid,
-                'create_time': process.create_time(),
-                'cmdline': cmdline,
-                'name': name,
-                'memory_rss': process.memory_info().rss / 1024,
-                'cpu_percent': process.cpu_percent(),
-                'cpu_times':
-                    cpu_times.user + cpu_times.system,
-                'status': process.status(),
-                'username': username,
-            }
-            try:
-                process_info['exe'] = process.exe()
-            except psutil.AccessDenied:
-                process_info['exe'] = ''
+            if hasattr(process, 'oneshot'):
+                # psutil 5.0+: read each /proc file only once
+                with process.oneshot():
+                    process_info = _get_process_info(process)
+            else:
+                process_info = _get_process_info(process)
         except psutil.NoSuchProcess:
             continue
 
         processes.append(process_info)
 
+    return processes
+
+
+def get_top_info(core):
+    """ Return informations needed to build a "top" view.
+
+        Each process also contains "argv", the list of process arguments.
+        It is used by discovery and must be removed before sending the
+        top info (see strip_top_info and Core.get_top_info).
+
+        Prefer Core.get_top_info, which share one snapshot between all
+        users, to calling this function directly.
+
+        When core.process_reader is set (agent.process_reader: proc on
+        Linux), processes are read directly from /proc instead of psutil.
+    """
+    if core.process_reader is not None:
+        processes = core.process_reader.get_processes()
+    else:
+        processes = _get_processes_psutil()
+
     now = time.time()
     cpu_usage = psutil.cpu_times_percent()
     memory_usage = psutil.virtual_memory()
@@ -462,6 +767,71 @@ def get_top_info(core):
     return result
 
 
+def strip_top_info(top_info):
+    """ Return a copy of top_info without fields only used by the agent
+    """
+    result = top_info.copy()
+    result['processes'] = [
+        {
+            key: value
+            for (key, value) in process.items()
+            if key != 'argv'
+        }
+        for process in top_info['processes']
+    ]
+    return result
+
+
+def get_process_key(process):
+    """ Return the key identifying a process of top_info
+
+        The pid alone is not enough, it could be reused by a new process.
+    """
+    return (process['pid'], process['create_time'])
+
+
+def diff_top_info(previous_processes, processes, top_info):
+    """ Return top_info with processes encoded as a delta
+
+        previous_processes and processes map get_process_key to the
+        process entry, for the previous and the current top_info.
+
+        The processes list is replaced by:
+
+        * processes_added: full entry of new processes
+        * processes_changed: pid, create_time and changed fields of
+          processes which already existed
+        * processes_removed: [pid, create_time] of terminated processes
+    """
+    result = {
+        key: value
+        for (key, value) in top_info.items()
+        if key != 'processes'
+    }
+    added = []
+    changed = []
+    for (key, process) in processes.items():
+        previous = previous_processes.get(key)
+        if previous is None:
+            added.append(process)
+        elif previous != process:
+            changes = {
+                name: value
+                for (name, value) in process.items()
+                if previous.get(name) != value
+            }
+            changes['pid'] = process['pid']
+            changes['create_time'] = process['create_time']
+            changed.append(changes)
+
+    result['processes_added'] = added
+    result['processes_changed'] = changed
+    result['processes_removed'] = [
+        list(key) for key in previous_processes if key not in processes
+    ]
+    return result
+
+
 def get_top_output(top_info):
     """ Return a top-like output
     """
@@ -556,6 +926,55 @@ def get_top_output(top_info):
     )
 
 
+# HTTP sessions are kept per thread and target host, so connections (and
+# their TLS handshake) are reused between checks and metric pulls. Each
+# thread keeps at most HTTP_SESSIONS_MAX hosts. A session is only used by
+# one thread at a time, so it needs a single connection.
+HTTP_SESSIONS_MAX = 64
+
+_http_local = threading.local()
+
+
+def get_http_session(url):
+    """ Return the requests.Session to use for url
+
+        Sessions are shared per thread, scheme and host. requests.Session
+        isn't thread-safe, so a session must not be given to another
+        thread. The least recently used session of the thread is closed when
+        more than HTTP_SESSIONS_MAX hosts are used.
+
+        Sessions reject all cookies, so unrelated requests to the same host
+        don't share state.
+    """
+    url_parsed = urllib_parse.urlparse(url)
+    key = (url_parsed.scheme, url_parsed.netloc)
+
+    sessions = getattr(_http_local, 'sessions', None)
+    if sessions is None:
+        sessions = collections.OrderedDict()
+        _http_local.sessions = sessions
+
+    session = sessions.pop(key, None)
+    if session is None:
+        session = requests.Session()
+        session.cookies.set_policy(
+            http_cookiejar.DefaultCookiePolicy(allowed_domains=[]),
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=1,
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    sessions[key] = session
+
+    while len(sessions) > HTTP_SESSIONS_MAX:
+        (_, evicted) = sessions.popitem(last=False)
+        evicted.close()
+
+    return session
+
+
 def _get_url(core, name, metric_config):
     url = metric_config['url']
 
@@ -583,7 +1002,7 @@ def _get_url(core, name, metric_config):
             metric_config.get('password', '')
         )
     try:
-        response = requests.get(
+        response = get_http_session(url).get(
             url,
             **args
         )
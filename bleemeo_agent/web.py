@@ -30,6 +30,8 @@ app_thread = None
 
 @app.route('/')
 def home():
+    # The page is refreshed every 10 seconds and shows top info
+    app.core.request_fast_top_info()
     loads = bleemeo_agent.util.get_loadavg(app.core)
     check_info = _gather_checks_info()
     top_output = bleemeo_agent.util.get_top_output(app.core.top_info)
@@ -109,6 +111,21 @@ def check():
     )
 
 
+@app.route('/jobs')
+def jobs():
+    jobs_stats = sorted(
+        (stats.snapshot(percentiles=(95,))
+         for stats in app.core.get_jobs_stats()),
+        key=lambda x: x['name'],
+    )
+
+    return flask.render_template(
+        'jobs.html',
+        core=app.core,
+        jobs_stats=jobs_stats,
+    )
+
+
 @app.template_filter('netsizeformat')
 def filter_netsizeformat(value):
     """ Same as standard filesizeformat but for network.
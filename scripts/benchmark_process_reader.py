@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+#  Copyright 2015-2016 Bleemeo
+#
+#  bleemeo.com an infrastructure monitoring solution in the Cloud
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+""" Benchmark of the psutil and /proc process readers.
+
+    Both readers list the processes of a synthetic /proc tree (the one
+    used by procfs_test), psutil being pointed at it with PROCFS_PATH.
+    Linux only.
+
+    Run from the source tree (pytest is needed for the test fixtures)::
+
+        python3 scripts/benchmark_process_reader.py --count 2000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import psutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import bleemeo_agent.procfs  # noqa: E402
+from bleemeo_agent.tests.procfs_test import (  # noqa: E402
+    _make_proc_tree, BOOT_TIME,
+)
+import bleemeo_agent.util  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if not hasattr(psutil, 'PROCFS_PATH'):
+        sys.exit('psutil does not support PROCFS_PATH')
+
+    proc_path = tempfile.mkdtemp()
+    try:
+        _make_proc_tree(proc_path, count=args.count)
+        psutil.PROCFS_PATH = proc_path
+        psutil.boot_time = lambda: BOOT_TIME
+        reader = bleemeo_agent.procfs.ProcessReader(proc_path)
+
+        readers = (
+            ('psutil', bleemeo_agent.util._get_processes_psutil),
+            ('ProcessReader', reader.get_processes),
+        )
+        for (name, func) in readers:
+            processes = len(func())
+            best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+            print('%-15s %d processes: %.3f s' % (name, processes, best))
+    finally:
+        shutil.rmtree(proc_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+#  Copyright 2015-2016 Bleemeo
+#
+#  bleemeo.com an infrastructure monitoring solution in the Cloud
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+""" Benchmark of get_service_info on synthetic processes.
+
+    It compares matching the process argv directly with the previous path,
+    where argv was joined with shlex.quote and split again with shlex.split
+    before matching.
+
+    Run from the source tree (pytest is needed for the test fixtures)::
+
+        python3 scripts/benchmark_service_info.py --count 5000
+"""
+
+import argparse
+import os
+import shlex
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import bleemeo_agent.core  # noqa: E402
+from bleemeo_agent.tests.core_test import PROCESS_SERVICE  # noqa: E402
+
+
+def match_argv(processes):
+    for argv in processes:
+        bleemeo_agent.core.get_service_info(argv)
+
+
+def match_quote_split(processes):
+    for argv in processes:
+        cmdline = ' '.join(shlex.quote(x) for x in argv)
+        bleemeo_agent.core.get_service_info(shlex.split(cmdline))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    processes = [
+        PROCESS_SERVICE[index % len(PROCESS_SERVICE)][0].split()
+        for index in range(args.count)
+    ]
+
+    for func in (match_argv, match_quote_split):
+        best = min(timeit.repeat(
+            lambda: func(processes), number=1, repeat=args.repeat,
+        ))
+        print('%-20s %d processes: %.3f s' % (
+            func.__name__, args.count, best,
+        ))
+
+
+if __name__ == '__main__':
+    main()